@@ -1,4 +1,5 @@
 import itertools
+import time
 from copy import deepcopy
 
 import numpy as np
@@ -6,12 +7,13 @@ import tensorflow as tf
 import tensorflow_probability as tfp
 from tqdm import tqdm
 
+from rl.checkpoint import AsyncCheckpointManager
 from rl.replay_buffer import UniformReplayBuffer, ReplayField, EpisodeReturn
 from rl.utils import MeanAccumulator
 
 
 class AlphaZero:
-    def __init__(self, game, policy_and_vf_fn, lr, replay_buffer_size, ckpt_dir, log_dir):
+    def __init__(self, game, policy_and_vf_fn, lr, replay_buffer_size, ckpt_dir, log_dir, async_ckpt=False):
         self.game = game
         self.policy_and_vf = policy_and_vf_fn()
         self.ckpt_dir = ckpt_dir
@@ -38,15 +40,19 @@ class AlphaZero:
         self.iterations_done = tf.Variable(0, dtype=tf.int64, trainable=False)
         self.ckpt = tf.train.Checkpoint(iterations_done=self.iterations_done, optimizer=self.optimizer,
                                         policy_and_vf=self.policy_and_vf)
-        self.ckpt_manager = tf.train.CheckpointManager(
-            self.ckpt, self.ckpt_dir, max_to_keep=1, keep_checkpoint_every_n_hours=1)
+        if async_ckpt:
+            self.ckpt_manager = AsyncCheckpointManager(self.ckpt, self.ckpt_dir, max_to_keep=1)
+        else:
+            self.ckpt_manager = tf.train.CheckpointManager(
+                self.ckpt, self.ckpt_dir, max_to_keep=1, keep_checkpoint_every_n_hours=1)
         self.ckpt.restore(self.ckpt_manager.latest_checkpoint).expect_partial()
 
     def train(self, n_iterations, n_self_play_games,
               mcts_tau, mcts_n_steps, mcts_eta, mcts_epsilon, mcts_c_puct,
               update_batch_size, update_iterations,
-              ckpt_every, log_every, eval_every):
+              ckpt_every, log_every, eval_every, ckpt_every_seconds=None):
         summary_writer = tf.summary.create_file_writer(self.log_dir)
+        last_ckpt_time = time.monotonic()
         with tqdm(total=n_iterations, desc='Running train loop', unit='iteration') as pbar:
             pbar.update(self.ckpt.iterations_done.numpy())
             for i in range(self.ckpt.iterations_done.numpy(), n_iterations):
@@ -72,8 +78,14 @@ class AlphaZero:
 
                 losses = self.update(update_batch_size, update_iterations)
 
-                if i % ckpt_every == 0 or i == n_iterations - 1:
+                # Every ckpt_every iterations, or every ckpt_every_seconds of wall-clock time instead
+                if ckpt_every_seconds is None:
+                    ckpt_due = i % ckpt_every == 0
+                else:
+                    ckpt_due = time.monotonic() - last_ckpt_time >= ckpt_every_seconds
+                if ckpt_due or i == n_iterations - 1:
                     self.ckpt_manager.save()
+                    last_ckpt_time = time.monotonic()
                 if i % log_every == 0 or i == n_iterations - 1:
                     with summary_writer.as_default(), tf.name_scope('losses'):
                         for k, v in losses.items():
@@ -96,6 +108,8 @@ class AlphaZero:
                 self.ckpt.iterations_done.assign_add(1)
                 pbar.update(1)
 
+        if isinstance(self.ckpt_manager, AsyncCheckpointManager):
+            self.ckpt_manager.flush()
         self.game.close()
 
     def update(self, update_batch_size, update_iterations):
@@ -8,7 +8,7 @@ from rl.utils import MeanAccumulator, GradientAccumulator, tf_standardize
 class PPOClip:
     def __init__(self, env, policy_fn, vf_fn, lr_policy, lr_vf, gamma, lambda_, epsilon,
                  policy_update_iterations, vf_update_iterations, policy_update_batch_size,
-                 vf_update_batch_size, replay_buffer_size):
+                 vf_update_batch_size, replay_buffer_size, replay_buffer_fn=OnePassReplayBuffer):
         self.env = env
         self.policy = policy_fn()
         self.policy_old = policy_fn()
@@ -24,7 +24,7 @@ class PPOClip:
         self.policy_update_batch_size = policy_update_batch_size
         self.vf_update_batch_size = vf_update_batch_size
 
-        self.replay_buffer = OnePassReplayBuffer(
+        self.replay_buffer = replay_buffer_fn(
             buffer_size=replay_buffer_size,
             store_fields=[
                 ReplayField('observation', shape=self.env.observation_space.shape,
@@ -61,6 +61,12 @@ class PPOClip:
             self.replay_buffer.store_transition(transition)
         return transition
 
+    def act_vector(self, observations):
+        return self.policy.sample(observations).numpy()
+
+    def values_vector(self, observations):
+        return self.vf.compute(observations).numpy()[:, 0]
+
     def update(self):
         result = {
             'policy_loss': self._update_policy(self.replay_buffer.as_dataset(self.policy_update_batch_size)),
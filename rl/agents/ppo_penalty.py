@@ -9,7 +9,8 @@ from rl.utils import MeanAccumulator, GradientAccumulator, tf_standardize
 class PPOPenalty:
     def __init__(self, env, policy_fn, vf_fn, lr_policy, lr_vf, gamma, lambda_, beta, kl_target,
                  kl_tolerance, beta_update_factor, vf_update_iterations, policy_update_iterations,
-                 policy_update_batch_size, vf_update_batch_size, replay_buffer_size):
+                 policy_update_batch_size, vf_update_batch_size, replay_buffer_size,
+                 replay_buffer_fn=OnePassReplayBuffer):
         self.env = env
         self.policy = policy_fn()
         self.policy_old = policy_fn()
@@ -28,7 +29,7 @@ class PPOPenalty:
         self.policy_update_batch_size = policy_update_batch_size
         self.vf_update_batch_size = vf_update_batch_size
 
-        self.replay_buffer = OnePassReplayBuffer(
+        self.replay_buffer = replay_buffer_fn(
             buffer_size=replay_buffer_size,
             store_fields=[
                 ReplayField('observation', shape=self.env.observation_space.shape,
@@ -1,13 +1,15 @@
 import numpy as np
 import tensorflow as tf
 
-from rl.replay_buffer import UniformReplayBuffer, ReplayField
+from rl.replay_buffer import UniformReplayBuffer, PrioritizedReplayBuffer, ReplayField, NextObservationField, \
+    VariableReplayBuffer, n_step_fields
 from rl.utils import MeanAccumulator
 
 
 class SAC:
     def __init__(self, env, policy_fn, qf_fn, lr_policy, lr_qf, gamma, polyak, alpha,
-                 update_iterations, update_batch_size, replay_buffer_size):
+                 update_iterations, update_batch_size, replay_buffer_size,
+                 replay_buffer_fn=UniformReplayBuffer, n_step=1):
         self.env = env
         self.policy = policy_fn()
         self.qf1 = qf_fn()
@@ -21,24 +23,25 @@ class SAC:
         self.lr_policy = lr_policy
         self.lr_qf = lr_qf
         self.gamma = gamma
+        self.n_step = n_step
         self.polyak = polyak
         self.alpha = alpha
         self.update_iterations = update_iterations
         self.update_batch_size = update_batch_size
 
-        self.replay_buffer = UniformReplayBuffer(
+        self.replay_buffer = replay_buffer_fn(
             buffer_size=replay_buffer_size,
             store_fields=[
                 ReplayField('observation', shape=self.env.observation_space.shape,
                             dtype=self.env.observation_space.dtype),
-                ReplayField('observation_next', shape=self.env.observation_space.shape,
-                            dtype=self.env.observation_space.dtype),
+                NextObservationField('observation_next', shape=self.env.observation_space.shape,
+                                     dtype=self.env.observation_space.dtype),
                 ReplayField('action', shape=self.env.action_space.shape,
                             dtype=self.env.action_space.dtype),
                 ReplayField('reward'),
                 ReplayField('done', dtype=np.bool),
             ],
-            compute_fields=[],
+            compute_fields=n_step_fields(n_step, gamma),
         )
         self.policy_optimizer = tf.keras.optimizers.Adam(learning_rate=self.lr_policy)
         self.qf_optimizer = tf.keras.optimizers.Adam(learning_rate=self.lr_qf)
@@ -59,11 +62,20 @@ class SAC:
             self.replay_buffer.store_transition(transition)
         return transition
 
+    def act_vector(self, observations):
+        return self.policy.sample(observations, return_entropy=False).numpy()
+
     def update(self):
+        if isinstance(self.replay_buffer, VariableReplayBuffer):
+            self.replay_buffer.sync()
+            return self._update_in_graph()
         dataset = self.replay_buffer.as_dataset(self.update_batch_size).take(self.update_iterations)
         policy_loss_acc, qf_loss_acc = MeanAccumulator(), MeanAccumulator()
         for data in dataset:
-            qf_loss_acc.add(self._update_qf(data))
+            qf_loss, td_error = self._update_qf(data)
+            qf_loss_acc.add(qf_loss)
+            if isinstance(self.replay_buffer, PrioritizedReplayBuffer):
+                self.replay_buffer.update_priorities(data['indices'].numpy(), td_error.numpy())
             policy_loss_acc.add(self._update_policy(data))
             self._update_targets()
         return {
@@ -71,10 +83,26 @@ class SAC:
             'qf_loss': qf_loss_acc.value(),
         }
 
+    @tf.function
+    def _update_in_graph(self):
+        # Sampling and every update iteration run in this one call
+        policy_loss, qf_loss = 0.0, 0.0
+        for _ in tf.range(self.update_iterations):
+            data = self.replay_buffer.sample(self.update_batch_size)
+            qf_loss += self._update_qf(data)[0]
+            policy_loss += self._update_policy(data)
+            self._update_targets()
+        return {
+            'policy_loss': policy_loss / self.update_iterations,
+            'qf_loss': qf_loss / self.update_iterations,
+        }
+
     @tf.function(experimental_relax_shapes=True)
     def _update_qf(self, data):
         observation, observation_next = data['observation'], data['observation_next']
-        action, reward, done = data['action'], data['reward'], tf.cast(data['done'], tf.float32)
+        action = data['action']
+        reward, discount = self._reward_and_discount(data)
+        weights = data.get('weights', 1.0)
         with tf.GradientTape(watch_accessed_variables=False) as tape:
             tape.watch(self.qf1.trainable_variables)
             tape.watch(self.qf2.trainable_variables)
@@ -84,14 +112,19 @@ class SAC:
             q1_target = self.qf1_target.compute(observation_next, target_action)
             q2_target = self.qf2_target.compute(observation_next, target_action)
             q_target = tf.minimum(q1_target, q2_target)
-            bellman_backup = reward + self.gamma * (1 - done) * (q_target - self.alpha * target_action_entropy)
-            q1_loss = tf.keras.losses.mean_squared_error(q1, bellman_backup)
-            q2_loss = tf.keras.losses.mean_squared_error(q2, bellman_backup)
+            bellman_backup = reward + discount * (q_target - self.alpha * target_action_entropy)
+            q1_loss = tf.reduce_mean(weights * tf.math.squared_difference(q1, bellman_backup))
+            q2_loss = tf.reduce_mean(weights * tf.math.squared_difference(q2, bellman_backup))
             loss = q1_loss + q2_loss
             variables = self.qf1.trainable_variables + self.qf2.trainable_variables
             gradients = tape.gradient(loss, variables)
             self.qf_optimizer.apply_gradients(zip(gradients, variables))
-        return loss
+        return loss, bellman_backup - tf.minimum(q1, q2)
+
+    def _reward_and_discount(self, data):
+        if self.n_step == 1:
+            return data['reward'], self.gamma * (1 - tf.cast(data['done'], tf.float32))
+        return data['n_step_return'], data['n_step_discount']
 
     @tf.function(experimental_relax_shapes=True)
     def _update_policy(self, data):
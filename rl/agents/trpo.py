@@ -9,7 +9,8 @@ from rl.utils import MeanAccumulator, GradientAccumulator, tf_standardize
 class TRPO:
     def __init__(self, env, policy_fn, vf_fn, lr_vf, gamma, lambda_, delta, replay_buffer_size,
                  policy_update_batch_size, vf_update_batch_size, vf_update_iterations, conjugate_gradient_iterations,
-                 conjugate_gradient_tol, line_search_iterations, line_search_coefficient):
+                 conjugate_gradient_tol, line_search_iterations, line_search_coefficient,
+                 replay_buffer_fn=OnePassReplayBuffer):
         self.env = env
         self.policy = policy_fn()
         self.vf = vf_fn()
@@ -24,7 +25,7 @@ class TRPO:
         self.line_search_iterations = line_search_iterations
         self.line_search_coefficient = line_search_coefficient
 
-        self.replay_buffer = OnePassReplayBuffer(
+        self.replay_buffer = replay_buffer_fn(
             buffer_size=replay_buffer_size,
             store_fields=[
                 ReplayField('observation', shape=self.env.observation_space.shape,
@@ -6,12 +6,13 @@ from rl.utils import GradientAccumulator, MeanAccumulator, tf_standardize
 
 
 class VPG:
-    def __init__(self, env, policy_fn, lr, replay_buffer_size, policy_update_batch_size):
+    def __init__(self, env, policy_fn, lr, replay_buffer_size, policy_update_batch_size,
+                 replay_buffer_fn=OnePassReplayBuffer):
         self.env = env
         self.policy = policy_fn()
         self.policy_update_batch_size = policy_update_batch_size
 
-        self.replay_buffer = OnePassReplayBuffer(
+        self.replay_buffer = replay_buffer_fn(
             buffer_size=replay_buffer_size,
             store_fields=[
                 ReplayField('observation', shape=self.env.observation_space.shape,
@@ -7,7 +7,8 @@ from rl.utils import GradientAccumulator, MeanAccumulator, tf_standardize
 
 class VPGGAE:
     def __init__(self, env, policy_fn, vf_fn, lr_policy, lr_vf, gamma, lambda_, vf_update_iterations,
-                 policy_update_batch_size, vf_update_batch_size, replay_buffer_size):
+                 policy_update_batch_size, vf_update_batch_size, replay_buffer_size,
+                 replay_buffer_fn=OnePassReplayBuffer):
         self.env = env
         self.policy = policy_fn()
         self.vf = vf_fn()
@@ -15,7 +16,7 @@ class VPGGAE:
         self.policy_update_batch_size = policy_update_batch_size
         self.vf_update_batch_size = vf_update_batch_size
 
-        self.replay_buffer = OnePassReplayBuffer(
+        self.replay_buffer = replay_buffer_fn(
             buffer_size=replay_buffer_size,
             store_fields=[
                 ReplayField('observation', shape=self.env.observation_space.shape,
@@ -52,6 +53,12 @@ class VPGGAE:
             self.replay_buffer.store_transition(transition)
         return transition
 
+    def act_vector(self, observations):
+        return self.policy.sample(observations).numpy()
+
+    def values_vector(self, observations):
+        return self.vf.compute(observations).numpy()[:, 0]
+
     def update(self):
         result = {
             'policy_loss': self._update_policy(self.replay_buffer.as_dataset(self.policy_update_batch_size)),
@@ -0,0 +1,174 @@
+import argparse
+import json
+import platform
+import subprocess
+import sys
+import time
+import timeit
+
+import numpy as np
+import tensorflow as tf
+
+from rl.replay_buffer import OnePassReplayBuffer, UniformReplayBuffer, ReplayField, ComputeField, Advantage, \
+    RewardToGo, EpisodeReturn, EpisodeLength
+
+# The field shapes, compute fields and episode lengths of the zoo agents, each benchmarked at several buffer sizes
+SCENARIOS = {
+    'cartpole': {
+        'store_fields': lambda: [ReplayField('observation', shape=(4,)), ReplayField('action', dtype=np.int64),
+                                 ReplayField('reward'), ReplayField('value'), ReplayField('value_next'),
+                                 ReplayField('done', dtype=bool)],
+        'compute_fields': lambda: [Advantage(gamma=0.99, lambda_=0.97), RewardToGo(gamma=0.99)],
+        'episode_lengths': (10, 250),
+        'buffer_sizes': (2_000, 20_000, 200_000),
+    },
+    'pong': {
+        'store_fields': lambda: [ReplayField('observation', dtype=np.int8, shape=(80, 80, 4)),
+                                 ReplayField('action', dtype=np.int64), ReplayField('reward'), ReplayField('value'),
+                                 ReplayField('value_next'), ReplayField('done', dtype=bool)],
+        'compute_fields': lambda: [Advantage(gamma=0.99, lambda_=0.97), RewardToGo(gamma=0.99)],
+        'episode_lengths': (800, 5_000),
+        'buffer_sizes': (1_000, 10_000),
+    },
+    'alpha_zero': {
+        'store_fields': lambda: [ReplayField('observation', dtype=np.int8, shape=(6, 7, 1)),
+                                 ReplayField('pi', shape=(7,)), ReplayField('player'), ReplayField('score'),
+                                 ReplayField('done', dtype=bool)],
+        'compute_fields': lambda: [EpisodeReturn(reward_field='score', name='z')],
+        'episode_lengths': (7, 43),
+        'buffer_sizes': (5_000, 50_000, 500_000),
+    },
+}
+
+
+def time_per_call(fn, number=20):
+    return timeit.timeit(fn, number=number) / number
+
+
+def random_transitions(store_fields, n, episode_lengths, rng):
+    """
+    n transitions of random values, split into episodes whose lengths are uniform in [low, high).
+    """
+    transitions = {}
+    for f in store_fields:
+        if np.issubdtype(f.dtype, np.integer):
+            transitions[f.name] = rng.integers(-1, 2, size=(n, *f.shape)).astype(f.dtype)
+        else:
+            transitions[f.name] = rng.normal(size=(n, *f.shape)).astype(f.dtype)
+    lengths = rng.integers(*episode_lengths, size=n // episode_lengths[0] + 1)
+    dones = np.zeros(np.sum(lengths), dtype=bool)
+    dones[np.cumsum(lengths) - 1] = True
+    transitions['done'] = dones[:n]
+    return transitions
+
+
+def benchmark_scenario(scenario, buffer_size, batch_size=64, store_calls=2_000, sample_batches=200, seed=0):
+    """
+    Times storing, computing and sampling the transitions of a scenario, returns {benchmark: (value, unit)}.
+    """
+    spec = SCENARIOS[scenario]
+    rng = np.random.default_rng(seed)
+    transitions = random_transitions(spec['store_fields'](), buffer_size, spec['episode_lengths'], rng)
+
+    def create(buffer_cls):
+        return buffer_cls(buffer_size=buffer_size, store_fields=spec['store_fields'](),
+                          compute_fields=spec['compute_fields']())
+
+    results = {}
+    buffer = create(UniformReplayBuffer)
+    n = min(store_calls, buffer_size)
+    singles = [{k: v[i] for k, v in transitions.items()} for i in range(n)]
+    start = time.perf_counter()
+    for transition in singles:
+        buffer.store_transition(transition)
+    results['store_transition'] = ((time.perf_counter() - start) / n * 1e6, 'us/transition')
+    start = time.perf_counter()
+    buffer.store_transitions(transitions)
+    results['store_transitions'] = ((time.perf_counter() - start) / buffer_size * 1e6, 'us/transition')
+
+    def compute():
+        buffer.compute_head = 0
+        buffer._compute()
+
+    results['compute'] = (time_per_call(compute, number=5) * 1e3, 'ms/full buffer')
+
+    start = time.perf_counter()
+    for _ in buffer.as_dataset(batch_size).take(sample_batches):
+        pass
+    results['uniform_as_dataset'] = (sample_batches / (time.perf_counter() - start), 'batches/s')
+    del buffer
+
+    buffer = create(OnePassReplayBuffer)
+    buffer.store_transitions(transitions)
+    start = time.perf_counter()
+    for _ in buffer.as_dataset(batch_size):
+        pass
+    results['one_pass_as_dataset'] = (buffer_size / (time.perf_counter() - start), 'transitions/s')
+    return results
+
+
+def benchmark_compute_fields(buffer_size=2000, min_episode_length=10, max_episode_length=60, seed=0):
+    """
+    Times every ComputeField on a full buffer of short episodes, computed episode by episode (the ComputeField.compute
+    fallback) and for all the episodes at once. Returns {field: {'per_episode': seconds, 'vectorized': seconds}}.
+    """
+    rng = np.random.default_rng(seed)
+    buffer = OnePassReplayBuffer(
+        buffer_size=buffer_size,
+        store_fields=[ReplayField('reward'), ReplayField('value'), ReplayField('value_next'),
+                      ReplayField('done', dtype=bool)],
+        compute_fields=[Advantage(gamma=0.99, lambda_=0.97), RewardToGo(gamma=0.99), EpisodeReturn(), EpisodeLength()],
+    )
+    lengths = rng.integers(min_episode_length, max_episode_length, size=buffer_size // min_episode_length)
+    dones = np.zeros(np.sum(lengths), dtype=bool)
+    dones[np.cumsum(lengths) - 1] = True
+    buffer.store_transitions({'reward': rng.normal(size=buffer_size), 'value': rng.normal(size=buffer_size),
+                              'value_next': rng.normal(size=buffer_size), 'done': dones[:buffer_size]})
+    dones = buffer.buffers['done'][:]
+    results = {}
+    for f in buffer.compute_fields:
+        results[f.name] = {
+            'per_episode': time_per_call(lambda: ComputeField.compute(f, buffer.buffers, 0, buffer_size, dones)),
+            'vectorized': time_per_call(lambda: f.compute(buffer.buffers, 0, buffer_size, dones)),
+        }
+    return results
+
+
+def run(scenarios=tuple(SCENARIOS), quick=False):
+    """
+    Runs the benchmarks, returns a JSON-serializable report whose records can be compared across commits.
+    """
+    records = []
+    for scenario in scenarios:
+        buffer_sizes = SCENARIOS[scenario]['buffer_sizes']
+        for buffer_size in buffer_sizes[:1] if quick else buffer_sizes:
+            for benchmark, (value, unit) in benchmark_scenario(scenario, buffer_size).items():
+                records.append({'scenario': scenario, 'buffer_size': buffer_size, 'benchmark': benchmark,
+                                'value': value, 'unit': unit})
+    for field, timings in benchmark_compute_fields().items():
+        for path, seconds in timings.items():
+            records.append({'scenario': 'compute_fields', 'buffer_size': 2000, 'benchmark': f'{field}_{path}',
+                            'value': seconds * 1e3, 'unit': 'ms/full buffer'})
+    return {'commit': _commit(), 'python': platform.python_version(), 'numpy': np.__version__,
+            'tensorflow': tf.__version__, 'machine': platform.machine(), 'records': records}
+
+
+def _commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks the replay buffer hot paths, prints a JSON report')
+    parser.add_argument('--scenarios', nargs='+', choices=list(SCENARIOS), default=list(SCENARIOS))
+    parser.add_argument('--quick', action='store_true', help='only the smallest buffer size of every scenario')
+    parser.add_argument('--output', help='write the report to this file instead of stdout')
+    args = parser.parse_args()
+    report = run(args.scenarios, args.quick)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
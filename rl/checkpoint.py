@@ -0,0 +1,117 @@
+import atexit
+import glob
+import os
+import queue
+import re
+import threading
+
+import tensorflow as tf
+
+try:
+    from tensorflow.python.checkpoint.graph_view import ObjectGraphView
+except ImportError:
+    from tensorflow.python.training.tracking.graph_view import ObjectGraphView
+
+# Since TF 2.10 Checkpoint.write can copy the variables to the host and serialize them in a thread of its own
+_TF_ASYNC = hasattr(tf.train.Checkpoint, 'sync')
+
+
+class AsyncCheckpointManager:
+    """
+    A stand-in for tf.train.CheckpointManager whose save snapshots the variables and returns before the checkpoint is
+    on disk. With TF's async checkpoints TF copies and writes them, otherwise the tensors they read are the snapshot
+    and a background thread serializes them. That thread only points the checkpoint state at a checkpoint once it's
+    written. Up to max_pending checkpoints wait, save blocks on the next one. flush waits for all of them, close runs
+    at exit too, so that no checkpoint taken is lost.
+    """
+
+    def __init__(self, checkpoint, directory, max_to_keep=1, max_pending=2):
+        self.checkpoint = checkpoint
+        self.directory = directory
+        self.max_to_keep = max_to_keep
+        os.makedirs(directory, exist_ok=True)
+
+        state = tf.train.get_checkpoint_state(directory)
+        self.checkpoints = list(state.all_model_checkpoint_paths) if state else []
+        # Numbered on from the checkpoints of tf.train.CheckpointManager as well
+        self.number = max([_number(path) for path in self.checkpoints], default=0) + 1
+
+        self._queue = queue.Queue(max_pending)
+        self._errors = []
+        threading.Thread(target=self._complete, daemon=True).start()
+        atexit.register(self.close)
+
+    @property
+    def latest_checkpoint(self):
+        return self.checkpoints[-1] if self.checkpoints else None
+
+    def save(self):
+        self._raise_errors()
+        path = os.path.join(self.directory, f'ckpt-{self.number}')
+        self.number += 1
+        if _TF_ASYNC:
+            self.checkpoint.write(path, options=tf.train.CheckpointOptions(experimental_enable_async_checkpoint=True))
+            self._queue.put((path, None))
+        else:
+            # Tensors read from the variables keep their values, TF copies a variable that's updated meanwhile
+            saveables = ObjectGraphView(self.checkpoint).frozen_saveable_objects()
+            self._queue.put((path, [(spec.name, spec.slice_spec, spec.tensor)
+                                    for saveable in saveables for spec in saveable.specs]))
+        return path
+
+    def flush(self):
+        self._queue.join()
+        self._raise_errors()
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            atexit.unregister(self.close)
+
+    def _complete(self):
+        while True:
+            path, snapshot = self._queue.get()
+            try:
+                self._write(path, snapshot)
+                if not os.path.exists(f'{path}.index'):
+                    raise FileNotFoundError(f'{path} was not written')
+                self.checkpoints.append(path)
+                removed = self.checkpoints[:-self.max_to_keep]
+                del self.checkpoints[:-self.max_to_keep]
+                self._write_state()
+                for path in removed:
+                    for file in glob.glob(f'{path}.*'):
+                        os.remove(file)
+            except Exception as e:
+                self._errors.append(e)
+            finally:
+                self._queue.task_done()
+
+    def _write(self, path, snapshot):
+        if snapshot is None:
+            self.checkpoint.sync()
+        else:
+            names, slices, tensors = zip(*snapshot)
+            tf.raw_ops.SaveV2(prefix=path, tensor_names=list(names), shape_and_slices=list(slices),
+                              tensors=list(tensors))
+
+    def _write_state(self):
+        lines = [f'model_checkpoint_path: "{self.checkpoints[-1]}"']
+        lines += [f'all_model_checkpoint_paths: "{path}"' for path in self.checkpoints]
+        path = os.path.join(self.directory, 'checkpoint')
+        with open(f'{path}.tmp', 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(f'{path}.tmp', path)
+
+    def _raise_errors(self):
+        # Failures are raised once, by the next call
+        if self._errors:
+            error = self._errors.pop(0)
+            self._errors.clear()
+            raise RuntimeError('Writing a checkpoint failed') from error
+
+
+def _number(path):
+    match = re.search(r'-(\d+)$', path)
+    return int(match.group(1)) if match else 0
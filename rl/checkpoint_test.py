@@ -0,0 +1,85 @@
+import os
+import threading
+
+import pytest
+import tensorflow as tf
+
+from rl.checkpoint import AsyncCheckpointManager
+
+
+@pytest.fixture
+def variable():
+    return tf.Variable(0.0)
+
+
+@pytest.fixture(params=[False, True], ids=['staged', 'tf_async'], autouse=True)
+def tf_async(request, monkeypatch):
+    if request.param and not hasattr(tf.train.Checkpoint, 'sync'):
+        pytest.skip('TF has no async checkpoints')
+    monkeypatch.setattr('rl.checkpoint._TF_ASYNC', request.param)
+
+
+@pytest.fixture
+def manager(variable, tmp_path):
+    manager = AsyncCheckpointManager(tf.train.Checkpoint(v=variable), str(tmp_path / 'ckpt'), max_to_keep=2)
+    yield manager
+    manager.close()
+
+
+class TestAsyncCheckpointManager:
+
+    def test_save_snapshots_the_variables(self, variable, manager, tmp_path):
+        variable.assign(1.0)
+        path = manager.save()
+        # Assigned before the checkpoint is on disk
+        variable.assign(2.0)
+        manager.flush()
+        assert manager.latest_checkpoint == path
+        assert tf.train.latest_checkpoint(str(tmp_path / 'ckpt')) == path
+        tf.train.Checkpoint(v=variable).restore(path)
+        assert variable.numpy() == 1.0
+
+    def test_save_returns_before_the_write(self, variable, manager, tmp_path, monkeypatch):
+        written = threading.Event()
+        write = manager._write
+
+        def blocked_write(path, snapshot):
+            written.wait()
+            write(path, snapshot)
+
+        monkeypatch.setattr(manager, '_write', blocked_write)
+        variable.assign(1.0)
+        path = manager.save()
+        variable.assign(2.0)
+        assert manager.latest_checkpoint is None
+        assert tf.train.latest_checkpoint(str(tmp_path / 'ckpt')) is None
+        written.set()
+        manager.flush()
+        assert manager.latest_checkpoint == path
+        tf.train.Checkpoint(v=variable).restore(path)
+        assert variable.numpy() == 1.0
+
+    def test_keeps_the_latest_checkpoints(self, manager, tmp_path):
+        paths = [manager.save() for _ in range(4)]
+        manager.flush()
+        assert manager.checkpoints == paths[2:]
+        assert tf.train.get_checkpoint_state(str(tmp_path / 'ckpt')).all_model_checkpoint_paths == paths[2:]
+        assert sorted(os.listdir(tmp_path / 'ckpt')) == ['checkpoint', 'ckpt-3.data-00000-of-00001', 'ckpt-3.index',
+                                                         'ckpt-4.data-00000-of-00001', 'ckpt-4.index']
+
+    def test_continues_after_checkpoint_manager(self, variable, tmp_path):
+        checkpoint = tf.train.Checkpoint(v=variable)
+        tf.train.CheckpointManager(checkpoint, str(tmp_path), max_to_keep=1).save()
+        manager = AsyncCheckpointManager(checkpoint, str(tmp_path))
+        assert manager.latest_checkpoint == str(tmp_path / 'ckpt-1')
+        assert manager.save() == str(tmp_path / 'ckpt-2')
+        manager.close()
+        assert tf.train.CheckpointManager(checkpoint, str(tmp_path), max_to_keep=1).latest_checkpoint == \
+            str(tmp_path / 'ckpt-2')
+
+    def test_errors_surface(self, manager, tmp_path):
+        # The checkpoint state can't be written
+        os.mkdir(tmp_path / 'ckpt' / 'checkpoint.tmp')
+        manager.save()
+        with pytest.raises(RuntimeError):
+            manager.flush()
@@ -0,0 +1,114 @@
+from abc import ABC, abstractmethod
+
+import numpy as np
+
+
+class Encoding(ABC):
+    """
+    How the values of a ReplayField are stored. encode and decode work on whole batches of values, with a leading
+    batch dimension.
+    """
+
+    @abstractmethod
+    def stored_shape(self, shape, dtype):
+        raise NotImplementedError
+
+    @abstractmethod
+    def stored_dtype(self, shape, dtype):
+        raise NotImplementedError
+
+    @abstractmethod
+    def encode(self, values, shape, dtype):
+        raise NotImplementedError
+
+    @abstractmethod
+    def decode(self, stored, shape, dtype):
+        raise NotImplementedError
+
+
+class PackedBits(Encoding):
+    """
+    Stores binary values (e.g. 0/1 Pong frames) as 8 values per byte, anything nonzero is stored as 1.
+    """
+
+    def stored_shape(self, shape, dtype):
+        return -(-int(np.prod(shape)) // 8),
+
+    def stored_dtype(self, shape, dtype):
+        return np.uint8
+
+    def encode(self, values, shape, dtype):
+        values = np.asarray(values)
+        return np.packbits(values.reshape(len(values), -1) != 0, axis=1)
+
+    def decode(self, stored, shape, dtype):
+        stored = np.asarray(stored)
+        values = np.unpackbits(stored, axis=1, count=int(np.prod(shape)))
+        return values.reshape(len(stored), *shape).astype(dtype, copy=False)
+
+
+class Float16(Encoding):
+    """
+    Stores floating point values as float16, which keeps about 3 significant digits within +-65504.
+    """
+
+    def stored_shape(self, shape, dtype):
+        return shape
+
+    def stored_dtype(self, shape, dtype):
+        return np.float16
+
+    def encode(self, values, shape, dtype):
+        return np.asarray(values, dtype=np.float16)
+
+    def decode(self, stored, shape, dtype):
+        return np.asarray(stored).astype(dtype)
+
+
+class BFloat16(Encoding):
+    """
+    Stores floating point values as the upper 16 bits of their float32 representation, rounded to nearest even,
+    which keeps the float32 range with about 2 significant digits.
+    """
+
+    def stored_shape(self, shape, dtype):
+        return shape
+
+    def stored_dtype(self, shape, dtype):
+        return np.uint16
+
+    def encode(self, values, shape, dtype):
+        bits = np.asarray(values, dtype=np.float32).view(np.uint32)
+        rounding = ((bits >> 16) & 1) + np.uint32(0x7FFF)
+        return ((bits + rounding) >> 16).astype(np.uint16)
+
+    def decode(self, stored, shape, dtype):
+        return (np.asarray(stored).astype(np.uint32) << 16).view(np.float32).astype(dtype, copy=False)
+
+
+class Quantized(Encoding):
+    """
+    Stores values within [low, high], e.g. the bounds of a Box observation space, as evenly spaced unsigned integers.
+    Values outside the bounds are clipped. low and high broadcast against the shape of a value.
+    """
+
+    def __init__(self, low, high, dtype=np.uint8):
+        self.low = np.asarray(low, dtype=np.float64)
+        self.high = np.asarray(high, dtype=np.float64)
+        if not (np.all(np.isfinite(self.low)) and np.all(np.isfinite(self.high)) and np.all(self.low < self.high)):
+            raise ValueError('Quantized needs finite bounds with low < high')
+        self.dtype = dtype
+        self.scale = (self.high - self.low) / np.iinfo(dtype).max
+
+    def stored_shape(self, shape, dtype):
+        return shape
+
+    def stored_dtype(self, shape, dtype):
+        return self.dtype
+
+    def encode(self, values, shape, dtype):
+        values = np.clip(np.asarray(values, dtype=np.float64), self.low, self.high)
+        return np.round((values - self.low) / self.scale).astype(self.dtype)
+
+    def decode(self, stored, shape, dtype):
+        return (np.asarray(stored) * self.scale + self.low).astype(dtype)
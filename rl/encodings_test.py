@@ -0,0 +1,61 @@
+import numpy as np
+import pytest
+
+from rl.encodings import PackedBits, Float16, BFloat16, Quantized
+
+
+class TestPackedBits:
+
+    def test_values_round_trip(self):
+        encoding = PackedBits()
+        for shape in [(), (3,), (80, 80), (5, 7, 3)]:
+            values = np.random.default_rng(0).integers(0, 2, size=(6, *shape)).astype(np.int8)
+            stored = encoding.encode(values, shape, np.int8)
+            assert stored.dtype == np.uint8
+            assert stored.shape == (6, *encoding.stored_shape(shape, np.int8))
+            decoded = encoding.decode(stored, shape, np.int8)
+            assert decoded.dtype == np.int8
+            assert np.array_equal(decoded, values)
+
+    def test_frames_take_one_bit_per_pixel(self):
+        assert PackedBits().stored_shape((80, 80), np.int8) == (800,)
+
+
+class TestReducedPrecision:
+
+    @pytest.fixture
+    def values(self):
+        return np.random.default_rng(0).normal(scale=10.0, size=(100, 3)).astype(np.float32)
+
+    def test_float16(self, values):
+        encoding = Float16()
+        stored = encoding.encode(values, (3,), np.float32)
+        assert stored.dtype == np.float16
+        decoded = encoding.decode(stored, (3,), np.float32)
+        assert decoded.dtype == np.float32
+        assert np.allclose(decoded, values, rtol=1e-3)
+
+    def test_bfloat16(self, values):
+        encoding = BFloat16()
+        stored = encoding.encode(values, (3,), np.float32)
+        assert stored.dtype == np.uint16
+        decoded = encoding.decode(stored, (3,), np.float32)
+        assert np.allclose(decoded, values, rtol=2 ** -8)
+        # Values are rounded to the nearest value with a 7 bit mantissa
+        rounded = encoding.decode(encoding.encode([1.5, 1 + 2 ** -9, 1 + 3 * 2 ** -9], (), np.float32), (), np.float32)
+        assert np.array_equal(rounded, [1.5, 1.0, 1 + 2 ** -7])
+
+    def test_quantized(self):
+        low, high = np.array([-1.0, -1.0, -8.0]), np.array([1.0, 1.0, 8.0])
+        encoding = Quantized(low, high)
+        values = np.random.default_rng(0).uniform(low, high, size=(100, 3))
+        stored = encoding.encode(values, (3,), np.float32)
+        assert stored.dtype == np.uint8
+        decoded = encoding.decode(stored, (3,), np.float32)
+        assert np.all(np.abs(decoded - values) <= (high - low) / 255 / 2 + 1e-6)
+        assert np.array_equal(encoding.decode(encoding.encode([low - 1, high + 1], (3,), np.float32), (3,), np.float64),
+                              [low, high])
+
+    def test_quantized_needs_finite_bounds(self):
+        with pytest.raises(ValueError): Quantized(-np.inf, 1.0)
+        with pytest.raises(ValueError): Quantized(1.0, 1.0)
@@ -0,0 +1,201 @@
+import multiprocessing
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+
+
+class SyncVectorEnv:
+    """
+    Steps copies of an environment one after the other in this process, with batched observations, actions, rewards
+    and dones. step returns the true next observations, an environment whose episode is done is then reset at once,
+    so observations holds the observations the next actions are taken from. step_async steps the environments at
+    indices in a worker thread, e.g. while the policy runs on the observations of the others.
+    """
+
+    def __init__(self, env_fns):
+        self.envs = [env_fn() for env_fn in env_fns]
+        self.num_envs = len(self.envs)
+        self.observation_space = self.envs[0].observation_space
+        self.action_space = self.envs[0].action_space
+        self.observations = None
+        self._executor = None
+        self._futures = {}
+
+    def reset(self):
+        self.observations = np.stack([env.reset() for env in self.envs])
+        return self.observations
+
+    def reset_at(self, indices):
+        """
+        Resets the environments at indices, e.g. those whose episodes were truncated.
+        """
+        for i in indices:
+            self.observations[i] = self.envs[i].reset()
+
+    def step(self, actions):
+        return self._step(actions, range(self.num_envs))
+
+    def step_async(self, actions, indices=None):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=1)
+        indices = _indices(self, indices)
+        self._futures[tuple(indices)] = self._executor.submit(self._step, actions, indices)
+
+    def step_wait(self, indices=None):
+        return self._futures.pop(tuple(_indices(self, indices))).result()
+
+    def _step(self, actions, indices):
+        results = [self.envs[i].step(action) for i, action in zip(indices, actions)]
+        observations_next = np.stack([r[0] for r in results])
+        rewards = np.array([r[1] for r in results], dtype=np.float32)
+        dones = np.array([r[2] for r in results], dtype=np.bool_)
+        infos = [r[3] for r in results]
+        # Rows are written in place, the environments of other indices may be stepped or reset meanwhile
+        for i, observation_next, done in zip(indices, observations_next, dones):
+            self.observations[i] = self.envs[i].reset() if done else observation_next
+        return observations_next, rewards, dones, infos
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+        for env in self.envs:
+            env.close()
+
+
+class SubprocVectorEnv:
+    """
+    Runs every environment in a worker process, with the interface of SyncVectorEnv. The workers write their
+    observations straight into shared memory: observations and the next observations returned by step are views of
+    it, which the next step overwrites, so copy what has to be kept. step_async sends the actions to the workers at
+    indices, all of them by default, before step_wait waits for any of them. env_fns are sent to the workers, under
+    the spawn start method they must be picklable, e.g. functools.partial(gym.make, 'Pong-v0') rather than lambdas.
+    """
+
+    def __init__(self, env_fns, mp_context=None):
+        context = multiprocessing.get_context(mp_context)
+        # Workers share the resource tracker of this process only if it runs before they start, one of their own would
+        # unlink the observation blocks when they exit
+        resource_tracker.ensure_running()
+        self.num_envs = len(env_fns)
+        self.pipes, self.workers = [], []
+        for index, env_fn in enumerate(env_fns):
+            pipe, worker_pipe = context.Pipe()
+            worker = context.Process(target=_worker, args=(env_fn, index, worker_pipe), daemon=True)
+            worker.start()
+            worker_pipe.close()
+            self.pipes.append(pipe)
+            self.workers.append(worker)
+        self.observation_space, self.action_space = self._receive(self.pipes[0])
+        for pipe in self.pipes[1:]:
+            self._receive(pipe)
+        shape = (self.num_envs, *self.observation_space.shape)
+        size = max(int(np.prod(shape)) * np.dtype(self.observation_space.dtype).itemsize, 1)
+        self._blocks = [SharedMemory(create=True, size=size) for _ in range(2)]
+        for pipe in self.pipes:
+            pipe.send(('attach', ([block.name for block in self._blocks], shape, self.observation_space.dtype)))
+        for pipe in self.pipes:
+            self._receive(pipe)
+        self.observations, self._observations_next = \
+            [np.ndarray(shape, dtype=self.observation_space.dtype, buffer=block.buf) for block in self._blocks]
+        self.closed = False
+
+    def reset(self):
+        for pipe in self.pipes:
+            pipe.send(('reset', None))
+        for pipe in self.pipes:
+            self._receive(pipe)
+        return self.observations
+
+    def reset_at(self, indices):
+        for i in indices:
+            self.pipes[i].send(('reset', None))
+        for i in indices:
+            self._receive(self.pipes[i])
+
+    def step_async(self, actions, indices=None):
+        for i, action in zip(_indices(self, indices), actions):
+            self.pipes[i].send(('step', action))
+
+    def step_wait(self, indices=None):
+        results = [self._receive(self.pipes[i]) for i in _indices(self, indices)]
+        rewards = np.array([r[0] for r in results], dtype=np.float32)
+        dones = np.array([r[1] for r in results], dtype=np.bool_)
+        infos = [r[2] for r in results]
+        observations_next = self._observations_next if indices is None else self._observations_next[indices]
+        return observations_next, rewards, dones, infos
+
+    def step(self, actions):
+        self.step_async(actions)
+        return self.step_wait()
+
+    def close(self):
+        if self.closed:
+            return
+        # Workers that failed exit on their own, their pipes are broken
+        for pipe in self.pipes:
+            try:
+                pipe.send(('close', None))
+            except OSError:
+                pass
+        for pipe, worker in zip(self.pipes, self.workers):
+            try:
+                pipe.recv()
+            except (EOFError, OSError):
+                pass
+            worker.join()
+            pipe.close()
+        # The arrays must be released before their blocks are closed
+        self.observations, self._observations_next = None, None
+        for block in self._blocks:
+            block.close()
+            block.unlink()
+        self.closed = True
+
+    @staticmethod
+    def _receive(pipe):
+        status, payload = pipe.recv()
+        if status == 'error':
+            raise RuntimeError(f'An environment worker failed:\n{payload}')
+        return payload
+
+
+def _indices(vector_env, indices):
+    return range(vector_env.num_envs) if indices is None else indices
+
+
+def _worker(env_fn, index, pipe):
+    try:
+        env = env_fn()
+        pipe.send(('ok', (env.observation_space, env.action_space)))
+        blocks, observations, observations_next = [], None, None
+        while True:
+            command, data = pipe.recv()
+            if command == 'attach':
+                names, shape, dtype = data
+                blocks = [SharedMemory(name=name) for name in names]
+                observations, observations_next = [np.ndarray(shape, dtype=dtype, buffer=b.buf) for b in blocks]
+                pipe.send(('ok', None))
+            elif command == 'step':
+                observation_next, reward, done, info = env.step(data)
+                observations_next[index] = observation_next
+                # Done environments are reset at once, their next actions are taken from the first observation
+                observations[index] = env.reset() if done else observation_next
+                pipe.send(('ok', (reward, done, info)))
+            elif command == 'reset':
+                observations[index] = env.reset()
+                pipe.send(('ok', None))
+            elif command == 'close':
+                env.close()
+                observations = observations_next = None
+                for block in blocks:
+                    block.close()
+                pipe.send(('ok', None))
+                break
+    except EOFError:
+        # The main process is gone
+        pass
+    except Exception:
+        pipe.send(('error', traceback.format_exc()))
@@ -0,0 +1,91 @@
+from functools import partial
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from rl.environments.vector_env import SyncVectorEnv, SubprocVectorEnv
+
+
+class CountingEnv:
+    """
+    Observations count the steps of the episode, episodes of env_id + 2 steps.
+    """
+
+    def __init__(self, env_id):
+        self.env_id = env_id
+        self.observation_space = SimpleNamespace(shape=(2,), dtype=np.int64)
+        self.action_space = None
+        self.t = 0
+
+    def reset(self):
+        self.t = 0
+        return np.array([self.env_id, self.t])
+
+    def step(self, action):
+        if action < 0:
+            raise ValueError('Negative action')
+        self.t += 1
+        return np.array([self.env_id, self.t]), float(action), self.t == self.env_id + 2, {'t': self.t}
+
+    def close(self):
+        pass
+
+
+class TestVectorEnvs:
+
+    @pytest.fixture(params=['sync', 'subproc'])
+    def env(self, request):
+        env_fns = [partial(CountingEnv, i) for i in range(3)]
+        env = SyncVectorEnv(env_fns) if request.param == 'sync' else SubprocVectorEnv(env_fns, mp_context='spawn')
+        env.reset()
+        yield env
+        env.close()
+
+    def test_steps_are_batched(self, env):
+        observations_next, rewards, dones, infos = env.step(np.array([1, 2, 3]))
+        assert np.array_equal(observations_next, [[0, 1], [1, 1], [2, 1]])
+        assert np.array_equal(rewards, [1, 2, 3])
+        assert not np.any(dones) and len(infos) == 3
+
+    def test_done_envs_are_reset(self, env):
+        env.step(np.zeros(3))
+        observations_next, _, dones, _ = env.step(np.zeros(3))
+        assert np.array_equal(dones, [True, False, False])
+        # The true next observation is returned, the next actions are taken from the first one of a new episode
+        assert np.array_equal(observations_next[0], [0, 2])
+        assert np.array_equal(env.observations, [[0, 0], [1, 2], [2, 2]])
+
+    def test_reset_at(self, env):
+        env.step(np.zeros(3))
+        env.reset_at([2])
+        assert np.array_equal(env.observations, [[0, 1], [1, 1], [2, 0]])
+
+
+class TestSubprocVectorEnv:
+
+    @pytest.fixture
+    def env(self):
+        env = SubprocVectorEnv([partial(CountingEnv, i) for i in range(2)], mp_context='spawn')
+        env.reset()
+        yield env
+        env.close()
+
+    def test_observations_are_shared_memory_views(self, env):
+        observations_next, _, _, _ = env.step(np.zeros(2))
+        assert not observations_next.flags.owndata and not env.observations.flags.owndata
+        kept = np.array(observations_next)
+        env.step(np.zeros(2))
+        # Views are overwritten by the next step
+        assert not np.array_equal(observations_next, kept)
+
+    def test_steps_are_pipelined(self, env):
+        env.step_async(np.ones(2))
+        _, rewards, _, infos = env.step_wait()
+        assert np.array_equal(rewards, [1, 1]) and [info['t'] for info in infos] == [1, 1]
+
+    def test_worker_errors_are_raised(self, env):
+        with pytest.raises(RuntimeError, match='Negative action'):
+            env.step(np.array([0, -1]))
+        env.close()
+        assert env.closed and not any(worker.is_alive() for worker in env.workers)
@@ -1,10 +1,26 @@
+import copy
+import multiprocessing
+import os
+import queue
+import threading
+import time
+import traceback
+from contextlib import nullcontext
+from functools import partial
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
 import tensorflow as tf
 from tqdm import tqdm
 
+from rl.checkpoint import AsyncCheckpointManager
+from rl.replay_buffer import SharedMemoryReplayBuffer
+
 
 class EpisodeTrainLoop:
     def __init__(self, agent, n_episodes, max_episode_length, ckpt_dir, log_dir,
-                 ckpt_every, log_every, update_every, metrics):
+                 ckpt_every, log_every, update_every, metrics, ckpt_replay_buffer=False,
+                 async_ckpt=False, ckpt_every_seconds=None):
         self.agent = agent
         self.n_episodes = n_episodes
         self.max_episode_length = max_episode_length
@@ -14,19 +30,24 @@ class EpisodeTrainLoop:
         self.log_every = log_every
         self.update_every = update_every
         self.metrics = metrics
+        self.ckpt_replay_buffer = ckpt_replay_buffer
+        self.ckpt_every_seconds = ckpt_every_seconds
 
         self.episodes_done = tf.Variable(0, dtype=tf.int64, trainable=False)
         self.ckpt = tf.train.Checkpoint(episodes_done=self.episodes_done, **agent.variables_to_checkpoint())
-        self.ckpt_manager = tf.train.CheckpointManager(
-            self.ckpt, self.ckpt_dir, max_to_keep=1, keep_checkpoint_every_n_hours=1)
+        self.ckpt_manager = _checkpoint_manager(self.ckpt, self.ckpt_dir, async_ckpt)
         self.ckpt.restore(self.ckpt_manager.latest_checkpoint).expect_partial()
+        _restore_replay_buffer(self)
 
     def run(self):
         summary_writer = tf.summary.create_file_writer(self.log_dir)
+        self.last_ckpt_time = time.monotonic()
         with tqdm(total=self.n_episodes, desc='Running train loop', unit='episode') as pbar:
-            pbar.update(self.ckpt.episodes_done.numpy())
+            # Counted in Python, episodes_done is only assigned for checkpoints
+            episodes_done = int(self.ckpt.episodes_done.numpy())
+            pbar.update(episodes_done)
             self.agent.env.reset()
-            while self.ckpt.episodes_done.numpy() < self.n_episodes:
+            while episodes_done < self.n_episodes:
                 transition, losses = None, None
                 for step in range(self.max_episode_length):
                     transition = self.agent.step(transition, training=True)
@@ -34,11 +55,12 @@ class EpisodeTrainLoop:
                         m.record(transition)
                     if transition['done']:
                         break
-                i = self.ckpt.episodes_done.numpy()
+                i = episodes_done
                 if i % self.update_every == 0 or i == self.n_episodes:
                     losses = self.agent.update()
-                if i % self.ckpt_every == 0 or i == self.n_episodes:
-                    self.ckpt_manager.save()
+                if _ckpt_due(self, i, i + 1) or i == self.n_episodes:
+                    self.ckpt.episodes_done.assign(i)
+                    _save_checkpoint(self)
                 if i % self.log_every == 0 or i == self.n_episodes:
                     if losses:
                         with summary_writer.as_default(), tf.name_scope('losses'):
@@ -47,14 +69,17 @@ class EpisodeTrainLoop:
                     with summary_writer.as_default(), tf.name_scope('metrics'):
                         for m in self.metrics:
                             tf.summary.scalar(m.name, m.compute(), step=i)
-                self.ckpt.episodes_done.assign_add(1)
+                episodes_done += 1
                 pbar.update(1)
+            self.ckpt.episodes_done.assign(episodes_done)
+            _flush_checkpoints(self)
             self.agent.env.close()
 
 
 class StepTrainLoop:
     def __init__(self, agent, n_steps, max_episode_length, initial_random_steps, ckpt_dir, log_dir,
-                 ckpt_every, log_every, update_every, metrics):
+                 ckpt_every, log_every, update_every, metrics, ckpt_replay_buffer=False,
+                 async_ckpt=False, ckpt_every_seconds=None):
         self.agent = agent
         self.n_steps = n_steps
         self.max_episode_length = max_episode_length
@@ -65,30 +90,36 @@ class StepTrainLoop:
         self.log_every = log_every
         self.update_every = update_every
         self.metrics = metrics
+        self.ckpt_replay_buffer = ckpt_replay_buffer
+        self.ckpt_every_seconds = ckpt_every_seconds
 
         self.steps_done = tf.Variable(0, dtype=tf.int64, trainable=False)
         self.ckpt = tf.train.Checkpoint(steps_done=self.steps_done, **agent.variables_to_checkpoint())
-        self.ckpt_manager = tf.train.CheckpointManager(
-            self.ckpt, self.ckpt_dir, max_to_keep=1, keep_checkpoint_every_n_hours=1)
+        self.ckpt_manager = _checkpoint_manager(self.ckpt, self.ckpt_dir, async_ckpt)
         self.ckpt.restore(self.ckpt_manager.latest_checkpoint).expect_partial()
+        _restore_replay_buffer(self)
 
     def run(self):
         summary_writer = tf.summary.create_file_writer(self.log_dir)
+        self.last_ckpt_time = time.monotonic()
         with tqdm(total=self.n_steps, desc='Running train loop', unit='step') as pbar:
-            pbar.update(self.ckpt.steps_done.numpy())
+            # Counted in Python, steps_done is only assigned for checkpoints
+            steps_done = int(self.ckpt.steps_done.numpy())
+            pbar.update(steps_done)
             self.agent.env.reset()
-            while self.ckpt.steps_done.numpy() < self.n_steps:
+            while steps_done < self.n_steps:
                 transition, losses = None, None
                 for step in range(self.max_episode_length):
-                    i = self.ckpt.steps_done.numpy()
+                    i = steps_done
                     transition = self.agent.step(transition, training=True,
                                                  random_action=i < self.initial_random_steps)
                     for m in self.metrics:
                         m.record(transition)
                     if i % self.update_every == 0 or i == self.n_steps:
                         losses = self.agent.update()
-                    if i % self.ckpt_every == 0 or i == self.n_steps:
-                        self.ckpt_manager.save()
+                    if _ckpt_due(self, i, i + 1) or i == self.n_steps:
+                        self.ckpt.steps_done.assign(i)
+                        _save_checkpoint(self)
                     if i % self.log_every == 0 or i == self.n_steps:
                         if losses:
                             with summary_writer.as_default(), tf.name_scope('losses'):
@@ -99,6 +130,690 @@ class StepTrainLoop:
                                 tf.summary.scalar(m.name, m.compute(), step=i)
                     if transition['done'] or i == self.n_steps:
                         break
-                    self.ckpt.steps_done.assign_add(1)
+                    steps_done += 1
                     pbar.update(1)
+            self.ckpt.steps_done.assign(steps_done)
+            _flush_checkpoints(self)
             self.agent.env.close()
+
+
+class VectorEpisodeTrainLoop:
+    """
+    An EpisodeTrainLoop over the environments of a vector env, stepped in lockstep with agent.act_vector. The
+    transitions of every environment are stored at once when its episode ends, so that every episode is a contiguous
+    run of transitions in the replay buffer, and every episode that ends counts as one.
+    With pipelined, half of the environments step while the policy runs on the other half, see _PipelinedSteps.
+    """
+
+    def __init__(self, agent, vector_env, n_episodes, max_episode_length, ckpt_dir, log_dir,
+                 ckpt_every, log_every, update_every, metrics, ckpt_replay_buffer=False, pipelined=False,
+                 async_ckpt=False, ckpt_every_seconds=None):
+        self.agent = agent
+        self.vector_env = vector_env
+        self.n_episodes = n_episodes
+        self.max_episode_length = max_episode_length
+        self.ckpt_dir = ckpt_dir
+        self.log_dir = log_dir
+        self.ckpt_every = ckpt_every
+        self.log_every = log_every
+        self.update_every = update_every
+        self.metrics = metrics
+        self.ckpt_replay_buffer = ckpt_replay_buffer
+        self.ckpt_every_seconds = ckpt_every_seconds
+        self.pipelined = pipelined
+
+        self.episodes_done = tf.Variable(0, dtype=tf.int64, trainable=False)
+        self.ckpt = tf.train.Checkpoint(episodes_done=self.episodes_done, **agent.variables_to_checkpoint())
+        self.ckpt_manager = _checkpoint_manager(self.ckpt, self.ckpt_dir, async_ckpt)
+        self.ckpt.restore(self.ckpt_manager.latest_checkpoint).expect_partial()
+        _restore_replay_buffer(self)
+
+    def run(self):
+        summary_writer = tf.summary.create_file_writer(self.log_dir)
+        self.last_ckpt_time = time.monotonic()
+        with tqdm(total=self.n_episodes, desc='Running train loop', unit='episode') as pbar:
+            # Counted in Python, episodes_done is only assigned for checkpoints
+            episodes_done = int(self.ckpt.episodes_done.numpy())
+            pbar.update(episodes_done)
+            self.vector_env.reset()
+            episodes = _EpisodeStaging(self.vector_env.num_envs)
+            steps = _PipelinedSteps(self.agent, self.vector_env, self.max_episode_length) if self.pipelined else None
+            while episodes_done < self.n_episodes:
+                transitions = steps.step() if steps else _step_vector(self.agent, self.vector_env)
+                for m in self.metrics:
+                    m.record_transitions(transitions)
+                for env_index in _end_episodes(self, episodes, transitions, reset=steps is None):
+                    self.agent.replay_buffer.store_transitions(episodes.pop(env_index))
+                    losses = None
+                    i = episodes_done
+                    if i % self.update_every == 0 or i == self.n_episodes:
+                        losses = self.agent.update()
+                    if _ckpt_due(self, i, i + 1) or i == self.n_episodes:
+                        self.ckpt.episodes_done.assign(i)
+                        _save_checkpoint(self)
+                    if i % self.log_every == 0 or i == self.n_episodes:
+                        if losses:
+                            with summary_writer.as_default(), tf.name_scope('losses'):
+                                for k, v in losses.items():
+                                    tf.summary.scalar(k, v, step=i)
+                        with summary_writer.as_default(), tf.name_scope('metrics'):
+                            for m in self.metrics:
+                                tf.summary.scalar(m.name, m.compute(), step=i)
+                    episodes_done += 1
+                    pbar.update(1)
+                    if episodes_done >= self.n_episodes:
+                        break
+            self.ckpt.episodes_done.assign(episodes_done)
+            _flush_checkpoints(self)
+            self.vector_env.close()
+
+
+class VectorStepTrainLoop:
+    """
+    A StepTrainLoop over the environments of a vector env, stepped in lockstep with agent.act_vector, every tick
+    counts as num_envs steps. The transitions of every environment are stored at once when its episode ends, so that
+    every episode is a contiguous run of transitions in the replay buffer, updates wait for the first one.
+    With pipelined, half of the environments step while the policy runs on the other half, see _PipelinedSteps.
+    """
+
+    def __init__(self, agent, vector_env, n_steps, max_episode_length, initial_random_steps, ckpt_dir, log_dir,
+                 ckpt_every, log_every, update_every, metrics, ckpt_replay_buffer=False, pipelined=False,
+                 async_ckpt=False, ckpt_every_seconds=None):
+        self.agent = agent
+        self.vector_env = vector_env
+        self.n_steps = n_steps
+        self.max_episode_length = max_episode_length
+        self.initial_random_steps = initial_random_steps
+        self.ckpt_dir = ckpt_dir
+        self.log_dir = log_dir
+        self.ckpt_every = ckpt_every
+        self.log_every = log_every
+        self.update_every = update_every
+        self.metrics = metrics
+        self.ckpt_replay_buffer = ckpt_replay_buffer
+        self.ckpt_every_seconds = ckpt_every_seconds
+        self.pipelined = pipelined
+
+        self.steps_done = tf.Variable(0, dtype=tf.int64, trainable=False)
+        self.ckpt = tf.train.Checkpoint(steps_done=self.steps_done, **agent.variables_to_checkpoint())
+        self.ckpt_manager = _checkpoint_manager(self.ckpt, self.ckpt_dir, async_ckpt)
+        self.ckpt.restore(self.ckpt_manager.latest_checkpoint).expect_partial()
+        _restore_replay_buffer(self)
+
+    def run(self):
+        summary_writer = tf.summary.create_file_writer(self.log_dir)
+        self.last_ckpt_time = time.monotonic()
+        with tqdm(total=self.n_steps, desc='Running train loop', unit='step') as pbar:
+            # Counted in Python, steps_done is only assigned for checkpoints
+            steps_done = int(self.ckpt.steps_done.numpy())
+            pbar.update(steps_done)
+            self.vector_env.reset()
+            episodes = _EpisodeStaging(self.vector_env.num_envs)
+            steps = _PipelinedSteps(self.agent, self.vector_env, self.max_episode_length) if self.pipelined else None
+            losses = None
+            while steps_done < self.n_steps:
+                i = steps_done
+                random_action = i < self.initial_random_steps
+                transitions = steps.step(random_action) if steps else \
+                    _step_vector(self.agent, self.vector_env, random_action)
+                for m in self.metrics:
+                    m.record_transitions(transitions)
+                for env_index in _end_episodes(self, episodes, transitions, reset=steps is None):
+                    self.agent.replay_buffer.store_transitions(episodes.pop(env_index))
+                # The steps i:j are taken in this tick, the periodic work of every multiple among them is done now
+                j = min(i + self.vector_env.num_envs, self.n_steps)
+                if self.agent.replay_buffer.current_size > 0:
+                    for _ in range(_multiples(i, j, self.update_every)):
+                        losses = self.agent.update()
+                if _ckpt_due(self, i, j):
+                    self.ckpt.steps_done.assign(i)
+                    _save_checkpoint(self)
+                if _multiples(i, j, self.log_every):
+                    if losses:
+                        with summary_writer.as_default(), tf.name_scope('losses'):
+                            for k, v in losses.items():
+                                tf.summary.scalar(k, v, step=i)
+                    with summary_writer.as_default(), tf.name_scope('metrics'):
+                        for m in self.metrics:
+                            tf.summary.scalar(m.name, m.compute(), step=i)
+                steps_done = j
+                pbar.update(j - i)
+            self.ckpt.steps_done.assign(steps_done)
+            _flush_checkpoints(self)
+            self.vector_env.close()
+
+
+class AsyncStepTrainLoop:
+    """
+    A StepTrainLoop whose steps are taken by n_actors threads, each with its own environment from env_fn and its own
+    policy from policy_fn, while this thread updates the agent continuously: up to max_replay_ratio times as many
+    updates as StepTrainLoop runs, one every update_every steps. Actors wait while there are fewer than
+    min_replay_ratio times as many, e.g. 1.0 keeps the updates of StepTrainLoop when the learner is the bottleneck.
+    The policy weights are handed to the actors every weight_sync_every updates. Actors store every episode at once
+    when it ends, so that it is a contiguous run of transitions in the replay buffer, which must be thread_safe.
+    """
+
+    def __init__(self, agent, env_fn, policy_fn, n_actors, n_steps, max_episode_length, initial_random_steps,
+                 ckpt_dir, log_dir, ckpt_every, log_every, update_every, metrics, max_replay_ratio=1.0,
+                 min_replay_ratio=0.0, weight_sync_every=1, ckpt_replay_buffer=False, async_ckpt=False,
+                 ckpt_every_seconds=None):
+        if isinstance(getattr(agent.replay_buffer, 'lock', nullcontext()), nullcontext):
+            raise ValueError('AsyncStepTrainLoop needs a thread_safe replay buffer')
+        self.agent = agent
+        self.env_fn = env_fn
+        self.policy_fn = policy_fn
+        self.n_actors = n_actors
+        self.n_steps = n_steps
+        self.max_episode_length = max_episode_length
+        self.initial_random_steps = initial_random_steps
+        self.ckpt_dir = ckpt_dir
+        self.log_dir = log_dir
+        self.ckpt_every = ckpt_every
+        self.log_every = log_every
+        self.update_every = update_every
+        self.metrics = metrics
+        self.max_replay_ratio = max_replay_ratio
+        self.min_replay_ratio = min_replay_ratio
+        self.weight_sync_every = weight_sync_every
+        self.ckpt_replay_buffer = ckpt_replay_buffer
+        self.ckpt_every_seconds = ckpt_every_seconds
+
+        self.steps_done = tf.Variable(0, dtype=tf.int64, trainable=False)
+        self.ckpt = tf.train.Checkpoint(steps_done=self.steps_done, **agent.variables_to_checkpoint())
+        self.ckpt_manager = _checkpoint_manager(self.ckpt, self.ckpt_dir, async_ckpt)
+        self.ckpt.restore(self.ckpt_manager.latest_checkpoint).expect_partial()
+        _restore_replay_buffer(self)
+
+        self.steps = 0
+        self.start_steps = 0
+        self.updates = 0
+        self.weights = None
+        self._steps_lock = threading.Lock()
+        self._metrics_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._errors = []
+
+    def run(self):
+        summary_writer = tf.summary.create_file_writer(self.log_dir)
+        self.last_ckpt_time = time.monotonic()
+        self.start_steps = i = int(self.ckpt.steps_done.numpy())
+        actors = self._start_actors()
+        losses = None
+        with tqdm(total=self.n_steps, desc='Running train loop', unit='step') as pbar:
+            pbar.update(i)
+            try:
+                while any(actor.is_alive() for actor in actors):
+                    self._poll()
+                    j = self.steps
+                    if self.agent.replay_buffer.current_size > 0 and \
+                            _replay_ratio(self.updates, j, self.start_steps, self.update_every) < self.max_replay_ratio:
+                        losses = self.agent.update()
+                        self.updates += 1
+                        if self.updates % self.weight_sync_every == 0:
+                            self._publish_weights()
+                    else:
+                        time.sleep(1e-3)
+                    self._checkpoint_and_log(summary_writer, i, j, losses)
+                    pbar.update(j - i)
+                    i = j
+            finally:
+                self._stop_actors(actors)
+            self._poll()
+            j = self.steps
+            self._checkpoint_and_log(summary_writer, i, j, losses)
+            pbar.update(j - i)
+            # The last steps are checkpointed too, their episodes have all been stored by now
+            self.ckpt.steps_done.assign(j)
+            _save_checkpoint(self)
+            _flush_checkpoints(self)
+
+    def _start_actors(self):
+        self.steps = self.start_steps
+        # Actors load the weights whenever their version changes
+        self.weights = (self.updates, self.agent.policy.get_weights())
+        actors = [threading.Thread(target=self._act, daemon=True) for _ in range(self.n_actors)]
+        for actor in actors:
+            actor.start()
+        return actors
+
+    def _publish_weights(self):
+        self.weights = (self.updates, self.agent.policy.get_weights())
+
+    def _poll(self):
+        if self._errors:
+            raise RuntimeError('An actor failed') from self._errors[0]
+
+    def _stop_actors(self, actors):
+        self._stop.set()
+        for actor in actors:
+            actor.join()
+
+    def _checkpoint_and_log(self, summary_writer, i, j, losses):
+        # The periodic work of the multiples among the steps i:j taken since the last call
+        if _ckpt_due(self, i, j):
+            self.ckpt.steps_done.assign(j)
+            _save_checkpoint(self)
+        if _multiples(i, j, self.log_every):
+            if losses:
+                with summary_writer.as_default(), tf.name_scope('losses'):
+                    for k, v in losses.items():
+                        tf.summary.scalar(k, v, step=i)
+            with summary_writer.as_default(), tf.name_scope('metrics'), self._metrics_lock:
+                for m in self.metrics:
+                    tf.summary.scalar(m.name, m.compute(), step=i)
+
+    def _act(self):
+        try:
+            # A shallow copy of the agent steps with the environment and policy of this actor
+            actor = copy.copy(self.agent)
+            actor.env, actor.policy = self.env_fn(), self.policy_fn()
+            version, transition, episode = None, None, []
+            while not self._stop.is_set():
+                # Until the first episode is stored the learner cannot catch up
+                if _replay_ratio(self.updates, self.steps, self.start_steps, self.update_every) < \
+                        self.min_replay_ratio and self.agent.replay_buffer.current_size > 0:
+                    time.sleep(1e-3)
+                    continue
+                with self._steps_lock:
+                    i = self.steps
+                    if i >= self.n_steps:
+                        break
+                    self.steps += 1
+                if self.weights[0] != version:
+                    version, weights = self.weights
+                    actor.policy.set_weights(weights)
+                transition = actor.step(transition, random_action=i < self.initial_random_steps)
+                episode.append(transition)
+                if transition['done'] or len(episode) >= self.max_episode_length:
+                    self._store(episode)
+                    transition, episode = None, []
+            if episode:
+                self._store(episode)
+            actor.env.close()
+        except Exception as e:
+            self._errors.append(e)
+
+    def _store(self, episode):
+        self.agent.replay_buffer.store_transitions({k: np.stack([t[k] for t in episode]) for k in episode[0]})
+        self._record(episode)
+
+    def _record(self, episode):
+        with self._metrics_lock:
+            for t in episode:
+                for m in self.metrics:
+                    m.record(t)
+
+
+class DistributedStepTrainLoop(AsyncStepTrainLoop):
+    """
+    An AsyncStepTrainLoop whose actors are n_actors processes, in the style of Ape-X. Every actor builds its own
+    agent with agent_fn(env=env_fn(), replay_buffer_fn=...), whose steps are stored straight into the replay buffer
+    of the learner agent through agent.step(training=True). That buffer must be a SharedMemoryReplayBuffer of the
+    same mp_context. The learner publishes versioned policy weights into shared memory every weight_sync_every
+    updates, actors load them when the version changes. Actors send the reward and done of their transitions to
+    the metrics once their episodes end. Under the spawn start method, agent_fn and env_fn must be picklable, e.g.
+    functools.partial of module-level functions, and only the weights of agent.policy are shared: every actor
+    initializes its other networks, which it does not use.
+    """
+
+    def __init__(self, agent, agent_fn, env_fn, n_actors, n_steps, max_episode_length, initial_random_steps,
+                 ckpt_dir, log_dir, ckpt_every, log_every, update_every, metrics, max_replay_ratio=1.0,
+                 min_replay_ratio=0.0, weight_sync_every=1, ckpt_replay_buffer=False, async_ckpt=False,
+                 ckpt_every_seconds=None, mp_context='spawn'):
+        if not isinstance(agent.replay_buffer, SharedMemoryReplayBuffer):
+            raise ValueError('DistributedStepTrainLoop needs a SharedMemoryReplayBuffer')
+        context = multiprocessing.get_context(mp_context)
+        # The counters are shared with the actors, see the steps and updates properties
+        self._shared_steps = context.Value('q', 0)
+        self._shared_updates = context.Value('q', 0, lock=False)
+        super().__init__(agent, env_fn, None, n_actors, n_steps, max_episode_length, initial_random_steps,
+                         ckpt_dir, log_dir, ckpt_every, log_every, update_every, metrics, max_replay_ratio,
+                         min_replay_ratio, weight_sync_every, ckpt_replay_buffer, async_ckpt, ckpt_every_seconds)
+        self.agent_fn = agent_fn
+        self.mp_context = mp_context
+        self.shared_weights = None
+        self._messages = None
+
+    @property
+    def steps(self):
+        return self._shared_steps.value
+
+    @steps.setter
+    def steps(self, value):
+        self._shared_steps.value = value
+
+    @property
+    def updates(self):
+        return self._shared_updates.value
+
+    @updates.setter
+    def updates(self, value):
+        self._shared_updates.value = value
+
+    def _start_actors(self):
+        context = multiprocessing.get_context(self.mp_context)
+        self.steps = self.start_steps
+        self.shared_weights = SharedWeights(self.agent.policy.get_weights(), self.mp_context)
+        self._stop = context.Event()
+        self._messages = context.Queue()
+        actor = _ActorProcess(self.agent_fn, self.env_fn, self.agent.replay_buffer, self.shared_weights,
+                              self._shared_steps, self._shared_updates, self._stop, self._messages, self.n_steps,
+                              self.start_steps, self.max_episode_length, self.initial_random_steps,
+                              self.update_every, self.min_replay_ratio)
+        actors = [context.Process(target=actor.run, daemon=True) for _ in range(self.n_actors)]
+        for actor in actors:
+            actor.start()
+        return actors
+
+    def _publish_weights(self):
+        self.shared_weights.publish(self.agent.policy.get_weights(), self.updates)
+
+    def _poll(self):
+        self._receive()
+        super()._poll()
+
+    def _receive(self):
+        while True:
+            try:
+                kind, payload = self._messages.get_nowait()
+            except queue.Empty:
+                return
+            if kind == 'error':
+                self._errors.append(RuntimeError(f'The traceback of the actor:\n{payload}'))
+            else:
+                self._record(payload)
+
+    def _stop_actors(self, actors):
+        self._stop.set()
+        # Actors only exit once their messages are read
+        while any(actor.is_alive() for actor in actors):
+            self._receive()
+            time.sleep(1e-3)
+        for actor in actors:
+            actor.join()
+        self.shared_weights.close()
+
+
+class SharedWeights:
+    """
+    A list of weight arrays in a multiprocessing.shared_memory block, with the version they were published with.
+    Pickling only sends the name of the block and the lock, so mp_context must be the context of the processes it is
+    sent to. The process that creates it owns the block and unlinks it in close.
+    """
+
+    def __init__(self, weights, mp_context=None):
+        self.shapes = [w.shape for w in weights]
+        self.dtypes = [w.dtype for w in weights]
+        self.lock = multiprocessing.get_context(mp_context).Lock()
+        self._block = SharedMemory(create=True, size=8 + sum(w.nbytes for w in weights))
+        self._owner = True
+        self._attach()
+        self.publish(weights, 0)
+
+    def __getstate__(self):
+        return {'shapes': self.shapes, 'dtypes': self.dtypes, 'lock': self.lock, 'block': self._block.name}
+
+    def __setstate__(self, state):
+        self.shapes, self.dtypes, self.lock = state['shapes'], state['dtypes'], state['lock']
+        self._block = SharedMemory(name=state['block'])
+        self._owner = False
+        self._attach()
+
+    @property
+    def version(self):
+        return int(self._version[0])
+
+    def publish(self, weights, version):
+        with self.lock:
+            for array, w in zip(self._arrays, weights):
+                array[...] = w
+            self._version[0] = version
+
+    def read(self):
+        """
+        Returns the version and a copy of the weights.
+        """
+        with self.lock:
+            return int(self._version[0]), [np.array(array) for array in self._arrays]
+
+    def close(self):
+        # The arrays must be released before the block is closed
+        self._version, self._arrays = None, []
+        self._block.close()
+        if self._owner:
+            self._block.unlink()
+
+    def _attach(self):
+        self._version = np.ndarray((1,), dtype=np.int64, buffer=self._block.buf)
+        self._arrays, offset = [], 8
+        for shape, dtype in zip(self.shapes, self.dtypes):
+            array = np.ndarray(shape, dtype=dtype, buffer=self._block.buf, offset=offset)
+            self._arrays.append(array)
+            offset += array.nbytes
+
+
+class _ActorProcess:
+    """
+    The loop of an actor process of DistributedStepTrainLoop, sent to it with the shared state.
+    """
+
+    def __init__(self, agent_fn, env_fn, replay_buffer, weights, steps, updates, stop, messages, n_steps,
+                 start_steps, max_episode_length, initial_random_steps, update_every, min_replay_ratio):
+        self.agent_fn = agent_fn
+        self.env_fn = env_fn
+        self.replay_buffer = replay_buffer
+        self.weights = weights
+        self.steps = steps
+        self.updates = updates
+        self.stop = stop
+        self.messages = messages
+        self.n_steps = n_steps
+        self.start_steps = start_steps
+        self.max_episode_length = max_episode_length
+        self.initial_random_steps = initial_random_steps
+        self.update_every = update_every
+        self.min_replay_ratio = min_replay_ratio
+
+    def run(self):
+        try:
+            agent = self.agent_fn(env=self.env_fn(), replay_buffer_fn=partial(_attached, self.replay_buffer))
+            version, transition, episode = None, None, []
+            while not self.stop.is_set():
+                if _replay_ratio(self.updates.value, self.steps.value, self.start_steps, self.update_every) < \
+                        self.min_replay_ratio and self.replay_buffer.current_size > 0:
+                    time.sleep(1e-3)
+                    continue
+                with self.steps.get_lock():
+                    i = self.steps.value
+                    if i >= self.n_steps:
+                        break
+                    self.steps.value += 1
+                if self.weights.version != version:
+                    version, weights = self.weights.read()
+                    agent.policy.set_weights(weights)
+                transition = agent.step(transition, training=True, random_action=i < self.initial_random_steps)
+                # Only what the metrics need goes through the queue
+                episode.append({'reward': transition['reward'], 'done': transition['done']})
+                if transition['done'] or len(episode) >= self.max_episode_length:
+                    self.messages.put(('episode', episode))
+                    transition, episode = None, []
+            if episode:
+                self.messages.put(('episode', episode))
+            agent.env.close()
+        except Exception:
+            self.messages.put(('error', traceback.format_exc()))
+        finally:
+            self.replay_buffer.close()
+            self.weights.close()
+
+
+def _attached(replay_buffer, **kwargs):
+    # The replay_buffer_fn of the agents of actor processes, whose transitions go to the buffer of the learner
+    return replay_buffer
+
+
+def _replay_ratio(updates, steps, start_steps, update_every):
+    # The updates relative to those of StepTrainLoop over the steps taken by this run
+    return updates * update_every / max(steps - start_steps, 1)
+
+
+class _EpisodeStaging:
+    """
+    The transitions of the environments of a vector env since their episodes started, kept as the batched
+    transitions of every tick until the oldest episode ends.
+    """
+
+    def __init__(self, num_envs):
+        self.ticks = []
+        self.first_tick = 0
+        self.starts = np.zeros(num_envs, dtype=np.int64)
+
+    def add(self, transitions):
+        self.ticks.append(transitions)
+
+    def lengths(self):
+        return self.first_tick + len(self.ticks) - self.starts
+
+    def pop(self, env_index):
+        """
+        Returns the transitions of the episode of an environment, which starts a new one.
+        """
+        ticks = self.ticks[self.starts[env_index] - self.first_tick:]
+        episode = {k: np.stack([t[k][env_index] for t in ticks]) for k in ticks[0]}
+        self.starts[env_index] = self.first_tick + len(self.ticks)
+        dropped = np.min(self.starts) - self.first_tick
+        del self.ticks[:dropped]
+        self.first_tick += dropped
+        return episode
+
+
+class _PipelinedSteps:
+    """
+    Steps the environments of a vector env in two groups, each group steps while the policy runs on the observations
+    of the other one, and the first group keeps stepping while the loop stores and updates. step returns the
+    transitions of every environment like _step_vector, but those of the first group are of actions taken in
+    the previous call, which can be a policy update behind. Episodes truncated at max_episode_length are reset here,
+    once their group is done stepping.
+    """
+
+    def __init__(self, agent, vector_env, max_episode_length):
+        if vector_env.num_envs < 2:
+            raise ValueError('Pipelined stepping needs at least two environments')
+        self.agent = agent
+        self.vector_env = vector_env
+        self.max_episode_length = max_episode_length
+        self.groups = np.array_split(np.arange(vector_env.num_envs), 2)
+        self.lengths = np.zeros(vector_env.num_envs, dtype=np.int64)
+        self.pending = None
+
+    def step(self, random_action=False):
+        first, second = self.groups
+        if self.pending is None:
+            self.pending = self._act(first, random_action)
+            self.vector_env.step_async(self.pending[1], first)
+        started = self._act(second, random_action)
+        results = self.vector_env.step_wait(first)
+        self.vector_env.step_async(started[1], second)
+        first_transitions = self._transitions(first, *self.pending, results)
+        self.pending = self._act(first, random_action)
+        results = self.vector_env.step_wait(second)
+        self.vector_env.step_async(self.pending[1], first)
+        second_transitions = self._transitions(second, *started, results)
+        return {k: np.concatenate([first_transitions[k], second_transitions[k]]) for k in first_transitions}
+
+    def _act(self, group, random_action):
+        observations = self.vector_env.observations[group]
+        return observations, _act_vector(self.agent, self.vector_env, observations, random_action)
+
+    def _transitions(self, group, observations, actions, results):
+        observations_next, rewards, dones, _ = results
+        transitions = _vector_transitions(self.agent, observations, actions, observations_next, rewards, dones)
+        self.lengths[group] += 1
+        ended = dones | (self.lengths[group] >= self.max_episode_length)
+        if np.any(ended & ~dones):
+            self.vector_env.reset_at(group[ended & ~dones])
+        self.lengths[group[ended]] = 0
+        return transitions
+
+
+def _step_vector(agent, vector_env, random_action=False):
+    # Steps every environment of vector_env with one batched policy call, the transitions have a leading environment
+    # dimension
+    observations = np.array(vector_env.observations)
+    actions = _act_vector(agent, vector_env, observations, random_action)
+    return _vector_transitions(agent, observations, actions, *vector_env.step(actions)[:3])
+
+
+def _act_vector(agent, vector_env, observations, random_action):
+    if random_action:
+        return np.stack([vector_env.action_space.sample() for _ in range(len(observations))])
+    return agent.act_vector(observations)
+
+
+def _vector_transitions(agent, observations, actions, observations_next, rewards, dones):
+    observations_next = np.array(observations_next)
+    transitions = {'observation': observations, 'observation_next': observations_next, 'action': actions,
+                   'reward': rewards, 'done': dones}
+    # Agents that store values, e.g. PPOClip and VPGGAE, compute those of both observations in one batched call
+    values_vector = getattr(agent, 'values_vector', None)
+    if values_vector is not None:
+        values = values_vector(np.concatenate([observations, observations_next]))
+        transitions['value'], transitions['value_next'] = values[:len(observations)], values[len(observations):]
+    return transitions
+
+
+def _end_episodes(loop, episodes, transitions, reset=True):
+    # Episodes end with a done or at max_episode_length, the truncated ones are reset here unless _PipelinedSteps
+    # already did
+    episodes.add(transitions)
+    ended = transitions['done'] | (episodes.lengths() >= loop.max_episode_length)
+    truncated = np.flatnonzero(ended & ~transitions['done'])
+    if reset and len(truncated) > 0:
+        loop.vector_env.reset_at(truncated)
+    return np.flatnonzero(ended)
+
+
+def _checkpoint_manager(ckpt, ckpt_dir, async_ckpt):
+    if async_ckpt:
+        return AsyncCheckpointManager(ckpt, ckpt_dir, max_to_keep=1)
+    return tf.train.CheckpointManager(ckpt, ckpt_dir, max_to_keep=1, keep_checkpoint_every_n_hours=1)
+
+
+def _ckpt_due(loop, start, stop):
+    # At the multiples of ckpt_every within start:stop, or every ckpt_every_seconds of wall-clock time instead
+    if loop.ckpt_every_seconds is None:
+        return _multiples(start, stop, loop.ckpt_every) > 0
+    return time.monotonic() - loop.last_ckpt_time >= loop.ckpt_every_seconds
+
+
+def _save_checkpoint(loop):
+    loop.ckpt_manager.save()
+    _save_replay_buffer(loop)
+    loop.last_ckpt_time = time.monotonic()
+
+
+def _flush_checkpoints(loop):
+    # Waits until the checkpoints of async_ckpt are all on disk
+    if isinstance(loop.ckpt_manager, AsyncCheckpointManager):
+        loop.ckpt_manager.flush()
+
+
+def _multiples(start, stop, every):
+    # How many multiples of every are within start:stop
+    return (stop - 1) // every - (start - 1) // every
+
+
+def _replay_buffer_dir(loop):
+    return os.path.join(loop.ckpt_dir, 'replay_buffer')
+
+
+def _save_replay_buffer(loop):
+    # Saved right after the checkpoint, so that a resumed run continues with the transitions collected until then
+    if loop.ckpt_replay_buffer:
+        loop.agent.replay_buffer.save(_replay_buffer_dir(loop))
+
+
+def _restore_replay_buffer(loop):
+    if loop.ckpt_replay_buffer and loop.ckpt_manager.latest_checkpoint and \
+            os.path.exists(os.path.join(_replay_buffer_dir(loop), 'meta.json')):
+        loop.agent.replay_buffer.restore(_replay_buffer_dir(loop))
@@ -0,0 +1,310 @@
+import itertools
+import time
+from functools import partial
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from rl.checkpoint import AsyncCheckpointManager
+from rl.environments.vector_env import SyncVectorEnv
+from rl.loops import EpisodeTrainLoop, StepTrainLoop, AsyncStepTrainLoop, DistributedStepTrainLoop, SharedWeights, \
+    _EpisodeStaging, _PipelinedSteps, _end_episodes, _multiples, _step_vector
+from rl.metrics import AverageEpisodeLength
+from rl.replay_buffer import UniformReplayBuffer, SharedMemoryReplayBuffer, ReplayField
+
+
+class CountingEnv:
+    """
+    Observations count the steps of the episode, episodes of env_id + 2 steps.
+    """
+
+    def __init__(self, env_id):
+        self.env_id = env_id
+        self.observation_space = SimpleNamespace(shape=(2,), dtype=np.int64)
+        self.action_space = None
+        self.t = 0
+
+    def reset(self):
+        self.t = 0
+        return np.array([self.env_id, self.t])
+
+    def step(self, action):
+        self.t += 1
+        return np.array([self.env_id, self.t]), float(action), self.t == self.env_id + 2, {}
+
+    def close(self):
+        pass
+
+
+class EchoAgent:
+    """
+    Takes the step count of the observation as its action.
+    """
+
+    def act_vector(self, observations):
+        return observations[:, 1]
+
+
+class VersionPolicy:
+    """
+    Its single weight counts the updates, actions are the version of the weights they were taken with.
+    """
+
+    def __init__(self):
+        self.weights = [np.zeros(1)]
+
+    def get_weights(self):
+        return [w.copy() for w in self.weights]
+
+    def set_weights(self, weights):
+        self.weights = weights
+
+
+class VersionAgent:
+
+    def __init__(self, env=None, replay_buffer_fn=partial(UniformReplayBuffer, thread_safe=True)):
+        self.env = env
+        self.policy = VersionPolicy()
+        self.replay_buffer = replay_buffer_fn(
+            buffer_size=10_000,
+            store_fields=[ReplayField('observation', shape=(2,), dtype=np.int64), ReplayField('action'),
+                          ReplayField('reward'), ReplayField('done', dtype=bool)],
+            compute_fields=[],
+        )
+
+    def variables_to_checkpoint(self):
+        return {}
+
+    def step(self, previous_transition=None, training=False, random_action=False):
+        observation = previous_transition['observation_next'] if previous_transition else self.env.reset()
+        # Slow enough for the learner to update while the actors step
+        time.sleep(1e-4)
+        action = self.policy.weights[0][0]
+        observation_next, reward, done, _ = self.env.step(action)
+        transition = {'observation': observation, 'observation_next': observation_next, 'action': action,
+                      'reward': reward, 'done': done}
+        if training:
+            self.replay_buffer.store_transition(transition)
+        return transition
+
+    def update(self):
+        self.policy.weights[0] += 1
+        return {'loss': 0.0}
+
+
+class TestCounters:
+
+    def test_step_train_loop(self, tmp_path):
+        def loop():
+            return StepTrainLoop(VersionAgent(env=CountingEnv(2)), n_steps=50, max_episode_length=10,
+                                 initial_random_steps=0, ckpt_dir=str(tmp_path / 'ckpt'), log_dir=str(tmp_path / 'log'),
+                                 ckpt_every=20, log_every=10, update_every=5, metrics=[])
+
+        first = loop()
+        first.run()
+        assert int(first.steps_done.numpy()) == 50
+        assert first.agent.policy.weights[0][0] > 0
+        # The last checkpoint was saved at step 50, a resumed loop has nothing left to do
+        resumed = loop()
+        assert int(resumed.steps_done.numpy()) == 50
+        resumed.run()
+        assert resumed.agent.policy.weights[0][0] == 0
+
+    def test_episode_train_loop(self, tmp_path):
+        loop = EpisodeTrainLoop(VersionAgent(env=CountingEnv(2)), n_episodes=12, max_episode_length=10,
+                                ckpt_dir=str(tmp_path / 'ckpt'), log_dir=str(tmp_path / 'log'), ckpt_every=5,
+                                log_every=5, update_every=5, metrics=[AverageEpisodeLength()])
+        loop.run()
+        assert int(loop.episodes_done.numpy()) == 12
+        assert loop.agent.policy.weights[0][0] == 3
+        assert loop.metrics[0].compute() == 4
+
+
+class TestAsyncCheckpoints:
+
+    def loop(self, tmp_path, **kwargs):
+        return StepTrainLoop(VersionAgent(env=CountingEnv(2)), n_steps=50, max_episode_length=10,
+                             initial_random_steps=0, ckpt_dir=str(tmp_path / 'ckpt'), log_dir=str(tmp_path / 'log'),
+                             log_every=10, update_every=5, metrics=[], async_ckpt=True, **kwargs)
+
+    def test_resumes(self, tmp_path):
+        first = self.loop(tmp_path, ckpt_every=20)
+        first.run()
+        resumed = self.loop(tmp_path, ckpt_every=20)
+        assert int(resumed.steps_done.numpy()) == 50
+
+    def test_ckpt_every_seconds(self, tmp_path):
+        # Instead of every ckpt_every steps, the last step is checkpointed regardless
+        loop = self.loop(tmp_path / 'hourly', ckpt_every=20, ckpt_every_seconds=3600.0)
+        loop.run()
+        assert loop.ckpt_manager.number == 2
+        assert loop.ckpt_manager.latest_checkpoint == str(tmp_path / 'hourly' / 'ckpt' / 'ckpt-1')
+        loop = self.loop(tmp_path / 'always', ckpt_every=20, ckpt_every_seconds=0.0)
+        loop.run()
+        assert loop.ckpt_manager.number > 50
+
+    def test_flushes_only_at_exit(self, tmp_path, monkeypatch):
+        flushes = []
+        monkeypatch.setattr(AsyncCheckpointManager, 'flush', lambda manager: flushes.append(manager.number))
+        loop = TestAsyncStepTrainLoop.loop(VersionAgent(), tmp_path, async_ckpt=True, min_replay_ratio=1.0)
+        loop.run()
+        assert loop.ckpt_manager.number - 1 > 1
+        assert flushes == [loop.ckpt_manager.number]
+
+
+class TestEpisodeStaging:
+
+    def test_episodes_are_returned_contiguously(self):
+        staging = _EpisodeStaging(2)
+        for t in range(5):
+            staging.add({'observation': np.array([[0, t], [1, t]]), 'done': np.array([t == 2, t == 4])})
+        assert np.array_equal(staging.lengths(), [5, 5])
+        episode = staging.pop(0)
+        assert np.array_equal(episode['observation'], [[0, t] for t in range(5)])
+        # Ticks are kept until every episode that started in them has been returned
+        assert len(staging.ticks) == 5
+        staging.add({'observation': np.array([[0, 5], [1, 5]]), 'done': np.array([False, False])})
+        assert np.array_equal(staging.lengths(), [1, 6])
+        assert np.array_equal(staging.pop(1)['observation'], [[1, t] for t in range(6)])
+        assert len(staging.ticks) == 1 and staging.first_tick == 5
+        assert np.array_equal(staging.pop(0)['observation'], [[0, 5]])
+        assert len(staging.ticks) == 0
+
+
+def test_step_vector_adds_the_values_of_agents_with_values_vector():
+    class ValueAgent(EchoAgent):
+        def values_vector(self, observations):
+            return 10.0 * observations[:, 1]
+
+    vector_env = SyncVectorEnv([partial(CountingEnv, i) for i in range(3)])
+    vector_env.reset()
+    vector_env.step(np.zeros(3))
+    transitions = _step_vector(ValueAgent(), vector_env)
+    assert np.array_equal(transitions['action'], [1, 1, 1])
+    assert np.array_equal(transitions['value'], [10, 10, 10])
+    # The first environment's episode of 2 steps ended, its true next observation is kept
+    assert np.array_equal(transitions['value_next'], [20, 20, 20])
+    assert 'value' not in _step_vector(EchoAgent(), vector_env)
+    vector_env.close()
+
+
+def test_multiples():
+    # Like in StepTrainLoop, step 0 is a multiple
+    assert _multiples(0, 4, 2) == 2
+    assert _multiples(4, 8, 2) == 2
+    assert _multiples(5, 6, 2) == 0
+    assert _multiples(3, 11, 4) == 2
+
+
+class TestPipelinedSteps:
+
+    @staticmethod
+    def vector_env(num_envs):
+        vector_env = SyncVectorEnv([partial(CountingEnv, i) for i in range(num_envs)])
+        vector_env.reset()
+        return vector_env
+
+    def test_transitions_match_lockstep_stepping(self):
+        # Episodes of up to 6 steps, truncated at 4
+        loop = SimpleNamespace(vector_env=self.vector_env(5), max_episode_length=4)
+        episodes = _EpisodeStaging(5)
+        vector_env = self.vector_env(5)
+        steps = _PipelinedSteps(EchoAgent(), vector_env, max_episode_length=4)
+        for _ in range(12):
+            expected = _step_vector(EchoAgent(), loop.vector_env)
+            for env_index in _end_episodes(loop, episodes, expected):
+                episodes.pop(env_index)
+            transitions = steps.step()
+            for k in expected:
+                assert np.array_equal(transitions[k], expected[k])
+        # The first group keeps stepping between calls
+        assert len(vector_env._futures) == 1
+        vector_env.close()
+
+    def test_needs_two_environments(self):
+        with pytest.raises(ValueError):
+            _PipelinedSteps(EchoAgent(), self.vector_env(1), max_episode_length=4)
+
+
+class TestAsyncStepTrainLoop:
+
+    @staticmethod
+    def loop(agent, tmp_path, **kwargs):
+        # The environments of the actors have episodes of 2, 3 and 4 steps
+        env_ids = itertools.count()
+        return AsyncStepTrainLoop(
+            agent=agent, env_fn=lambda: CountingEnv(next(env_ids)), policy_fn=VersionPolicy, n_actors=3,
+            n_steps=1000, max_episode_length=10, initial_random_steps=0, ckpt_dir=str(tmp_path / 'ckpt'),
+            log_dir=str(tmp_path / 'log'), ckpt_every=300, log_every=100, update_every=10,
+            metrics=[AverageEpisodeLength()], **kwargs)
+
+    def test_episodes_are_stored_contiguously(self, tmp_path):
+        agent = VersionAgent()
+        loop = self.loop(agent, tmp_path, max_replay_ratio=2.0, min_replay_ratio=1.0, weight_sync_every=5)
+        loop.run()
+        assert loop.steps == 1000 and int(loop.steps_done.numpy()) == 1000
+        observations = agent.replay_buffer.buffers['observation'][:1000]
+        new_episode = observations[1:, 1] == 0
+        next_step = (observations[1:, 0] == observations[:-1, 0]) & (observations[1:, 1] == observations[:-1, 1] + 1)
+        assert np.all(new_episode | next_step)
+        # Actors wait for the learner below the min replay ratio, the last steps can be a few updates ahead
+        assert 1000 / 10 - 5 <= loop.updates <= 2.0 * 1000 / 10
+        # Actions are taken with weights synced every 5 updates
+        actions = agent.replay_buffer.buffers['action'][:1000]
+        assert np.max(actions) > 0 and np.all(actions % 5 == 0)
+
+    def test_needs_a_thread_safe_replay_buffer(self, tmp_path):
+        with pytest.raises(ValueError):
+            self.loop(VersionAgent(replay_buffer_fn=UniformReplayBuffer), tmp_path)
+
+    def test_actor_errors_are_raised(self, tmp_path):
+        loop = self.loop(VersionAgent(), tmp_path)
+        loop.env_fn = lambda: CountingEnv(None)
+        with pytest.raises(RuntimeError, match='An actor failed'):
+            loop.run()
+
+
+class TestDistributedStepTrainLoop:
+
+    @staticmethod
+    def loop(agent, tmp_path, **kwargs):
+        return DistributedStepTrainLoop(
+            agent=agent, agent_fn=VersionAgent, n_steps=300, max_episode_length=10, initial_random_steps=0,
+            ckpt_dir=str(tmp_path / 'ckpt'), log_dir=str(tmp_path / 'log'), ckpt_every=100, log_every=100,
+            update_every=10, metrics=[AverageEpisodeLength()], **kwargs)
+
+    @pytest.fixture
+    def agent(self):
+        agent = VersionAgent(replay_buffer_fn=partial(SharedMemoryReplayBuffer, mp_context='spawn'))
+        yield agent
+        agent.replay_buffer.close()
+
+    def test_actors_store_into_the_learner_buffer(self, agent, tmp_path):
+        # Episodes of 4 steps
+        loop = self.loop(agent, tmp_path, env_fn=partial(CountingEnv, 2), n_actors=2, max_replay_ratio=2.0,
+                         min_replay_ratio=1.0, weight_sync_every=3)
+        loop.run()
+        assert loop.steps == 300 and int(loop.steps_done.numpy()) == 300
+        assert agent.replay_buffer.current_size == 300
+        assert 300 / 10 - 5 <= loop.updates <= 2.0 * 300 / 10
+        actions = agent.replay_buffer.buffers['action'][:300]
+        assert np.max(actions) > 0 and np.all(actions % 3 == 0)
+        assert loop.metrics[0].compute() == 4
+
+    def test_actor_errors_are_raised(self, agent, tmp_path):
+        loop = self.loop(agent, tmp_path, env_fn=partial(CountingEnv, None), n_actors=1)
+        with pytest.raises(RuntimeError, match='An actor failed'):
+            loop.run()
+
+    def test_needs_a_shared_memory_replay_buffer(self, tmp_path):
+        with pytest.raises(ValueError):
+            self.loop(VersionAgent(), tmp_path, env_fn=partial(CountingEnv, 2), n_actors=1)
+
+
+def test_shared_weights():
+    weights = SharedWeights([np.zeros((2, 3), dtype=np.float32), np.zeros(3, dtype=np.float32)])
+    weights.publish([np.ones((2, 3)), np.full(3, 2.0)], version=4)
+    version, copies = weights.read()
+    assert version == 4 and np.array_equal(copies[0], np.ones((2, 3))) and np.array_equal(copies[1], [2, 2, 2])
+    weights.close()
@@ -22,16 +22,25 @@ class Metric(ABC):
     def compute(self):
         pass
 
+    def record_transitions(self, transitions):
+        """
+        Records one transition of each environment of a vector env, given as arrays with a leading environment
+        dimension. Metrics that follow episodes keep their state for every environment.
+        """
+        raise NotImplementedError(f'{type(self).__name__} does not support vector envs')
+
 
 class AverageReturn(Metric):
     def __init__(self, buffer_size=10, name='average_return'):
         super().__init__(buffer_size, name)
         self.returns = RingBuffer(self.buffer_size, (), np.float32)
         self.current_return = 0.0
+        self.current_returns = None
 
     def reset(self):
         self.returns.purge()
         self.current_return = 0.0
+        self.current_returns = None
 
     def record(self, transition):
         self.current_return += transition['reward']
@@ -39,6 +48,14 @@ class AverageReturn(Metric):
             self.returns.append(self.current_return)
             self.current_return = 0
 
+    def record_transitions(self, transitions):
+        rewards, dones = np.asarray(transitions['reward']), np.asarray(transitions['done'])
+        if self.current_returns is None:
+            self.current_returns = np.zeros(len(rewards), dtype=np.float32)
+        self.current_returns += rewards
+        self.returns.extend(self.current_returns[dones])
+        self.current_returns[dones] = 0.0
+
     def compute(self):
         return np.mean(self.returns[:])
 
@@ -48,10 +65,12 @@ class AverageEpisodeLength(Metric):
         super().__init__(buffer_size, name)
         self.episode_lengths = RingBuffer(self.buffer_size, (), np.float32)
         self.current_length = 0.0
+        self.current_lengths = None
 
     def reset(self):
         self.episode_lengths.purge()
         self.current_length = 0.0
+        self.current_lengths = None
 
     def record(self, transition):
         self.current_length += 1
@@ -59,5 +78,13 @@ class AverageEpisodeLength(Metric):
             self.episode_lengths.append(self.current_length)
             self.current_length = 0.0
 
+    def record_transitions(self, transitions):
+        dones = np.asarray(transitions['done'])
+        if self.current_lengths is None:
+            self.current_lengths = np.zeros(len(dones), dtype=np.float32)
+        self.current_lengths += 1
+        self.episode_lengths.extend(self.current_lengths[dones])
+        self.current_lengths[dones] = 0.0
+
     def compute(self):
         return np.mean(self.episode_lengths[:])
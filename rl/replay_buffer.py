@@ -1,10 +1,20 @@
+import json
+import multiprocessing
+import os
+import tempfile
+import threading
+import weakref
 from abc import ABC, abstractmethod
-from dataclasses import dataclass
+from contextlib import nullcontext
+from dataclasses import dataclass, replace
+from multiprocessing.shared_memory import SharedMemory
 
 import numpy as np
 import tensorflow as tf
 
-from rl.utils import RingBuffer, discounted_cumsum
+from rl.encodings import Encoding
+from rl.utils import RingBuffer, EncodedRingBuffer, FrameStackBuffer, NextObservationBuffer, SumTree, MinTree, \
+    discounted_cumsum, episode_ends, episode_end_of_steps, segmented_discounted_cumsum
 
 
 @dataclass
@@ -12,6 +22,75 @@ class ReplayField:
     name: str
     dtype: np.dtype = np.float32
     shape: tuple = ()
+    storage_dir: str = None
+    encoding: Encoding = None
+    compression_block_size: int = None
+
+    def create_buffer(self, buffer_size, buffers):
+        filename = self._filename()
+        if self.encoding is not None:
+            buffer = EncodedRingBuffer(buffer_size, self.shape, self.dtype, self.encoding, filename=filename,
+                                       compression_block_size=self.compression_block_size)
+        else:
+            buffer = RingBuffer(buffer_size, self.shape, self.dtype, filename=filename,
+                                compression_block_size=self.compression_block_size)
+        return self._removing_file(buffer, filename)
+
+    def _filename(self):
+        if not self.storage_dir:
+            return None
+        # Every buffer gets a file of its own, even when several buffers share a storage_dir
+        os.makedirs(self.storage_dir, exist_ok=True)
+        fd, filename = tempfile.mkstemp(prefix=f'{self.name}-', suffix='.npy', dir=self.storage_dir)
+        os.close(fd)
+        return filename
+
+    @staticmethod
+    def _removing_file(buffer, filename):
+        # The file is scratch storage of this buffer only, removed once the buffer is garbage collected or at exit
+        if filename is not None:
+            weakref.finalize(buffer, _remove_file, filename)
+        return buffer
+
+
+@dataclass
+class FrameStackField(ReplayField):
+    """
+    A field of frames stacked along the last axis (e.g. 80x80x4 Pong observations), which stores every frame once.
+    Set frames_from to the name of another FrameStackField to share its frames, e.g. observation_next with
+    observation. The default frame_capacity holds the frames of buffer_size transitions whenever episodes are at
+    least as long as the stack, a smaller one saves memory when episodes are much longer than that.
+    """
+    frames_from: str = None
+    frame_capacity: int = None
+
+    def create_buffer(self, buffer_size, buffers):
+        if self.frames_from and (self.storage_dir or self.encoding or self.compression_block_size):
+            raise ValueError(f'{self.name} stores its frames in {self.frames_from}, set the storage options there')
+        source = buffers[self.frames_from] if self.frames_from else None
+        filename = self._filename()
+        buffer = FrameStackBuffer(buffer_size, self.shape, self.dtype, frame_capacity=self.frame_capacity,
+                                  source=source, filename=filename, encoding=self.encoding,
+                                  compression_block_size=self.compression_block_size)
+        return self._removing_file(buffer, filename)
+
+
+@dataclass
+class NextObservationField(ReplayField):
+    """
+    A next observation field, which only stores the next observations that differ from the observation of the
+    following transition, i.e. those at the end of an episode. Must be declared after observation_field. These few
+    next observations are kept in memory, so a storage_dir is not supported.
+    """
+    observation_field: str = 'observation'
+
+    def create_buffer(self, buffer_size, buffers):
+        if self.storage_dir or self.encoding or self.compression_block_size:
+            raise ValueError(f'{self.name} keeps its next observations in memory and does not support storage '
+                             f'options, it reads the others from {self.observation_field}')
+        if self.observation_field not in buffers:
+            raise ValueError(f'{self.name} must be declared after {self.observation_field}')
+        return NextObservationBuffer(buffer_size, self.shape, self.dtype, buffers[self.observation_field])
 
 
 @dataclass
@@ -20,6 +99,15 @@ class ComputeField(ABC, ReplayField):
     def __call__(self, *args, **kwargs):
         raise NotImplementedError
 
+    def compute(self, buffers, head, tail, dones):
+        """
+        Computes the field of the transitions head:tail, which are split into episodes by dones. By default, the
+        field is computed episode by episode, fields that override compute do it for all the episodes at once.
+        """
+        ends = head + episode_ends(dones) + 1
+        for episode_head, episode_tail in zip(np.concatenate(([head], ends[:-1])), ends):
+            self(buffers, episode_head, episode_tail)
+
 
 class Advantage(ComputeField):
     def __init__(self, gamma=1.0, lambda_=1.0, reward_field='reward', value_field='value',
@@ -38,6 +126,13 @@ class Advantage(ComputeField):
         deltas = rewards + self.gamma * value_nexts - values
         buffers[self.name][head:tail] = discounted_cumsum(deltas, self.gamma * self.lambda_)
 
+    def compute(self, buffers, head, tail, dones):
+        rewards = buffers[self.reward_field][head:tail]
+        values = buffers[self.value_field][head:tail]
+        value_nexts = buffers[self.value_next_field][head:tail]
+        deltas = rewards + self.gamma * value_nexts - values
+        buffers[self.name][head:tail] = segmented_discounted_cumsum(deltas, self.gamma * self.lambda_, dones)
+
 
 class RewardToGo(ComputeField):
     def __init__(self, gamma=1.0, reward_field='reward', name='reward_to_go'):
@@ -49,6 +144,10 @@ class RewardToGo(ComputeField):
         rewards = buffers[self.reward_field][head:tail]
         buffers[self.name][head:tail] = discounted_cumsum(rewards, self.gamma)
 
+    def compute(self, buffers, head, tail, dones):
+        rewards = buffers[self.reward_field][head:tail]
+        buffers[self.name][head:tail] = segmented_discounted_cumsum(rewards, self.gamma, dones)
+
 
 class EpisodeReturn(ComputeField):
     def __init__(self, reward_field='reward', name='episode_return'):
@@ -59,91 +158,662 @@ class EpisodeReturn(ComputeField):
         episode_return = np.sum(buffers[self.reward_field][head:tail])
         buffers[self.name][head:tail] = episode_return
 
+    def compute(self, buffers, head, tail, dones):
+        ends = episode_ends(dones)
+        lengths = np.diff(ends, prepend=-1)
+        episode_returns = np.add.reduceat(buffers[self.reward_field][head:tail], ends - lengths + 1, axis=0)
+        buffers[self.name][head:tail] = np.repeat(episode_returns, lengths, axis=0)
+
 
 class EpisodeLength(ComputeField):
     def __init__(self, name='episode_length'):
         super().__init__(name=name)
 
     def __call__(self, buffers, head, tail, *args, **kwargs):
-        buffers[self.name][head:tail] = tail - head + 1
+        buffers[self.name][head:tail] = tail - head
+
+    def compute(self, buffers, head, tail, dones):
+        lengths = np.diff(episode_ends(dones), prepend=-1)
+        buffers[self.name][head:tail] = np.repeat(lengths, lengths)
+
+
+class NStepField(ComputeField):
+    """
+    Base of the n-step fields. Transition t is bootstrapped from the observation_next of transition t + offset, where
+    offset = min(n, steps left in its episode) - 1. Episodes end with a done, or where a time limit cut them: where
+    observation_next is not the observation of the following transition. The transitions after the last done are
+    computed again once their episode is done.
+    """
+
+    def __init__(self, n, gamma=1.0, name=None, dtype=np.float32):
+        super().__init__(name=name, dtype=dtype)
+        self.n = n
+        self.gamma = gamma
+
+    def __call__(self, buffers, head, tail, *args, **kwargs):
+        self.compute(buffers, head, tail, buffers['done'][head:tail])
+
+    def _lengths(self, ends_episode):
+        steps = np.arange(len(ends_episode))
+        ends = episode_end_of_steps(ends_episode)
+        return steps, ends, np.minimum(self.n, ends - steps + 1)
+
+    @staticmethod
+    def _ends_episode(buffers, head, tail, dones):
+        ends_episode = np.array(dones, dtype=np.bool_)
+        next_observations = buffers.get('observation_next')
+        if isinstance(next_observations, NextObservationBuffer):
+            # The next observations kept aside are exactly those that don't continue into the following transition
+            ends_episode |= next_observations.is_side[head:tail]
+        elif next_observations is not None and tail - head > 1:
+            discontinuous = next_observations[head:tail - 1] != buffers['observation'][head + 1:tail]
+            ends_episode[:-1] |= np.any(discontinuous.reshape(tail - head - 1, -1), axis=1)
+        return ends_episode
+
+
+class NStepReturn(NStepField):
+    def __init__(self, n, gamma=1.0, reward_field='reward', name='n_step_return'):
+        super().__init__(n, gamma, name=name)
+        self.reward_field = reward_field
+
+    def compute(self, buffers, head, tail, dones):
+        ends_episode = self._ends_episode(buffers, head, tail, dones)
+        steps, ends, lengths = self._lengths(ends_episode)
+        returns = segmented_discounted_cumsum(buffers[self.reward_field][head:tail], self.gamma, ends_episode)
+        # The return of t + lengths is only subtracted when it is still in the episode of t
+        later = steps + lengths
+        later_returns = np.where(later <= ends, returns[np.minimum(later, len(dones) - 1)], 0.0)
+        buffers[self.name][head:tail] = returns - self.gamma ** lengths * later_returns
+
+
+class NStepDiscount(NStepField):
+    def __init__(self, n, gamma=1.0, name='n_step_discount'):
+        super().__init__(n, gamma, name=name)
+
+    def compute(self, buffers, head, tail, dones):
+        steps, ends, lengths = self._lengths(self._ends_episode(buffers, head, tail, dones))
+        # An episode cut by a time limit is still bootstrapped from its last next observation
+        terminal = (steps + lengths - 1 == ends) & np.asarray(dones)[ends]
+        buffers[self.name][head:tail] = np.where(terminal, 0.0, self.gamma ** lengths)
+
+
+class NStepOffset(NStepField):
+    """
+    The distance to the transition that is bootstrapped from, the fields in shifted_fields are sampled from there.
+    """
+
+    def __init__(self, n, shifted_fields=('observation_next',), name='n_step_offset'):
+        super().__init__(n, name=name, dtype=np.int64)
+        self.shifted_fields = tuple(shifted_fields)
+
+    def compute(self, buffers, head, tail, dones):
+        _, _, lengths = self._lengths(self._ends_episode(buffers, head, tail, dones))
+        buffers[self.name][head:tail] = lengths - 1
+
+
+def n_step_fields(n, gamma, reward_field='reward', shifted_fields=('observation_next',)):
+    """
+    The compute fields of n-step returns, none for n == 1 where the stored reward and done are used as they are.
+    """
+    if n == 1:
+        return []
+    return [NStepReturn(n, gamma, reward_field), NStepDiscount(n, gamma), NStepOffset(n, shifted_fields)]
 
 
 class ReplayBuffer(ABC):
-    def __init__(self, buffer_size, store_fields, compute_fields):
+    def __init__(self, buffer_size, store_fields, compute_fields, field_overrides=None, eager_compute=False,
+                 thread_safe=False):
+        """
+        With thread_safe, a collector thread can store transitions while the learner samples them: storing, computing
+        and gathering a batch each hold the lock of the buffer, so a sample is never torn, i.e. all its fields belong
+        to the same, completely stored transition. A batch can hold transitions stored after as_dataset was called,
+        their compute fields are only computed at the next as_dataset (or at their done with eager_compute), until
+        then they read 0. OnePassReplayBuffer epochs are snapshots of the transitions stored before as_dataset.
+        With eager_compute, the compute fields of an episode are computed as soon as its done transition is stored,
+        instead of all at once in as_dataset, which then only computes the incomplete last episode.
+        field_overrides maps the name of a store field either to ReplayField attributes that replace the declared
+        ones, e.g. {'observation': {'storage_dir': '/scratch/replay'}} keeps the observations in a memory-mapped file,
+        or to a function of the declared field returning its replacement,
+        e.g. {'observation': lambda f: FrameStackField(f.name, f.dtype, f.shape)}.
+        """
+        field_overrides = field_overrides or {}
         self.buffer_size = buffer_size
-        self.store_fields = store_fields
+        self.store_fields = [self._override(f, field_overrides.get(f.name, {})) for f in store_fields]
         self.compute_fields = compute_fields
-        self.buffers = {f.name: RingBuffer(self.buffer_size, f.shape, f.dtype)
-                        for f in self.store_fields + self.compute_fields}
-        self.current_size, self.compute_head = 0, 0
+        self.buffers = {}
+        for f in self.store_fields + self.compute_fields:
+            self.buffers[f.name] = f.create_buffer(self.buffer_size, self.buffers)
+        self.eager_compute = eager_compute
+        self.thread_safe = thread_safe
+        self.lock = threading.RLock() if thread_safe else nullcontext()
+        self.current_size, self.compute_head, self.head = 0, 0, 0
 
     @abstractmethod
     def as_dataset(self, *args, **kwargs):
-        self._compute()
+        with self.lock:
+            self._compute()
 
     def purge(self):
-        for buffer in self.buffers.values():
-            buffer.purge()
-        self.current_size, self.compute_head = 0, 0
+        with self.lock:
+            for buffer in self.buffers.values():
+                buffer.purge()
+            self.current_size, self.compute_head, self.head = 0, 0, 0
+
+    def save(self, directory):
+        """
+        Saves the buffers as raw .npy arrays plus a meta.json to directory, writing only the slots that changed since
+        the last save to the same directory. meta.json is replaced last, so an interrupted save keeps the previous
+        metadata, though slots overwritten since then may already hold newer transitions.
+        """
+        os.makedirs(directory, exist_ok=True)
+        with self.lock:
+            metadata = self._metadata()
+            metadata['buffers'] = {name: buffer.save(directory, name) for name, buffer in self.buffers.items()}
+        self._write_metadata(directory, metadata)
+
+    def restore(self, directory):
+        """
+        Restores a buffer saved to directory, memory-mapping the arrays instead of reading them.
+        """
+        metadata = self._read_metadata(directory)
+        with self.lock:
+            for name, buffer in self.buffers.items():
+                buffer.restore(directory, name, metadata['buffers'][name])
+            self._restore_metadata(metadata)
+
+    @staticmethod
+    def _write_metadata(directory, metadata):
+        filename = os.path.join(directory, 'meta.json')
+        with open(f'{filename}.tmp', 'w') as f:
+            json.dump(metadata, f, default=int)
+        os.replace(f'{filename}.tmp', filename)
+
+    def _read_metadata(self, directory):
+        with open(os.path.join(directory, 'meta.json')) as f:
+            metadata = json.load(f)
+        if metadata['buffer_size'] != self.buffer_size or set(metadata['buffers']) != set(self.buffers):
+            raise ValueError(f'{directory} holds a buffer with different fields or buffer_size')
+        return metadata
+
+    def _metadata(self):
+        return {'buffer_size': self.buffer_size, 'current_size': self.current_size,
+                'compute_head': self.compute_head, 'head': self.head}
+
+    def _restore_metadata(self, metadata):
+        self.current_size, self.compute_head, self.head = \
+            metadata['current_size'], metadata['compute_head'], metadata['head']
 
     def store_transition(self, transition):
-        for f in self.store_fields:
-            self.buffers[f.name].append(transition[f.name])
+        with self.lock:
+            for f in self.store_fields:
+                self.buffers[f.name].append(transition[f.name])
+            for f in self.compute_fields:
+                self.buffers[f.name].append(0)
+            self._advance(1)
+            if self.eager_compute and transition['done']:
+                self._compute_episodes(self.current_size)
+
+    def store_transitions(self, transitions):
+        """
+        Stores a batch of consecutive transitions, given as arrays with a leading batch dimension.
+        """
+        n = len(transitions[self.store_fields[0].name])
+        with self.lock:
+            for f in self.store_fields:
+                self.buffers[f.name].extend(np.asarray(transitions[f.name], dtype=f.dtype))
+            for f in self.compute_fields:
+                self.buffers[f.name].extend(np.zeros((min(n, self.buffer_size), *f.shape), dtype=f.dtype))
+            self._advance(n)
+            if self.eager_compute:
+                done_indices = np.flatnonzero(np.asarray(transitions['done'])[-self.buffer_size:])
+                if len(done_indices) > 0:
+                    self._compute_episodes(self.current_size - min(n, self.buffer_size) + int(done_indices[-1]) + 1)
+
+    def _advance(self, n):
+        # Transitions that are overwritten move the start of the uncomputed transitions back
+        overflow = max(self.current_size + n - self.buffer_size, 0)
+        self.compute_head = max(self.compute_head - overflow, 0)
+        self.current_size = min(self.current_size + n, self.buffer_size)
+        self.head = (self.head + overflow) % self.buffer_size
+
+    @staticmethod
+    def _override(field, override):
+        return override(field) if callable(override) else replace(field, **override)
+
+    @staticmethod
+    def _plain(field):
+        # For buffers that store every field as it is, in storage of their own
+        if field.storage_dir or field.encoding or field.compression_block_size:
+            raise ValueError(f'{field.name} does not support storage options in this buffer')
+        return ReplayField(field.name, field.dtype, field.shape)
+
+    def _gather(self, indices):
+        offsets = {k: f.name for f in self.compute_fields if isinstance(f, NStepOffset) for k in f.shifted_fields}
+        data = {k: buf[indices] for k, buf in self.buffers.items() if k not in offsets}
+        for k, offset in offsets.items():
+            data[k] = self.buffers[k][indices + data[offset]]
+        return data
+
+    def _slots(self, indices):
+        # Slots number the transitions the way a single ring buffer of buffer_size would store them
+        return (self.head + indices) % self.buffer_size
+
+    def _indices(self, slots):
+        return (slots - self.head) % self.buffer_size
+
+    def _compute_episodes(self, tail):
+        # The transitions compute_head:tail end with a done, only the ones stored since the last done are scanned
+        dones = self.buffers['done'][self.compute_head:tail]
         for f in self.compute_fields:
-            self.buffers[f.name].append(np.zeros(f.shape))
-        if self.current_size == self.buffer_size:
-            self.compute_head = max(self.compute_head - 1, 0)
-        self.current_size = min(self.current_size + 1, self.buffer_size)
+            f.compute(self.buffers, self.compute_head, tail, dones)
+        self.compute_head = tail
 
     def _compute(self):
         if self.compute_head == self.current_size:
             return
 
-        indices = np.arange(self.compute_head, self.current_size)
-        tail_indices = 1 + indices[self.buffers['done'][self.compute_head:]]
-        # If the last index is not done, add it to the tail_indices
-        if self.buffers['done'][-1] is False:
-            tail_indices = np.concatenate((tail_indices, [self.current_size]))
-
-        for compute_tail in tail_indices:
-            for f in self.compute_fields:
-                f(self.buffers, self.compute_head, compute_tail)
-            # If the last index is not done, do not move the compute_head
-            if compute_tail < self.current_size or self.buffers['done'][-1]:
-                self.compute_head = compute_tail
+        dones = self.buffers['done'][self.compute_head:self.current_size]
+        for f in self.compute_fields:
+            f.compute(self.buffers, self.compute_head, self.current_size, dones)
+        # If the last transition is not done, its episode is computed again once it is done
+        done_indices = np.flatnonzero(dones)
+        if len(done_indices) > 0:
+            self.compute_head += int(done_indices[-1]) + 1
 
 
 class OnePassReplayBuffer(ReplayBuffer):
+    def __init__(self, buffer_size, store_fields, compute_fields, field_overrides=None, eager_compute=False,
+                 thread_safe=False):
+        super().__init__(buffer_size, store_fields, compute_fields, field_overrides, eager_compute, thread_safe)
+        self._arrays = None
+
+    def purge(self):
+        super().purge()
+        self._arrays = None
+
+    def restore(self, directory):
+        super().restore(directory)
+        self._arrays = None
+
+    def store_transition(self, transition):
+        super().store_transition(transition)
+        self._arrays = None
+
+    def store_transitions(self, transitions):
+        super().store_transitions(transitions)
+        self._arrays = None
+
     def as_dataset(self, batch_size=32):
         def data_generator():
-            for i in np.random.default_rng().choice(self.current_size, size=self.current_size, replace=False):
-                yield {f.name: self.buffers[f.name][i.item()]
-                       for f in self.store_fields + self.compute_fields}
+            permutation = np.random.default_rng().permutation(size)
+            for i in range(0, size, batch_size):
+                yield {k: source[permutation[i:i + batch_size]] for k, source in sources.items()}
 
         super().as_dataset()
+        # Plain in-memory fields are materialized once per update, so that minibatches are gathered from contiguous
+        # arrays. Memory-mapped and derived fields (e.g. frame stacks) would take far more memory once materialized,
+        # their minibatches are gathered from the buffers directly, unless the buffer is thread safe: transitions
+        # stored during the epoch would then shift them.
+        with self.lock:
+            if self._arrays is None:
+                self._arrays = {k: np.array(buf[:]) for k, buf in self.buffers.items()
+                                if self.thread_safe or self._is_plain(buf)}
+            sources = {k: self._arrays.get(k, buf) for k, buf in self.buffers.items()}
+            size = self.current_size
         dataset = tf.data.Dataset.from_generator(
             data_generator,
             output_types={f.name: tf.as_dtype(f.dtype) for f in self.store_fields + self.compute_fields},
-            output_shapes={f.name: f.shape for f in self.store_fields + self.compute_fields}
+            output_shapes={f.name: (None, *f.shape) for f in self.store_fields + self.compute_fields}
         )
-        dataset = dataset.batch(batch_size)
         dataset = dataset.prefetch(tf.data.AUTOTUNE)
         return dataset
 
+    @staticmethod
+    def _is_plain(buffer):
+        return type(buffer) is RingBuffer and type(buffer.buffer) is np.ndarray
+
 
 class UniformReplayBuffer(ReplayBuffer):
     def as_dataset(self, batch_size=32):
         def data_generator():
-            i = np.random.randint(self.current_size)
-            yield {k: buf[i] for k, buf in self.buffers.items()}
+            rng = np.random.default_rng()
+            while True:
+                with self.lock:
+                    batch = self._gather(rng.integers(self.current_size, size=batch_size))
+                yield batch
 
         super().as_dataset()
         dataset = tf.data.Dataset.from_generator(
             data_generator,
             output_types={f.name: tf.as_dtype(f.dtype) for f in self.store_fields + self.compute_fields},
-            output_shapes={f.name: f.shape for f in self.store_fields + self.compute_fields}
+            output_shapes={f.name: (batch_size, *f.shape) for f in self.store_fields + self.compute_fields}
+        )
+        dataset = dataset.prefetch(tf.data.AUTOTUNE)
+        return dataset
+
+
+class PrioritizedReplayBuffer(ReplayBuffer):
+    def __init__(self, buffer_size, store_fields, compute_fields, field_overrides=None, eager_compute=False,
+                 thread_safe=False, alpha=0.6, beta=0.4, epsilon=1e-6):
+        if epsilon <= 0:
+            raise ValueError('epsilon must be positive, a zero priority would give an infinite importance weight')
+        super().__init__(buffer_size, store_fields, compute_fields, field_overrides, eager_compute, thread_safe)
+        self.alpha = alpha
+        self.beta = beta
+        self.epsilon = epsilon
+        self.sum_tree = SumTree(self.buffer_size)
+        self.min_tree = MinTree(self.buffer_size)
+        self.max_priority = 1.0
+        # The trees are sampled from the prefetching thread of the dataset while priorities are updated
+        self.tree_lock = threading.Lock()
+
+    def purge(self):
+        with self.lock:
+            super().purge()
+            with self.tree_lock:
+                self.sum_tree.purge()
+                self.min_tree.purge()
+            self.max_priority = 1.0
+
+    def store_transition(self, transition):
+        with self.lock:
+            super().store_transition(transition)
+            self._set_priorities(self._slots(self.current_size - 1), self.max_priority)
+
+    def store_transitions(self, transitions):
+        n = min(len(transitions[self.store_fields[0].name]), self.buffer_size)
+        with self.lock:
+            super().store_transitions(transitions)
+            self._set_priorities(self._slots(np.arange(self.current_size - n, self.current_size)), self.max_priority)
+
+    def save(self, directory):
+        with self.lock:
+            super().save(directory)
+            with self.tree_lock:
+                priorities = self.sum_tree[np.arange(self.buffer_size)]
+            np.save(os.path.join(directory, 'priorities.npy'), priorities)
+
+    def restore(self, directory):
+        priorities = np.load(os.path.join(directory, 'priorities.npy'))
+        with self.lock:
+            super().restore(directory)
+            with self.tree_lock:
+                self.sum_tree.purge()
+                self.min_tree.purge()
+                self.sum_tree[np.arange(self.buffer_size)] = priorities
+                # Free slots have a zero priority in the sum tree, they must not count as the min priority
+                self.min_tree[np.arange(self.current_size)] = priorities[:self.current_size]
+
+    def _metadata(self):
+        return {**super()._metadata(), 'max_priority': float(self.max_priority)}
+
+    def _restore_metadata(self, metadata):
+        super()._restore_metadata(metadata)
+        self.max_priority = metadata['max_priority']
+
+    def update_priorities(self, indices, td_errors):
+        priorities = np.abs(np.asarray(td_errors, dtype=np.float64)) + self.epsilon
+        self.max_priority = max(self.max_priority, np.max(priorities))
+        self._set_priorities(np.asarray(indices), priorities)
+
+    def as_dataset(self, batch_size=32):
+        def data_generator():
+            rng = np.random.default_rng()
+            while True:
+                yield self._sample(batch_size, rng)
+
+        super().as_dataset()
+        fields = self.store_fields + self.compute_fields
+        dataset = tf.data.Dataset.from_generator(
+            data_generator,
+            output_types={**{f.name: tf.as_dtype(f.dtype) for f in fields},
+                          'indices': tf.int64, 'weights': tf.float32},
+            output_shapes={**{f.name: (batch_size, *f.shape) for f in fields},
+                           'indices': (batch_size,), 'weights': (batch_size,)}
+        )
+        dataset = dataset.prefetch(tf.data.AUTOTUNE)
+        return dataset
+
+    def _sample(self, batch_size, rng):
+        with self.lock:
+            # Stratified proportional sampling: one prefix sum from each of batch_size equal segments of the total
+            with self.tree_lock:
+                total = self.sum_tree.reduce()
+                prefixsums = (np.arange(batch_size) + rng.random(batch_size)) * total / batch_size
+                slots = np.minimum(self.sum_tree.find_prefixsum_indices(prefixsums), self.current_size - 1)
+                probabilities = self.sum_tree[slots] / total
+                min_probability = self.min_tree.reduce() / total
+            data = self._gather(self._indices(slots))
+        # Importance sampling weights, normalized by the largest possible weight
+        weights = (probabilities / min_probability) ** -self.beta
+        data['indices'] = slots
+        data['weights'] = weights.astype(np.float32)
+        return data
+
+    def _set_priorities(self, slots, priorities):
+        priorities = np.power(priorities, self.alpha)
+        with self.tree_lock:
+            self.sum_tree[slots] = priorities
+            self.min_tree[slots] = priorities
+
+
+class SharedMemoryReplayBuffer(ReplayBuffer):
+    """
+    A uniform replay buffer whose fields live in multiprocessing.shared_memory blocks, so that actor processes can
+    store transitions while the learner samples them, without pickling or copying them. Pickling the buffer, e.g. as
+    an argument of a multiprocessing.Process, only sends the names of its blocks and its lock, so mp_context must be
+    the context of the processes it is sent to.
+
+    The transitions of several actors are interleaved, so every field is stored as it is: FrameStackField and
+    NextObservationField declarations fall back to plain fields, and compute fields are not supported. Transitions
+    are stored under the lock, with a write cursor counting every transition ever stored. Every slot carries the
+    number of the transition it holds, -1 while it is written, and sampled slots that were written while they were
+    gathered are drawn again, so the fields of a sample always belong to the same transition.
+    The process that creates the buffer owns the blocks and unlinks them in close.
+    """
+
+    def __init__(self, buffer_size, store_fields, compute_fields, field_overrides=None, mp_context=None):
+        if compute_fields:
+            raise ValueError('SharedMemoryReplayBuffer interleaves the transitions of several actors and does not '
+                             'support compute fields')
+        field_overrides = field_overrides or {}
+        self.buffer_size = buffer_size
+        self.store_fields = [self._plain(self._override(f, field_overrides.get(f.name, {}))) for f in store_fields]
+        self.compute_fields = []
+        self.lock = multiprocessing.get_context(mp_context).Lock()
+        sizes = {'cursor': 8, 'sequences': 8 * buffer_size}
+        for f in self.store_fields:
+            sizes[f.name] = max(buffer_size * int(np.prod(f.shape)) * np.dtype(f.dtype).itemsize, 1)
+        self._blocks = {name: SharedMemory(create=True, size=size) for name, size in sizes.items()}
+        self._owner = True
+        self._attach()
+        self.purge()
+
+    def __getstate__(self):
+        return {'buffer_size': self.buffer_size, 'store_fields': self.store_fields, 'lock': self.lock,
+                'blocks': {name: block.name for name, block in self._blocks.items()}}
+
+    def __setstate__(self, state):
+        self.buffer_size, self.store_fields, self.lock = state['buffer_size'], state['store_fields'], state['lock']
+        self.compute_fields = []
+        self._blocks = {name: SharedMemory(name=block) for name, block in state['blocks'].items()}
+        self._owner = False
+        self._attach()
+
+    @property
+    def current_size(self):
+        return min(int(self._cursor[0]), self.buffer_size)
+
+    def close(self):
+        """
+        Releases the shared memory of this process, and frees it if this process created the buffer.
+        """
+        # The arrays must be released before their blocks are closed
+        self._cursor, self._sequences, self.buffers = None, None, {}
+        for block in self._blocks.values():
+            block.close()
+            if self._owner:
+                block.unlink()
+
+    def as_dataset(self, batch_size=32):
+        def data_generator():
+            rng = np.random.default_rng()
+            while True:
+                yield self._sample(batch_size, rng)
+
+        dataset = tf.data.Dataset.from_generator(
+            data_generator,
+            output_types={f.name: tf.as_dtype(f.dtype) for f in self.store_fields},
+            output_shapes={f.name: (batch_size, *f.shape) for f in self.store_fields}
         )
-        dataset = dataset.repeat(-1)
-        dataset = dataset.batch(batch_size)
         dataset = dataset.prefetch(tf.data.AUTOTUNE)
         return dataset
+
+    def purge(self):
+        with self.lock:
+            self._sequences[:] = -1
+            self._cursor[0] = 0
+
+    def save(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        with self.lock:
+            for name, buffer in self.buffers.items():
+                np.save(os.path.join(directory, f'{name}.npy'), buffer)
+            np.save(os.path.join(directory, 'sequences.npy'), self._sequences)
+            metadata = {'buffer_size': self.buffer_size, 'cursor': self._cursor[0], 'buffers': list(self.buffers)}
+        self._write_metadata(directory, metadata)
+
+    def restore(self, directory):
+        metadata = self._read_metadata(directory)
+        with self.lock:
+            for name, buffer in self.buffers.items():
+                buffer[:] = np.load(os.path.join(directory, f'{name}.npy'), mmap_mode='r')
+            self._sequences[:] = np.load(os.path.join(directory, 'sequences.npy'))
+            self._cursor[0] = metadata['cursor']
+
+    def store_transition(self, transition):
+        self.store_transitions({f.name: [transition[f.name]] for f in self.store_fields})
+
+    def store_transitions(self, transitions):
+        n = len(transitions[self.store_fields[0].name])
+        with self.lock:
+            start = int(self._cursor[0])
+            # Transitions that would be overwritten within this call are skipped
+            sequences = np.arange(start, start + n)[-self.buffer_size:]
+            slots = sequences % self.buffer_size
+            self._sequences[slots] = -1
+            for f in self.store_fields:
+                self.buffers[f.name][slots] = np.asarray(transitions[f.name], dtype=f.dtype)[-self.buffer_size:]
+            self._sequences[slots] = sequences
+            self._cursor[0] = start + n
+
+    def _sample(self, batch_size, rng):
+        size = self.current_size
+        data = {f.name: np.empty((batch_size, *f.shape), dtype=f.dtype) for f in self.store_fields}
+        pending = np.arange(batch_size)
+        while len(pending) > 0:
+            slots = rng.integers(size, size=len(pending))
+            sequences = self._sequences[slots]
+            for name, buffer in self.buffers.items():
+                data[name][pending] = buffer[slots]
+            valid = (sequences >= 0) & (sequences == self._sequences[slots])
+            pending = pending[~valid]
+        return data
+
+    def _attach(self):
+        self._cursor = np.ndarray((1,), dtype=np.int64, buffer=self._blocks['cursor'].buf)
+        self._sequences = np.ndarray((self.buffer_size,), dtype=np.int64, buffer=self._blocks['sequences'].buf)
+        self.buffers = {
+            f.name: np.ndarray((self.buffer_size, *f.shape), dtype=f.dtype, buffer=self._blocks[f.name].buf)
+            for f in self.store_fields
+        }
+
+
+class VariableReplayBuffer(ReplayBuffer):
+    """
+    A uniform replay buffer whose fields are stored in tf.Variables, so that sample draws and gathers a batch within
+    the tf.function of an update, e.g. one that runs all the update iterations in one call. Stored transitions are
+    staged in memory and written to the variables at once by sync, which must be called before sampling.
+
+    Only plain fields are supported: FrameStackField and NextObservationField declarations fall back to plain fields
+    and compute fields are not supported.
+    """
+
+    def __init__(self, buffer_size, store_fields, compute_fields, field_overrides=None):
+        if compute_fields:
+            raise ValueError('VariableReplayBuffer does not support compute fields')
+        field_overrides = field_overrides or {}
+        self.buffer_size = buffer_size
+        self.store_fields = [self._plain(self._override(f, field_overrides.get(f.name, {}))) for f in store_fields]
+        self.compute_fields = []
+        self.buffers = {f.name: tf.Variable(tf.zeros((buffer_size, *f.shape), dtype=f.dtype), trainable=False)
+                        for f in self.store_fields}
+        self.size = tf.Variable(0, dtype=tf.int64, trainable=False)
+        self.cursor = 0
+        self._pending = []
+
+    @property
+    def current_size(self):
+        return min(self.cursor + sum(len(p[self.store_fields[0].name]) for p in self._pending), self.buffer_size)
+
+    def as_dataset(self, batch_size=32):
+        self.sync()
+        return tf.data.Dataset.range(1).repeat().map(lambda _: self.sample(batch_size))
+
+    def purge(self):
+        self._pending = []
+        self.cursor = 0
+        self.size.assign(0)
+
+    def save(self, directory):
+        self.sync()
+        os.makedirs(directory, exist_ok=True)
+        for name, variable in self.buffers.items():
+            np.save(os.path.join(directory, f'{name}.npy'), variable.numpy())
+        self._write_metadata(directory, {'buffer_size': self.buffer_size, 'cursor': self.cursor,
+                                         'buffers': list(self.buffers)})
+
+    def restore(self, directory):
+        metadata = self._read_metadata(directory)
+        self._pending = []
+        for name, variable in self.buffers.items():
+            variable.assign(np.load(os.path.join(directory, f'{name}.npy')))
+        self.cursor = metadata['cursor']
+        self.size.assign(min(self.cursor, self.buffer_size))
+
+    def store_transition(self, transition):
+        self._pending.append({f.name: [transition[f.name]] for f in self.store_fields})
+
+    def store_transitions(self, transitions):
+        self._pending.append({f.name: transitions[f.name] for f in self.store_fields})
+
+    def sync(self):
+        """
+        Writes the transitions stored since the last sync to the variables, one or two slice assignments per field.
+        """
+        if not self._pending:
+            return
+        transitions = {f.name: np.concatenate([np.asarray(p[f.name], dtype=f.dtype) for p in self._pending])
+                       for f in self.store_fields}
+        self._pending = []
+        n = len(transitions[self.store_fields[0].name])
+        # Transitions that would be overwritten within this sync are skipped
+        skip = max(n - self.buffer_size, 0)
+        start = (self.cursor + skip) % self.buffer_size
+        first = min(n - skip, self.buffer_size - start)
+        for name, variable in self.buffers.items():
+            values = transitions[name][skip:]
+            variable[start:start + first].assign(values[:first])
+            if first < len(values):
+                variable[:len(values) - first].assign(values[first:])
+        self.cursor += n
+        self.size.assign(min(self.cursor, self.buffer_size))
+
+    def sample(self, batch_size):
+        indices = tf.random.uniform((batch_size,), maxval=self.size, dtype=tf.int64)
+        return {name: tf.gather(variable, indices) for name, variable in self.buffers.items()}
+
+
+def _remove_file(filename):
+    if os.path.exists(filename):
+        os.remove(filename)
@@ -0,0 +1,664 @@
+import gc
+import multiprocessing
+import threading
+
+import numpy as np
+import pytest
+import tensorflow as tf
+
+from rl.encodings import PackedBits
+from rl.replay_buffer import ReplayField, FrameStackField, NextObservationField, UniformReplayBuffer, \
+    OnePassReplayBuffer, PrioritizedReplayBuffer, ComputeField, Advantage, RewardToGo, EpisodeReturn, EpisodeLength, \
+    n_step_fields, SharedMemoryReplayBuffer, VariableReplayBuffer
+
+
+def _store_shared(buffer, start, stop):
+    buffer.store_transitions(_transitions(start, stop))
+    buffer.close()
+
+
+def _store_fields():
+    return [
+        ReplayField('observation', shape=(2,)),
+        ReplayField('reward'),
+        ReplayField('done', dtype=bool),
+    ]
+
+
+def _transitions(start, stop):
+    rewards = np.arange(start, stop)
+    return {'observation': np.stack([rewards, -rewards], axis=1), 'reward': rewards, 'done': rewards % 4 == 3}
+
+
+def _fill(buffer, start, stop):
+    for i in range(start, stop):
+        buffer.store_transition({'observation': [i, -i], 'reward': i, 'done': i % 4 == 3})
+    return buffer
+
+
+class TestReplayBuffer:
+
+    def test_field_overrides_select_memory_mapped_storage(self, tmp_path):
+        buffer = UniformReplayBuffer(buffer_size=20, store_fields=_store_fields(), compute_fields=[],
+                                     field_overrides={'observation': {'storage_dir': str(tmp_path)}})
+        _fill(buffer, 0, 30)
+        assert isinstance(buffer.buffers['observation'].buffer, np.memmap)
+        assert not isinstance(buffer.buffers['reward'].buffer, np.memmap)
+        assert [p.name.startswith('observation-') for p in tmp_path.glob('*.npy')] == [True]
+        for data in buffer.as_dataset(batch_size=8).take(3):
+            reward = data['reward'].numpy()
+            assert np.array_equal(data['observation'].numpy(), np.stack([reward, -reward], axis=1))
+
+    def test_buffers_sharing_a_storage_dir_get_their_own_files(self, tmp_path):
+        buffers = [_fill(UniformReplayBuffer(buffer_size=20, store_fields=_store_fields(), compute_fields=[],
+                                             field_overrides={'observation': {'storage_dir': str(tmp_path)}}),
+                         start, start + 20) for start in [0, 100]]
+        assert len(list(tmp_path.glob('*.npy'))) == 2
+        for buffer, start in zip(buffers, [0, 100]):
+            assert np.array_equal(buffer.buffers['observation'][:][:, 0], np.arange(start, start + 20))
+
+    def test_storage_dir_is_cleaned_up(self, tmp_path):
+        buffer = _fill(UniformReplayBuffer(buffer_size=20, store_fields=_store_fields(), compute_fields=[],
+                                           field_overrides={'observation': {'storage_dir': str(tmp_path)}}), 0, 30)
+        frames = UniformReplayBuffer(buffer_size=20, compute_fields=[], store_fields=[
+            FrameStackField('observation', shape=(2, 3), storage_dir=str(tmp_path)), ReplayField('done', dtype=bool)])
+        assert len(list(tmp_path.glob('*.npy'))) == 2
+        del buffer, frames
+        gc.collect()
+        assert list(tmp_path.iterdir()) == []
+
+    def test_storage_dir_is_rejected_where_it_would_be_ignored(self, tmp_path):
+        store_fields = [
+            ReplayField('observation', shape=(2,)),
+            NextObservationField('observation_next', shape=(2,), storage_dir=str(tmp_path)),
+        ]
+        with pytest.raises(ValueError):
+            UniformReplayBuffer(buffer_size=20, store_fields=store_fields, compute_fields=[])
+        store_fields = [
+            FrameStackField('observation', shape=(2, 3)),
+            FrameStackField('observation_next', shape=(2, 3), frames_from='observation', storage_dir=str(tmp_path)),
+        ]
+        with pytest.raises(ValueError):
+            UniformReplayBuffer(buffer_size=20, store_fields=store_fields, compute_fields=[])
+
+    def test_frame_stack_fields_rebuild_sampled_observations(self):
+        buffer = UniformReplayBuffer(
+            buffer_size=20,
+            store_fields=[
+                ReplayField('observation', dtype=np.int8, shape=(2, 3)),
+                FrameStackField('observation_next', dtype=np.int8, shape=(2, 3), frames_from='observation'),
+                ReplayField('reward'),
+                ReplayField('done', dtype=bool),
+            ],
+            compute_fields=[],
+            field_overrides={'observation': lambda f: FrameStackField(f.name, f.dtype, f.shape)},
+        )
+        assert isinstance(buffer.store_fields[0], FrameStackField)
+        frames = np.arange(-60, 60).reshape(-1, 2).astype(np.int8)
+        for i in range(2, 50):
+            done = i % 9 == 0
+            buffer.store_transition({'observation': frames[i - 2:i + 1].T, 'observation_next': frames[i - 1:i + 2].T,
+                                     'reward': i, 'done': done})
+        for data in buffer.as_dataset(batch_size=8).take(3):
+            reward = data['reward'].numpy().astype(int)
+            assert np.array_equal(data['observation'].numpy(), np.stack([frames[i - 2:i + 1].T for i in reward]))
+            assert np.array_equal(data['observation_next'].numpy(), np.stack([frames[i - 1:i + 2].T for i in reward]))
+
+    def test_store_transitions_matches_store_transition(self):
+        for chunks in [[(0, 7), (7, 8), (8, 19)], [(0, 35)], [(0, 15), (15, 27), (27, 60)]]:
+            expected = _fill(UniformReplayBuffer(buffer_size=20, store_fields=_store_fields(), compute_fields=[]),
+                             0, chunks[-1][1])
+            buffer = UniformReplayBuffer(buffer_size=20, store_fields=_store_fields(), compute_fields=[])
+            for start, stop in chunks:
+                buffer.store_transitions(_transitions(start, stop))
+            assert buffer.current_size == expected.current_size
+            for name in buffer.buffers:
+                assert np.array_equal(buffer.buffers[name][:], expected.buffers[name][:])
+
+    def test_encoded_fields_are_decoded_when_sampled(self):
+        frames = np.random.default_rng(0).integers(0, 2, size=(60, 4, 4)).astype(np.int8)
+        buffer = OnePassReplayBuffer(
+            buffer_size=20,
+            store_fields=[ReplayField('observation', dtype=np.int8, shape=(4, 4, 2)), ReplayField('reward'),
+                          ReplayField('done', dtype=bool)],
+            compute_fields=[],
+            field_overrides={'observation': lambda f: FrameStackField(f.name, f.dtype, f.shape,
+                                                                      encoding=PackedBits())},
+        )
+        buffer.store_transitions({'observation': np.stack([np.moveaxis(frames[i - 2:i], 0, -1) for i in range(2, 50)]),
+                                  'reward': np.arange(2, 50), 'done': np.arange(2, 50) % 9 == 0})
+        for data in buffer.as_dataset(batch_size=8):
+            assert data['observation'].dtype == np.int8
+            reward = data['reward'].numpy().astype(int)
+            assert np.array_equal(data['observation'].numpy(),
+                                  np.stack([np.moveaxis(frames[i - 2:i], 0, -1) for i in reward]))
+
+    def test_save_and_restore(self, tmp_path):
+        def create_buffer():
+            return UniformReplayBuffer(
+                buffer_size=20,
+                store_fields=[
+                    FrameStackField('observation', dtype=np.int8, shape=(2, 3)),
+                    NextObservationField('observation_next', dtype=np.int8, shape=(2, 3)),
+                    ReplayField('reward'),
+                    ReplayField('done', dtype=bool),
+                ],
+                compute_fields=[EpisodeLength()],
+            )
+
+        frames = np.arange(-60, 60).reshape(-1, 2).astype(np.int8)
+        buffer = create_buffer()
+        for i in range(2, 50):
+            buffer.store_transition({'observation': frames[i - 2:i + 1].T, 'observation_next': frames[i - 1:i + 2].T,
+                                     'reward': i, 'done': i % 9 == 0})
+            if i in [20, 41, 49]:
+                buffer._compute()
+                buffer.save(str(tmp_path))
+        restored = create_buffer()
+        restored.restore(str(tmp_path))
+        assert (restored.current_size, restored.compute_head, restored.head) == \
+               (buffer.current_size, buffer.compute_head, buffer.head)
+        for name in buffer.buffers:
+            assert np.array_equal(restored.buffers[name][:], buffer.buffers[name][:])
+        restored.store_transition({'observation': frames[48:51].T, 'observation_next': frames[49:52].T,
+                                   'reward': 50, 'done': False})
+        assert np.array_equal(restored.buffers['observation_next'][-2], frames[48:51].T)
+        assert np.array_equal(restored.buffers['observation'][-1], frames[48:51].T)
+
+    def test_restore_rejects_other_buffers(self, tmp_path):
+        _fill(UniformReplayBuffer(buffer_size=20, store_fields=_store_fields(), compute_fields=[]), 0, 5) \
+            .save(str(tmp_path))
+        with pytest.raises(ValueError):
+            UniformReplayBuffer(buffer_size=30, store_fields=_store_fields(), compute_fields=[]).restore(str(tmp_path))
+
+    def test_frame_stack_fields_work_with_every_buffer(self):
+        frames = np.arange(-60, 60).reshape(-1, 2).astype(np.int8)
+        for replay_buffer_fn in [OnePassReplayBuffer, UniformReplayBuffer, PrioritizedReplayBuffer]:
+            buffer = replay_buffer_fn(
+                buffer_size=20,
+                store_fields=[ReplayField('observation', dtype=np.int8, shape=(2, 3)), ReplayField('reward'),
+                              ReplayField('done', dtype=bool)],
+                compute_fields=[],
+                field_overrides={'observation': lambda f: FrameStackField(f.name, f.dtype, f.shape)},
+            )
+            for i in range(2, 50):
+                buffer.store_transition({'observation': frames[i - 2:i + 1].T, 'reward': i, 'done': i % 9 == 0})
+            for data in buffer.as_dataset(batch_size=8).take(3):
+                reward = data['reward'].numpy().astype(int)
+                assert np.array_equal(data['observation'].numpy(), np.stack([frames[i - 2:i + 1].T for i in reward]))
+            if replay_buffer_fn is OnePassReplayBuffer:
+                assert 'observation' not in buffer._arrays
+
+
+class TestComputeFields:
+
+    @staticmethod
+    def _create_buffer(compute_fields, eager_compute=False):
+        store_fields = _store_fields() + [ReplayField('value'), ReplayField('value_next')]
+        return OnePassReplayBuffer(buffer_size=50, store_fields=store_fields, compute_fields=compute_fields,
+                                   eager_compute=eager_compute)
+
+    @staticmethod
+    def _compute_fields():
+        return [Advantage(gamma=0.99, lambda_=0.95), RewardToGo(gamma=0.9), EpisodeReturn(), EpisodeLength()]
+
+    @staticmethod
+    def _store(buffer, start, stop):
+        rng = np.random.default_rng(start)
+        transitions = _transitions(start, stop)
+        transitions['value'] = rng.normal(size=stop - start)
+        transitions['value_next'] = rng.normal(size=stop - start)
+        buffer.store_transitions(transitions)
+
+    def test_episodes_are_computed_like_the_per_episode_path(self):
+        buffer = self._create_buffer(self._compute_fields())
+        expected = self._create_buffer(self._compute_fields())
+        for start, stop in [(0, 10), (10, 26), (26, 41), (41, 70)]:
+            self._store(buffer, start, stop)
+            self._store(expected, start, stop)
+            buffer._compute()
+            # The ComputeField.compute fallback calls every field once per episode
+            for f in expected.compute_fields:
+                ComputeField.compute(f, expected.buffers, 0, expected.current_size,
+                                     expected.buffers['done'][:expected.current_size])
+            for f in buffer.compute_fields:
+                assert np.allclose(buffer.buffers[f.name][:], expected.buffers[f.name][:], atol=1e-5)
+
+    def test_eager_compute_matches_lazy_compute(self):
+        buffer = self._create_buffer(self._compute_fields(), eager_compute=True)
+        expected = self._create_buffer(self._compute_fields())
+        for start, stop in [(0, 10), (10, 26), (26, 41), (41, 70), (70, 71), (71, 130)]:
+            self._store(buffer, start, stop)
+            self._store(expected, start, stop)
+            # Every episode that is done has already been computed
+            assert buffer.compute_head == buffer.current_size - (stop % 4)
+            buffer._compute()
+            expected._compute()
+            for f in buffer.compute_fields:
+                assert np.allclose(buffer.buffers[f.name][:], expected.buffers[f.name][:], atol=1e-5)
+
+    def test_eager_compute_on_single_transitions(self):
+        buffer = self._create_buffer([EpisodeReturn(), EpisodeLength()], eager_compute=True)
+        for i in range(6):
+            buffer.store_transition({'observation': [i, -i], 'reward': i, 'done': i % 4 == 3, 'value': 0,
+                                     'value_next': 0})
+            assert buffer.compute_head == (4 if i >= 3 else 0)
+        assert np.array_equal(buffer.buffers['episode_length'][:4], [4, 4, 4, 4])
+        assert np.array_equal(buffer.buffers['episode_return'][:4], [6, 6, 6, 6])
+
+    def test_incomplete_last_episode_is_computed_and_recomputed(self):
+        buffer = self._create_buffer([EpisodeReturn(), EpisodeLength()])
+        self._store(buffer, 0, 6)
+        buffer._compute()
+        assert np.array_equal(buffer.buffers['episode_length'][:], [4, 4, 4, 4, 2, 2])
+        assert np.array_equal(buffer.buffers['episode_return'][:], [6, 6, 6, 6, 9, 9])
+        assert buffer.compute_head == 4
+        self._store(buffer, 6, 9)
+        buffer._compute()
+        assert np.array_equal(buffer.buffers['episode_length'][4:], [4, 4, 4, 4, 1])
+        assert np.array_equal(buffer.buffers['episode_return'][4:], [22, 22, 22, 22, 8])
+        assert buffer.compute_head == 8
+
+
+class TestNStepFields:
+
+    @staticmethod
+    def _create_buffer(n, gamma, buffer_size=20):
+        store_fields = [
+            ReplayField('observation'),
+            NextObservationField('observation_next'),
+            ReplayField('reward'),
+            ReplayField('done', dtype=bool),
+        ]
+        return UniformReplayBuffer(buffer_size=buffer_size, store_fields=store_fields,
+                                   compute_fields=n_step_fields(n, gamma))
+
+    # Episodes of 5 transitions, the one of 7 is cut by a time limit: no done, its last next observation is -1
+    cut = 4 + 5 * 7
+
+    @classmethod
+    def _store(cls, buffer, start, stop):
+        steps = np.arange(start, stop)
+        buffer.store_transitions({'observation': steps, 'observation_next': np.where(steps == cls.cut, -1, steps + 1),
+                                  'reward': steps % 3 - 1.0, 'done': (steps % 5 == 4) & (steps != cls.cut)})
+
+    @staticmethod
+    def _expected(rewards, dones, n, gamma, cuts=()):
+        returns, discounts, offsets = [], [], []
+        for t in range(len(rewards)):
+            ret, k = 0.0, 0
+            while k < n and t + k < len(rewards):
+                ret += gamma ** k * rewards[t + k]
+                k += 1
+                if dones[t + k - 1] or t + k - 1 in cuts:
+                    break
+            returns.append(ret)
+            discounts.append(0.0 if dones[t + k - 1] else gamma ** k)
+            offsets.append(k - 1)
+        return returns, discounts, offsets
+
+    @pytest.mark.parametrize('n', [1, 2, 3, 7])
+    def test_fields_match_step_by_step_returns(self, n):
+        gamma = 0.9
+        buffer = self._create_buffer(n, gamma)
+        if n == 1:
+            assert buffer.compute_fields == []
+            return
+        for start, stop in [(0, 7), (7, 16), (16, 33), (33, 49)]:
+            self._store(buffer, start, stop)
+            buffer._compute()
+            rewards, dones = buffer.buffers['reward'][:], buffer.buffers['done'][:]
+            cuts = np.flatnonzero(buffer.buffers['observation'][:] == self.cut)
+            returns, discounts, offsets = self._expected(rewards, dones, n, gamma, cuts)
+            assert np.allclose(buffer.buffers['n_step_return'][:], returns, atol=1e-5)
+            assert np.allclose(buffer.buffers['n_step_discount'][:], discounts)
+            assert np.array_equal(buffer.buffers['n_step_offset'][:], offsets)
+
+    def test_next_observations_are_sampled_from_the_bootstrap_transition(self):
+        buffer = self._create_buffer(3, 0.9)
+        self._store(buffer, 0, 47)
+        buffer._compute()
+        data = buffer._gather(np.arange(buffer.current_size))
+        bootstrap = data['observation'] + data['n_step_offset']
+        assert np.array_equal(data['observation_next'], np.where(bootstrap == self.cut, -1, bootstrap + 1))
+        # Bootstrapping never crosses a done or a cut
+        for i, offset in enumerate(data['n_step_offset']):
+            assert not np.any(data['done'][i:i + offset]) and not np.any(data['observation'][i:i + offset] == self.cut)
+
+    @pytest.mark.parametrize('next_observation_field', [NextObservationField, ReplayField])
+    def test_truncated_episode_is_not_bootstrapped_across(self, next_observation_field):
+        buffer = UniformReplayBuffer(buffer_size=10, compute_fields=n_step_fields(3, 1.0), store_fields=[
+            ReplayField('observation'), next_observation_field('observation_next'), ReplayField('reward'),
+            ReplayField('done', dtype=bool)])
+        # A time limit cuts the first episode after 2 steps, a new one starts at observation 10
+        buffer.store_transitions({'observation': np.array([0, 1, 10, 11]), 'observation_next': np.array([1, 2, 11, 12]),
+                                  'reward': np.array([1, 1, 50, 50]), 'done': np.array([False, False, False, True])})
+        buffer._compute()
+        assert np.array_equal(buffer.buffers['n_step_return'][:], [2, 1, 100, 50])
+        assert np.array_equal(buffer.buffers['n_step_discount'][:], [1, 1, 0, 0])
+        assert np.array_equal(buffer._gather(np.arange(4))['observation_next'], [2, 2, 12, 12])
+
+
+class TestOnePassReplayBuffer:
+
+    @pytest.fixture
+    def buffer(self):
+        return _fill(OnePassReplayBuffer(buffer_size=50, store_fields=_store_fields(), compute_fields=[]), 0, 37)
+
+    class TestAsDataset:
+
+        @staticmethod
+        def _rewards(dataset):
+            return np.concatenate([data['reward'].numpy() for data in dataset])
+
+        def test_every_transition_is_seen_once_per_epoch(self, buffer):
+            dataset = buffer.as_dataset(batch_size=8)
+            for _ in range(3):
+                batch_sizes = [len(data['reward']) for data in dataset]
+                assert batch_sizes == [8, 8, 8, 8, 5]
+                assert np.array_equal(np.sort(self._rewards(dataset)), np.arange(37))
+
+        def test_epochs_are_shuffled_independently(self, buffer):
+            dataset = buffer.as_dataset(batch_size=8)
+            assert not np.array_equal(self._rewards(dataset), self._rewards(dataset))
+
+        def test_fields_of_a_sample_belong_to_the_same_transition(self, buffer):
+            for data in buffer.as_dataset(batch_size=8):
+                reward = data['reward'].numpy()
+                assert np.array_equal(data['observation'].numpy(), np.stack([reward, -reward], axis=1))
+                assert np.array_equal(data['done'].numpy(), reward % 4 == 3)
+
+        def test_new_transitions_are_included_in_later_datasets(self, buffer):
+            buffer.as_dataset(batch_size=8)
+            _fill(buffer, 37, 40)
+            assert np.array_equal(np.sort(self._rewards(buffer.as_dataset(batch_size=8))), np.arange(40))
+            buffer.purge()
+            _fill(buffer, 0, 5)
+            assert np.array_equal(np.sort(self._rewards(buffer.as_dataset(batch_size=8))), np.arange(5))
+
+        def test_only_plain_in_memory_fields_are_materialized(self, tmp_path):
+            buffer = _fill(OnePassReplayBuffer(buffer_size=50, store_fields=_store_fields(), compute_fields=[],
+                                               field_overrides={'observation': {'storage_dir': str(tmp_path)}}), 0, 37)
+            dataset = buffer.as_dataset(batch_size=8)
+            assert set(buffer._arrays) == {'reward', 'done'}
+            for data in dataset:
+                reward = data['reward'].numpy()
+                assert np.array_equal(data['observation'].numpy(), np.stack([reward, -reward], axis=1))
+
+
+class TestUniformReplayBuffer:
+
+    @staticmethod
+    def _create_buffer(size, fill):
+        return _fill(UniformReplayBuffer(buffer_size=size, store_fields=_store_fields(), compute_fields=[]), 0, fill)
+
+    @pytest.fixture
+    def partially_full(self):
+        return self._create_buffer(100, 30)
+
+    @pytest.fixture
+    def overflown(self):
+        return self._create_buffer(20, 55)
+
+    class TestAsDataset:
+
+        def test_batches_have_the_requested_shape(self, partially_full):
+            for data in partially_full.as_dataset(batch_size=8).take(5):
+                assert data['observation'].shape == (8, 2)
+                assert data['reward'].shape == (8,)
+                assert data['done'].shape == (8,)
+
+        def test_fields_of_a_sample_belong_to_the_same_transition(self, partially_full, overflown):
+            for buffer, low, high in [(partially_full, 0, 30), (overflown, 35, 55)]:
+                for data in buffer.as_dataset(batch_size=16).take(10):
+                    reward = data['reward'].numpy()
+                    assert np.all((low <= reward) & (reward < high))
+                    assert np.array_equal(data['observation'].numpy(), np.stack([reward, -reward], axis=1))
+                    assert np.array_equal(data['done'].numpy(), reward % 4 == 3)
+
+
+class TestPrioritizedReplayBuffer:
+
+    @pytest.fixture
+    def buffer(self):
+        buffer = PrioritizedReplayBuffer(buffer_size=20, store_fields=_store_fields(), compute_fields=[], alpha=1.0,
+                                         beta=1.0, epsilon=1e-9)
+        return _fill(buffer, 0, 25)
+
+    def test_samples_carry_indices_and_weights(self, buffer):
+        for data in buffer.as_dataset(batch_size=8).take(3):
+            assert data['indices'].shape == (8,)
+            assert data['weights'].shape == (8,)
+            assert np.all(data['weights'].numpy() == 1.0)
+            reward = data['reward'].numpy()
+            assert np.all((5 <= reward) & (reward < 25))
+            assert np.array_equal(data['observation'].numpy(), np.stack([reward, -reward], axis=1))
+
+    def test_sampling_is_proportional_to_priority(self, buffer):
+        data = next(iter(buffer.as_dataset(batch_size=20)))
+        slots = data['indices'].numpy()
+        buffer.update_priorities(slots, np.zeros(20))
+        buffer.update_priorities(slots[:2], [1.0, 3.0])
+        rewards = np.concatenate([data['reward'].numpy() for data in buffer.as_dataset(batch_size=100).take(20)])
+        expected_rewards = data['reward'].numpy()[:2]
+        assert set(np.unique(rewards)) == set(expected_rewards)
+        assert 0.7 < np.mean(rewards == expected_rewards[1]) < 0.8
+
+    def test_weights_compensate_for_priority(self, buffer):
+        data = next(iter(buffer.as_dataset(batch_size=20)))
+        slots = data['indices'].numpy()
+        buffer.update_priorities(slots, np.arange(1, 21))
+        data = next(iter(buffer.as_dataset(batch_size=64)))
+        priorities = buffer.sum_tree[data['indices'].numpy()]
+        assert np.allclose(data['weights'].numpy(), 1.0 / priorities)
+
+    def test_stored_batches_get_the_max_priority(self, buffer):
+        buffer.update_priorities([0, 1], [7.0, 2.0])
+        buffer.store_transitions(_transitions(25, 30))
+        assert np.allclose(buffer.sum_tree[buffer._slots(np.arange(15, 20))], 7.0)
+        assert buffer.sum_tree.reduce() == pytest.approx(7.0 * 6 + 2.0 + 13)
+
+    def test_new_transitions_get_the_max_priority(self, buffer):
+        buffer.update_priorities([0, 1], [7.0, 2.0])
+        _fill(buffer, 25, 26)
+        assert buffer.sum_tree[buffer._slots(19)] == pytest.approx(7.0)
+
+    def test_priorities_are_saved_and_restored(self, buffer, tmp_path):
+        buffer.update_priorities([0, 3], [7.0, 0.5])
+        buffer.save(str(tmp_path))
+        restored = PrioritizedReplayBuffer(buffer_size=20, store_fields=_store_fields(), compute_fields=[], alpha=1.0,
+                                           beta=1.0, epsilon=1e-9)
+        restored.restore(str(tmp_path))
+        assert np.array_equal(restored.sum_tree.tree, buffer.sum_tree.tree)
+        assert np.array_equal(restored.min_tree.tree, buffer.min_tree.tree)
+        assert restored.max_priority == buffer.max_priority
+
+    def test_epsilon_must_be_positive(self):
+        with pytest.raises(ValueError):
+            PrioritizedReplayBuffer(buffer_size=20, store_fields=_store_fields(), compute_fields=[], epsilon=0.0)
+
+
+class TestThreadSafety:
+
+    @staticmethod
+    def _store_fields():
+        return [ReplayField('observation'), NextObservationField('observation_next'), ReplayField('reward'),
+                ReplayField('done', dtype=bool)]
+
+    @staticmethod
+    def _collect(buffer, stop):
+        # Alternates single and batched stores, which wrap around the buffer many times
+        start = 0
+        while not stop.is_set():
+            steps = np.arange(start, start + 1 + start % 7)
+            transitions = {'observation': steps, 'observation_next': steps + 1, 'reward': steps,
+                           'done': steps % 5 == 4}
+            if len(steps) == 1:
+                buffer.store_transition({k: v[0] for k, v in transitions.items()})
+            else:
+                buffer.store_transitions(transitions)
+            start += len(steps)
+
+    @pytest.mark.parametrize('buffer_cls', [UniformReplayBuffer, PrioritizedReplayBuffer])
+    def test_samples_are_never_torn_while_collecting(self, buffer_cls):
+        buffer = buffer_cls(buffer_size=32, store_fields=self._store_fields(), compute_fields=[EpisodeLength()],
+                            eager_compute=True, thread_safe=True)
+        self._collect_first(buffer)
+        stop = threading.Event()
+        collector = threading.Thread(target=self._collect, args=(buffer, stop))
+        collector.start()
+        try:
+            for data in buffer.as_dataset(16).take(200):
+                assert np.array_equal(data['observation_next'], data['observation'] + 1)
+                assert np.array_equal(data['reward'], data['observation'])
+                assert np.array_equal(data['done'], data['observation'] % 5 == 4)
+                # Episodes are computed under the lock too, never from a partly stored batch
+                assert np.all((data['episode_length'] >= 0) & (data['episode_length'] <= 5))
+        finally:
+            stop.set()
+            collector.join()
+        assert buffer.current_size == 32
+
+    def test_one_pass_epochs_are_snapshots(self):
+        buffer = OnePassReplayBuffer(buffer_size=32, store_fields=self._store_fields(), compute_fields=[],
+                                     thread_safe=True)
+        self._collect_first(buffer)
+        dataset = buffer.as_dataset(4)
+        expected = np.array(buffer.buffers['observation'][:])
+        stop = threading.Event()
+        collector = threading.Thread(target=self._collect, args=(buffer, stop))
+        collector.start()
+        try:
+            batches = list(dataset)
+        finally:
+            stop.set()
+            collector.join()
+        observations = np.concatenate([b['observation'] for b in batches])
+        assert np.array_equal(np.sort(observations), np.sort(expected))
+        assert np.array_equal(np.concatenate([b['observation_next'] for b in batches]), observations + 1)
+
+    @staticmethod
+    def _collect_first(buffer):
+        steps = np.arange(-40, 0)
+        buffer.store_transitions({'observation': steps, 'observation_next': steps + 1, 'reward': steps,
+                                  'done': steps % 5 == 4})
+
+
+class TestSharedMemoryReplayBuffer:
+
+    @pytest.fixture
+    def buffer(self):
+        buffer = SharedMemoryReplayBuffer(buffer_size=20, store_fields=_store_fields(), compute_fields=[],
+                                          mp_context='spawn')
+        yield buffer
+        buffer.close()
+
+    @staticmethod
+    def _assert_consistent(data):
+        assert np.array_equal(data['observation'], np.stack([data['reward'], -data['reward']], axis=1))
+        assert np.array_equal(data['done'], data['reward'] % 4 == 3)
+
+    def test_samples_belong_to_the_same_transition(self, buffer):
+        buffer.store_transitions(_transitions(0, 15))
+        for i in range(15, 27):
+            buffer.store_transition({k: v[0] for k, v in _transitions(i, i + 1).items()})
+        assert buffer.current_size == 20
+        data = buffer._sample(200, np.random.default_rng(0))
+        self._assert_consistent(data)
+        assert set(data['reward']) == set(range(7, 27))
+
+    def test_slots_being_written_are_not_sampled(self, buffer):
+        buffer.store_transitions(_transitions(0, 20))
+        # Slots of transitions that are being overwritten carry -1
+        buffer._sequences[:10] = -1
+        data = buffer._sample(200, np.random.default_rng(0))
+        assert np.all(data['reward'] >= 10)
+
+    def test_actor_processes_store_transitions(self, buffer):
+        context = multiprocessing.get_context('spawn')
+        actors = [context.Process(target=_store_shared, args=(buffer, 100 * i, 100 * i + 8)) for i in range(3)]
+        for actor in actors:
+            actor.start()
+        for actor in actors:
+            actor.join()
+        assert buffer._cursor[0] == 24 and buffer.current_size == 20
+        data = buffer._sample(100, np.random.default_rng(0))
+        self._assert_consistent(data)
+        assert len(set(data['reward'] // 100)) > 1
+
+    def test_fields_are_stored_as_they_are(self):
+        store_fields = [ReplayField('observation'), NextObservationField('observation_next'), ReplayField('done')]
+        buffer = SharedMemoryReplayBuffer(buffer_size=4, store_fields=store_fields, compute_fields=[])
+        try:
+            assert all(type(f) is ReplayField for f in buffer.store_fields)
+        finally:
+            buffer.close()
+        with pytest.raises(ValueError):
+            SharedMemoryReplayBuffer(buffer_size=4, store_fields=store_fields, compute_fields=n_step_fields(3, 0.9))
+
+    def test_save_and_restore(self, buffer, tmp_path):
+        buffer.store_transitions(_transitions(0, 27))
+        buffer.save(tmp_path)
+        restored = SharedMemoryReplayBuffer(buffer_size=20, store_fields=_store_fields(), compute_fields=[])
+        try:
+            restored.restore(tmp_path)
+            assert restored.current_size == 20
+            for name, array in buffer.buffers.items():
+                assert np.array_equal(restored.buffers[name], array)
+            restored.store_transition({k: v[0] for k, v in _transitions(27, 28).items()})
+            assert restored.buffers['reward'][7] == 27
+        finally:
+            restored.close()
+
+
+class TestVariableReplayBuffer:
+
+    @pytest.fixture
+    def buffer(self):
+        return VariableReplayBuffer(buffer_size=20, store_fields=_store_fields(), compute_fields=[])
+
+    @staticmethod
+    def _assert_consistent(data):
+        assert np.array_equal(data['observation'], np.stack([data['reward'], -data['reward']], axis=1))
+        assert np.array_equal(data['done'], data['reward'] % 4 == 3)
+
+    def test_sync_writes_the_stored_transitions(self, buffer):
+        buffer.store_transitions(_transitions(0, 15))
+        buffer.sync()
+        for i in range(15, 27):
+            buffer.store_transition({k: v[0] for k, v in _transitions(i, i + 1).items()})
+        assert buffer.current_size == 20
+        buffer.sync()
+        assert np.array_equal(buffer.buffers['reward'].numpy(), np.roll(np.arange(7, 27), 7))
+        # Transitions that are overwritten within a sync are skipped
+        buffer.store_transitions(_transitions(27, 70))
+        buffer.sync()
+        assert np.array_equal(buffer.buffers['reward'].numpy(), np.roll(np.arange(50, 70), 10))
+        assert buffer.size.numpy() == 20
+
+    def test_samples_are_gathered_in_graph(self, buffer):
+        buffer.store_transitions(_transitions(0, 12))
+        buffer.sync()
+
+        @tf.function
+        def sample():
+            return buffer.sample(64)
+
+        data = {k: v.numpy() for k, v in sample().items()}
+        self._assert_consistent(data)
+        assert set(data['reward']) <= set(range(12))
+        batch = next(iter(buffer.as_dataset(8)))
+        assert batch['observation'].shape == (8, 2)
+
+    def test_save_and_restore(self, buffer, tmp_path):
+        buffer.store_transitions(_transitions(0, 27))
+        buffer.save(tmp_path)
+        restored = VariableReplayBuffer(buffer_size=20, store_fields=_store_fields(), compute_fields=[])
+        restored.restore(tmp_path)
+        assert restored.current_size == 20
+        for name, variable in buffer.buffers.items():
+            assert np.array_equal(restored.buffers[name].numpy(), variable.numpy())
+
+    def test_compute_fields_are_rejected(self):
+        with pytest.raises(ValueError):
+            VariableReplayBuffer(buffer_size=4, store_fields=_store_fields(), compute_fields=[EpisodeLength()])
@@ -1,45 +1,145 @@
+import os
+import zlib
+from collections import OrderedDict
+
 import numpy as np
 import scipy.signal
 import tensorflow as tf
 
 
 class RingBuffer:
-    def __init__(self, buffer_size, shape, dtype):
+    def __init__(self, buffer_size, shape, dtype, filename=None, compression_block_size=None):
         self.buffer_size = buffer_size
-        self.buffer = np.empty((self.buffer_size, *shape), dtype=dtype)
+        self.compression_block_size = compression_block_size
+        if compression_block_size is not None:
+            if filename is not None:
+                raise ValueError('A RingBuffer is either memory-mapped or compressed')
+            self.buffer = BlockCompressedStorage(self.buffer_size, shape, dtype, compression_block_size)
+        elif filename is None:
+            self.buffer = np.empty((self.buffer_size, *shape), dtype=dtype)
+        else:
+            # Backed by a memory-mapped .npy file, the OS page cache decides which slots stay resident
+            os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+            self.buffer = np.lib.format.open_memmap(filename, mode='w+', dtype=dtype,
+                                                    shape=(self.buffer_size, *shape))
         self.head, self.tail = 0, -1
+        # Slots written since the last save to saved_to
+        self.dirty = np.ones(self.buffer_size, dtype=np.bool_)
+        self.saved_to = None
 
     def __len__(self):
         return self._circular_length(self.head, self.tail)
 
     def __getitem__(self, key):
+        """
+        Slices with a positive step return zero-copy views, a RingBufferView of two segments if the slice wraps around
+        the end of the storage. Integer arrays and boolean masks gather copies.
+        """
         if isinstance(key, int):
             index = self._translate_index(key)
             return self.buffer[index]
         if isinstance(key, slice):
-            indices = self._translate_slice(key)
-            return self.buffer[indices]
-        raise IndexError('Indices must be an integer or a slice')
+            slices = self._physical_slices(key)
+            if slices is None:
+                return self.buffer[self._translate_slice(key)]
+            segments = [self.buffer[s] for s in slices]
+            return RingBufferView(*segments) if len(segments) == 2 else segments[0]
+        if isinstance(key, np.ndarray):
+            return self.buffer[self._translate_array(key)]
+        raise IndexError('Indices must be an integer, a slice, an integer array or a boolean mask')
 
     def __setitem__(self, key, value):
         if isinstance(key, int):
             index = self._translate_index(key)
             self.buffer[index] = value
+            self.dirty[index] = True
         elif isinstance(key, slice):
-            indices = self._translate_slice(key)
+            slices = self._physical_slices(key)
+            if slices is None:
+                indices = self._translate_slice(key)
+                self.buffer[indices] = value
+                self.dirty[indices] = True
+                return
+            lengths = [len(range(*s.indices(self.buffer_size))) for s in slices]
+            value = np.broadcast_to(value, (sum(lengths), *self.buffer.shape[1:]))
+            for s, start, stop in zip(slices, [0, lengths[0]], np.cumsum(lengths)):
+                self.buffer[s] = value[start:stop]
+                self.dirty[s] = True
+        elif isinstance(key, np.ndarray):
+            indices = self._translate_array(key)
             self.buffer[indices] = value
+            self.dirty[indices] = True
         else:
-            raise IndexError('Indices must be an integer or a slice')
+            raise IndexError('Indices must be an integer, a slice, an integer array or a boolean mask')
 
     def purge(self):
         self.head, self.tail = 0, -1
 
+    def save(self, directory, name):
+        """
+        Writes the storage to <directory>/<name>.npy, only the slots written since the last save if it was to the same
+        file. Returns the metadata that restore needs.
+        """
+        filename = os.path.join(directory, f'{name}.npy')
+        if filename != self.saved_to or not os.path.exists(filename):
+            array = np.lib.format.open_memmap(filename, mode='w+', dtype=self.buffer.dtype, shape=self.buffer.shape)
+            self.dirty[:] = True
+        else:
+            array = np.load(filename, mmap_mode='r+')
+        slots = np.flatnonzero(self.dirty)
+        if len(slots) == self.buffer_size:
+            array[:] = self.buffer
+        elif len(slots) > 0:
+            array[slots] = self.buffer[slots]
+        array.flush()
+        self.dirty[:] = False
+        self.saved_to = filename
+        return {'head': self.head, 'tail': self.tail}
+
+    def restore(self, directory, name, metadata):
+        """
+        Memory-maps the storage saved to <directory>/<name>.npy copy-on-write, slots are read from disk on first use
+        and later writes never reach the saved file.
+        """
+        filename = os.path.join(directory, f'{name}.npy')
+        buffer = np.load(filename, mmap_mode='c')
+        if buffer.shape != self.buffer.shape or buffer.dtype != self.buffer.dtype:
+            raise ValueError(f'{filename} holds {buffer.dtype} {buffer.shape} values, expected '
+                             f'{self.buffer.dtype} {self.buffer.shape}')
+        if self.compression_block_size is None:
+            self.buffer = buffer
+        else:
+            # Compressed one block at a time, the saved file is never read into memory at once
+            for start in range(0, self.buffer_size, self.compression_block_size):
+                self.buffer[start:start + self.compression_block_size] = \
+                    buffer[start:start + self.compression_block_size]
+        self.head, self.tail = metadata['head'], metadata['tail']
+        self.dirty[:] = False
+        self.saved_to = filename
+
     def append(self, value):
         new_tail = (self.tail + 1) % self.buffer_size
         if self.tail >= 0 and self.head == new_tail:
             self.head = (self.head + 1) % self.buffer_size
         self.tail = new_tail
         self.buffer[self.tail] = value
+        self.dirty[self.tail] = True
+
+    def extend(self, values):
+        n = len(values)
+        if n == 0:
+            return
+        # Values that would be overwritten within this call are skipped
+        skip = max(n - self.buffer_size, 0)
+        length = min(len(self) + n, self.buffer_size)
+        start = (self.tail + 1 + skip) % self.buffer_size
+        stop = min(start + n - skip, self.buffer_size)
+        self.buffer[start:stop] = values[skip:skip + stop - start]
+        self.buffer[:n - skip - (stop - start)] = values[skip + stop - start:]
+        self.dirty[start:stop] = True
+        self.dirty[:n - skip - (stop - start)] = True
+        self.tail = (start + n - skip - 1) % self.buffer_size
+        self.head = (self.tail - length + 1) % self.buffer_size
 
     def _translate_index(self, i):
         i = self._positivify_index(i)
@@ -47,6 +147,39 @@ class RingBuffer:
             raise IndexError(f'Index {i} is out of bounds')
         return (self.head + i) % self.buffer_size
 
+    def _translate_array(self, key):
+        if np.issubdtype(key.dtype, np.bool_):
+            if key.shape != (len(self),):
+                raise IndexError(f'Boolean mask of shape {key.shape} does not match the buffer length {len(self)}')
+            return (self.head + np.flatnonzero(key)) % self.buffer_size
+        if np.issubdtype(key.dtype, np.integer):
+            return self._translate_indices(key)
+        raise IndexError('Indices must be an integer, a slice, an integer array or a boolean mask')
+
+    def _physical_slices(self, s):
+        """
+        Returns the one or two slices of the storage that make up a slice, or None if its step is negative.
+        """
+        if not all(v is None or isinstance(v, (int, np.integer)) for v in (s.start, s.stop, s.step)):
+            raise IndexError('Slice indices must be integers')
+        start, stop, step = s.indices(len(self))
+        if step < 0:
+            return None
+        length = max(stop - start, 0)
+        start = (self.head + start) % self.buffer_size
+        stop = start + length
+        if stop <= self.buffer_size:
+            return slice(start, stop, step),
+        first_length = len(range(start, self.buffer_size, step))
+        return slice(start, None, step), \
+            slice(start + first_length * step - self.buffer_size, stop - self.buffer_size, step)
+
+    def _translate_indices(self, indices):
+        indices = np.where(indices < 0, indices + len(self), indices)
+        if np.any((indices < 0) | (indices >= len(self))):
+            raise IndexError('Indices are out of bounds')
+        return (self.head + indices) % self.buffer_size
+
     def _translate_slice(self, s):
         current_size = len(self)
         start = self._positivify_index(s.start) if s.start is not None else -1
@@ -74,6 +207,426 @@ class RingBuffer:
         return np.arange(head, head + length, step) % self.buffer_size
 
 
+class BlockCompressedStorage:
+    """
+    Array-like storage of a RingBuffer that keeps the max_raw_blocks blocks of block_size slots that were used last
+    uncompressed and zlib-compresses the other, cold, blocks. Reading from a cold block decompresses all of it, so
+    this trades sampling speed for memory, it suits buffers that are mostly read near their write cursor or rarely.
+    """
+
+    def __init__(self, size, shape, dtype, block_size, max_raw_blocks=4, level=1):
+        if max_raw_blocks < 1:
+            raise ValueError('At least one block must be kept uncompressed')
+        self.shape = size, *shape
+        self.dtype = np.dtype(dtype)
+        self.block_size = block_size
+        self.max_raw_blocks = max_raw_blocks
+        self.level = level
+        self.raw = OrderedDict()
+        self.compressed = {}
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __array__(self, dtype=None, copy=None):
+        return self[:].astype(dtype or self.dtype, copy=False)
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, np.integer)):
+            return self._block(key // self.block_size)[key % self.block_size]
+        indices = self._indices(key)
+        values = np.empty((len(indices), *self.shape[1:]), dtype=self.dtype)
+        blocks = indices // self.block_size
+        for block in np.unique(blocks):
+            selected = blocks == block
+            values[selected] = self._block(block)[indices[selected] % self.block_size]
+        return values
+
+    def __setitem__(self, key, value):
+        if isinstance(key, (int, np.integer)):
+            self._block(key // self.block_size, write=True)[key % self.block_size] = value
+            return
+        indices = self._indices(key)
+        value = np.broadcast_to(value, (len(indices), *self.shape[1:]))
+        blocks = indices // self.block_size
+        for block in np.unique(blocks):
+            selected = blocks == block
+            self._block(block, write=True)[indices[selected] % self.block_size] = value[selected]
+
+    @property
+    def nbytes(self):
+        return sum(block.nbytes for block in self.raw.values()) + \
+            sum(len(data) for block, data in self.compressed.items() if block not in self.raw)
+
+    def _indices(self, key):
+        if isinstance(key, slice):
+            return np.arange(*key.indices(len(self)))
+        return np.asarray(key, dtype=np.int64).reshape(-1)
+
+    def _block(self, block, write=False):
+        block = int(block)
+        if block in self.raw:
+            self.raw.move_to_end(block)
+        else:
+            length = min(self.block_size, len(self) - block * self.block_size)
+            if block in self.compressed:
+                data = zlib.decompress(self.compressed[block])
+                self.raw[block] = np.frombuffer(data, dtype=self.dtype).reshape(length, *self.shape[1:]).copy()
+            else:
+                self.raw[block] = np.zeros((length, *self.shape[1:]), dtype=self.dtype)
+            while len(self.raw) > self.max_raw_blocks:
+                evicted, values = self.raw.popitem(last=False)
+                # A block that was only read since it was decompressed still has its compressed copy
+                if evicted not in self.compressed:
+                    self.compressed[evicted] = zlib.compress(values.tobytes(), self.level)
+        if write:
+            self.compressed.pop(block, None)
+        return self.raw[block]
+
+
+class RingBufferView(np.lib.mixins.NDArrayOperatorsMixin):
+    """
+    A zero-copy view of a range of a RingBuffer that wraps around the end of its storage, made of two segments.
+    Element-wise operations between views of the same range, scalars and per-row values run segment by segment and
+    return a view, anything else (reductions, indexing, np.asarray) works on the concatenated segments.
+    """
+
+    def __init__(self, first, second):
+        self.segments = first, second
+
+    def __len__(self):
+        return len(self.segments[0]) + len(self.segments[1])
+
+    @property
+    def shape(self):
+        return len(self), *self.segments[0].shape[1:]
+
+    @property
+    def ndim(self):
+        return self.segments[0].ndim
+
+    @property
+    def dtype(self):
+        return self.segments[0].dtype
+
+    def __array__(self, dtype=None, copy=None):
+        return np.concatenate(self.segments).astype(dtype or self.dtype, copy=False)
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, np.integer)):
+            index = key + len(self) if key < 0 else key
+            if not 0 <= index < len(self):
+                raise IndexError(f'Index {key} is out of bounds')
+            split = len(self.segments[0])
+            return self.segments[0][index] if index < split else self.segments[1][index - split]
+        return np.asarray(self)[key]
+
+    def __array_ufunc__(self, ufunc, method, *inputs, **kwargs):
+        if method == '__call__' and 'out' not in kwargs and all(map(self._is_segmentable, inputs)):
+            results = [ufunc(*(self._segment(x, i) for x in inputs), **kwargs) for i in range(2)]
+            if ufunc.nout > 1:
+                return tuple(RingBufferView(first, second) for first, second in zip(*results))
+            return RingBufferView(*results)
+        inputs = [np.asarray(x) if isinstance(x, RingBufferView) else x for x in inputs]
+        return getattr(ufunc, method)(*inputs, **kwargs)
+
+    def _is_segmentable(self, x):
+        if isinstance(x, RingBufferView):
+            return len(x.segments[0]) == len(self.segments[0]) and len(x) == len(self)
+        # Values with fewer dimensions broadcast onto every row of both segments
+        return np.ndim(x) < self.ndim
+
+    @staticmethod
+    def _segment(x, i):
+        return x.segments[i] if isinstance(x, RingBufferView) else x
+
+
+class EncodedRingBuffer(RingBuffer):
+    """
+    A RingBuffer that stores its values in the form given by an Encoding (see rl.encodings), values are encoded when
+    written and every read decodes the selected values in one vectorized call.
+    """
+
+    def __init__(self, buffer_size, shape, dtype, encoding, filename=None, compression_block_size=None):
+        super().__init__(buffer_size, encoding.stored_shape(shape, dtype), encoding.stored_dtype(shape, dtype),
+                         filename=filename, compression_block_size=compression_block_size)
+        self.shape = shape
+        self.dtype = dtype
+        self.encoding = encoding
+
+    def __getitem__(self, key):
+        stored = super().__getitem__(key)
+        if isinstance(key, int):
+            return self._decode(stored[None])[0]
+        return self._decode(stored)
+
+    def __setitem__(self, key, value):
+        if isinstance(key, int):
+            super().__setitem__(key, self._encode(np.asarray(value)[None])[0])
+        else:
+            n = len(super().__getitem__(key))
+            super().__setitem__(key, self._encode(np.broadcast_to(value, (n, *self.shape))))
+
+    def append(self, value):
+        super().append(self._encode(np.asarray(value)[None])[0])
+
+    def extend(self, values):
+        super().extend(self._encode(np.asarray(values)))
+
+    def roundtrip(self, values):
+        """
+        Returns values as they read once stored.
+        """
+        return self._decode(self._encode(values))
+
+    def _encode(self, values):
+        return self.encoding.encode(values, self.shape, self.dtype)
+
+    def _decode(self, stored):
+        return self.encoding.decode(np.asarray(stored), self.shape, self.dtype)
+
+
+class FrameStackBuffer:
+    """
+    Stores observations made of frames stacked along the last axis, keeping every distinct frame only once.
+    Each stored observation is a pointer to its newest frame, the other frames are the n_frames - 1 frames stored
+    right before it. A stack that continues the previously stored one only adds its newest frame, anything else
+    (e.g. the first observation of an episode) adds all of its frames, so episode boundaries need no bookkeeping.
+    A FrameStackBuffer created with a source shares the source's frames, e.g. observation_next with observation.
+    """
+
+    def __init__(self, buffer_size, shape, dtype, frame_capacity=None, source=None, filename=None, encoding=None,
+                 compression_block_size=None):
+        self.n_frames = shape[-1]
+        self.frame_shape = shape[:-1]
+        self.pointers = RingBuffer(buffer_size, (), np.int64)
+        self.source = source
+        if self.source is None:
+            frame_capacity = frame_capacity or 2 * buffer_size + self.n_frames
+            if encoding is None:
+                self.frames = RingBuffer(frame_capacity, self.frame_shape, dtype, filename=filename,
+                                         compression_block_size=compression_block_size)
+            else:
+                self.frames = EncodedRingBuffer(frame_capacity, self.frame_shape, dtype, encoding, filename=filename,
+                                                compression_block_size=compression_block_size)
+            self.n_pushed = 0
+
+    def __len__(self):
+        return len(self.pointers)
+
+    def __getitem__(self, key):
+        return self._stacks(self.pointers[key])
+
+    def purge(self):
+        self.pointers.purge()
+        if self.source is None:
+            self.frames.purge()
+            self.n_pushed = 0
+
+    def save(self, directory, name):
+        metadata = {'pointers': self.pointers.save(directory, f'{name}.pointers')}
+        if self.source is None:
+            metadata.update(frames=self.frames.save(directory, f'{name}.frames'), n_pushed=self.n_pushed)
+        return metadata
+
+    def restore(self, directory, name, metadata):
+        self.pointers.restore(directory, f'{name}.pointers', metadata['pointers'])
+        if self.source is None:
+            self.frames.restore(directory, f'{name}.frames', metadata['frames'])
+            self.n_pushed = metadata['n_pushed']
+
+    def append(self, value):
+        self.pointers.append(self._push(np.asarray(value)))
+
+    def extend(self, values):
+        # Deduplication depends on the previously stored stack, so stacks are pushed one at a time
+        self.pointers.extend([self._push(np.asarray(value)) for value in values])
+
+    def _push(self, stack):
+        if self.source is not None:
+            return self.source._push(stack)
+        if self.n_pushed > 0:
+            last = self._stacks(self.n_pushed - 1)
+            if np.array_equal(stack, last):
+                return self.n_pushed - 1
+            if np.array_equal(stack[..., :-1], last[..., 1:]):
+                new_frames = stack[..., -1:]
+            else:
+                new_frames = stack
+        else:
+            new_frames = stack
+        for frame in np.moveaxis(new_frames, -1, 0):
+            self.frames.append(frame)
+        self.n_pushed += new_frames.shape[-1]
+        return self.n_pushed - 1
+
+    def _stacks(self, pointers):
+        if self.source is not None:
+            return self.source._stacks(pointers)
+        pointers = np.asarray(pointers)
+        frame_numbers = pointers[..., None] + np.arange(1 - self.n_frames, 1)
+        # Frame number n lives at index n - first of the frames ring, where first is the oldest frame still stored
+        indices = frame_numbers - (self.n_pushed - len(self.frames))
+        if np.any(indices < 0):
+            raise IndexError('Frames of a stored observation were overwritten, increase the frame_capacity')
+        return np.moveaxis(self.frames[indices.reshape(-1)].reshape(*indices.shape, *self.frame_shape),
+                           pointers.ndim, -1)
+
+
+class NextObservationBuffer:
+    """
+    Stores next observations without duplicating the observations buffer. The next observation of a transition is
+    the observation of the transition after it, unless that one starts a new episode (the episode ended or was
+    truncated), in which case it is kept in a side table. Must be appended to after the observations buffer.
+    """
+
+    def __init__(self, buffer_size, shape, dtype, observations):
+        self.buffer_size = buffer_size
+        self.shape = shape
+        self.dtype = dtype
+        self.observations = observations
+        self.is_side = RingBuffer(self.buffer_size, (), np.bool_)
+        self.side = {}
+        self.pending = None
+        self.n_appended = 0
+
+    def __len__(self):
+        return len(self.is_side)
+
+    def __getitem__(self, key):
+        if isinstance(key, int):
+            return self._gather(np.array([key]))[0]
+        if isinstance(key, slice):
+            return self._gather(np.arange(*key.indices(len(self))))
+        if isinstance(key, np.ndarray) and np.issubdtype(key.dtype, np.integer):
+            return self._gather(key)
+        raise IndexError('Indices must be an integer, a slice or an integer array')
+
+    def purge(self):
+        self.is_side.purge()
+        self.side.clear()
+        self.pending = None
+        self.n_appended = 0
+
+    def save(self, directory, name):
+        # The side table only holds the next observations at episode ends, it is small enough to be rewritten
+        keys = np.array(sorted(self.side), dtype=np.int64)
+        np.savez(os.path.join(directory, f'{name}.side.npz'), keys=keys,
+                 values=np.array([self.side[k] for k in keys], dtype=self.dtype).reshape(len(keys), *self.shape),
+                 pending=np.empty((0, *self.shape), dtype=self.dtype) if self.pending is None else self.pending[None])
+        return {'is_side': self.is_side.save(directory, f'{name}.is_side'), 'n_appended': self.n_appended}
+
+    def restore(self, directory, name, metadata):
+        self.is_side.restore(directory, f'{name}.is_side', metadata['is_side'])
+        with np.load(os.path.join(directory, f'{name}.side.npz')) as side:
+            self.side = dict(zip(side['keys'].tolist(), side['values']))
+            self.pending = side['pending'][0] if len(side['pending']) > 0 else None
+        self.n_appended = metadata['n_appended']
+
+    def append(self, value):
+        self.is_side.append(False)
+        # Compare the previous next observation with this observation, unless there is no previous transition left
+        if len(self) > 1 and not np.array_equal(self.pending, self.observations[-1]):
+            self.side[self.n_appended - 1] = self.pending
+            self.is_side[-2] = True
+        self.side.pop(self.n_appended - self.buffer_size, None)
+        self.pending = self._as_stored(np.array(value, dtype=self.dtype)[None])[0]
+        self.n_appended += 1
+
+    def extend(self, values):
+        n = len(values)
+        if n == 0:
+            return
+        values = self._as_stored(np.asarray(values, dtype=self.dtype)[-self.buffer_size:])
+        keep = len(values)
+        # The observations have already been extended, the newest keep of them belong to the new transitions
+        observations = np.asarray(self.observations[len(self.observations) - keep:])
+        if len(self) > 0 and n < self.buffer_size and not np.array_equal(self.pending, observations[0]):
+            self.side[self.n_appended - 1] = self.pending
+            self.is_side[-1] = True
+        is_side = np.zeros(keep, dtype=np.bool_)
+        is_side[:-1] = np.any(values[:-1] != observations[1:], axis=tuple(range(1, values.ndim)))
+        self.is_side.extend(is_side)
+        first = self.n_appended + n - keep
+        for i in np.flatnonzero(is_side):
+            self.side[first + i] = values[i]
+        for k in [k for k in self.side if k < first + keep - self.buffer_size]:
+            del self.side[k]
+        self.pending = values[-1].copy()
+        self.n_appended += n
+
+    def _as_stored(self, values):
+        # Next observations are compared with observations as they read once stored, e.g. after a lossy encoding
+        return self.observations.roundtrip(values) if hasattr(self.observations, 'roundtrip') else values
+
+    def _gather(self, indices):
+        size = len(self)
+        indices = np.where(indices < 0, indices + size, indices)
+        if np.any((indices < 0) | (indices >= size)):
+            raise IndexError('Indices are out of bounds')
+        values = np.empty((len(indices), *self.shape), dtype=self.dtype)
+        is_last = indices == size - 1
+        is_side = self.is_side[indices]
+        is_derived = ~(is_last | is_side)
+        values[is_derived] = self.observations[indices[is_derived] + 1]
+        if np.any(is_last):
+            values[is_last] = self.pending
+        first = self.n_appended - size
+        for i in np.flatnonzero(is_side):
+            values[i] = self.side[first + indices[i]]
+        return values
+
+
+class SegmentTree:
+    def __init__(self, capacity, operation, neutral_element):
+        self.capacity = capacity
+        self.operation = operation
+        self.neutral_element = neutral_element
+        self.n_leaves = 1 << max(capacity - 1, 0).bit_length()
+        self.tree = np.full(2 * self.n_leaves, neutral_element, dtype=np.float64)
+
+    def __getitem__(self, indices):
+        return self.tree[self.n_leaves + np.asarray(indices)]
+
+    def __setitem__(self, indices, values):
+        nodes = self.n_leaves + np.atleast_1d(indices)
+        self.tree[nodes] = values
+        nodes = np.unique(nodes // 2)
+        # All updated leaves are at the same depth, so their ancestors can be refreshed one level at a time
+        while nodes[-1] > 0:
+            self.tree[nodes] = self.operation(self.tree[2 * nodes], self.tree[2 * nodes + 1])
+            nodes = np.unique(nodes // 2)
+
+    def purge(self):
+        self.tree.fill(self.neutral_element)
+
+    def reduce(self):
+        return self.tree[1]
+
+
+class SumTree(SegmentTree):
+    def __init__(self, capacity):
+        super().__init__(capacity, np.add, 0.0)
+
+    def find_prefixsum_indices(self, prefixsums):
+        """
+        Returns, for every prefixsum, the highest index i such that sum(tree[:i]) <= prefixsum.
+        """
+        prefixsums = np.array(prefixsums, dtype=np.float64)
+        nodes = np.ones(prefixsums.shape, dtype=np.int64)
+        while nodes.size and nodes[0] < self.n_leaves:
+            left_sums = self.tree[2 * nodes]
+            go_right = prefixsums >= left_sums
+            prefixsums -= left_sums * go_right
+            nodes = 2 * nodes + go_right
+        return np.minimum(nodes - self.n_leaves, self.capacity - 1)
+
+
+class MinTree(SegmentTree):
+    def __init__(self, capacity):
+        super().__init__(capacity, np.minimum, np.inf)
+
+
 class GradientAccumulator:
     def __init__(self):
         self._gradients = []
@@ -125,3 +678,37 @@ def discounted_cumsum(values, discount):
                3 * 0.9^0]
     """
     return scipy.signal.lfilter([1], [1, float(-discount)], values[::-1], axis=0)[::-1]
+
+
+def episode_ends(dones):
+    """
+    Returns the index of the last value of every episode, the last value ends an episode even if it is not done.
+    """
+    return np.flatnonzero(np.append(np.asarray(dones)[:-1], True))
+
+
+def episode_end_of_steps(dones):
+    """
+    Returns, for every value, the index of the last value of its episode.
+    """
+    ends = episode_ends(dones)
+    return ends[np.searchsorted(ends, np.arange(len(dones)))]
+
+
+def segmented_discounted_cumsum(values, discount, dones):
+    """
+    discounted_cumsum of every episode of values, where an episode ends with a done value, in a single lfilter call.
+    Example:
+    values = [1,2,3,4], discount = 0.9, dones = [F,T,F,F]
+    returns = [1 * 0.9^0 + 2 * 0.9^1,
+               2 * 0.9^0,
+               3 * 0.9^0 + 4 * 0.9^1,
+               4 * 0.9^0]
+    """
+    values = np.asarray(values, dtype=np.float64)
+    # The cumsum over all episodes, from which the cumsum of the episodes that follow each episode is subtracted
+    cumsums = np.append(discounted_cumsum(values, discount), np.zeros((1, *values.shape[1:])), axis=0)
+    steps = np.arange(len(values))
+    next_starts = episode_end_of_steps(dones) + 1
+    discounts = float(discount) ** (next_starts - steps).reshape(-1, *[1] * (values.ndim - 1))
+    return cumsums[:-1] - discounts * cumsums[next_starts]
@@ -1,7 +1,9 @@
 import numpy as np
 import pytest
 
-from rl.utils import RingBuffer
+from rl.encodings import PackedBits, Float16
+from rl.utils import RingBuffer, RingBufferView, EncodedRingBuffer, FrameStackBuffer, NextObservationBuffer, SumTree, \
+    MinTree, discounted_cumsum, segmented_discounted_cumsum
 
 
 class TestRingBuffer:
@@ -69,6 +71,21 @@ class TestRingBuffer:
                 buffer.append(i)
                 assert np.array_equal(buffer[:], np.arange(max(0, i - 2), i + 1))
 
+    class TestExtend:
+
+        def test_extend_matches_repeated_appends(self):
+            for chunk_sizes in [[3, 4, 2], [6, 1, 7, 5], [12], [0, 4, 11, 2]]:
+                expected, actual = RingBuffer(5, (2,), np.int32), RingBuffer(5, (2,), np.int32)
+                start = 0
+                for chunk_size in chunk_sizes:
+                    values = np.stack([np.arange(start, start + chunk_size)] * 2, axis=1)
+                    for value in values:
+                        expected.append(value)
+                    actual.extend(values)
+                    start += chunk_size
+                    assert len(actual) == len(expected)
+                    assert np.array_equal(actual[:], expected[:])
+
     class TestGetItem:
 
         def test_invalid_index(self, full):
@@ -94,6 +111,19 @@ class TestRingBuffer:
                 with pytest.raises(IndexError): overflown[10 + i]
                 with pytest.raises(IndexError): overflown[-11 - i]
 
+        def test_int_arrays(self, partially_full, full, overflown,
+                            partially_full_expected, full_expected, overflown_expected):
+            for indices in [np.array([], dtype=np.int64), np.array([0, 4, 2, 2]), np.array([-1, -5, 3])]:
+                assert np.array_equal(partially_full[indices], partially_full_expected[indices])
+                assert np.array_equal(full[indices], full_expected[indices])
+                assert np.array_equal(overflown[indices], overflown_expected[indices])
+
+        def test_out_of_bounds_int_arrays(self, empty, partially_full, overflown):
+            with pytest.raises(IndexError): empty[np.array([0])]
+            with pytest.raises(IndexError): partially_full[np.array([1, 5])]
+            with pytest.raises(IndexError): partially_full[np.array([-6, 1])]
+            with pytest.raises(IndexError): overflown[np.array([10])]
+
         def test_slices(self, empty, partially_full, full, overflown,
                         empty_expected, partially_full_expected, full_expected, overflown_expected):
             for s in [None, *range(1, 15)]:
@@ -104,6 +134,30 @@ class TestRingBuffer:
                         assert np.array_equal(full[i:j:s], full_expected[i:j:s])
                         assert np.array_equal(overflown[i:j:s], overflown_expected[i:j:s])
 
+        def test_boolean_masks(self, partially_full, overflown, partially_full_expected, overflown_expected):
+            mask = np.arange(10) % 3 == 0
+            assert np.array_equal(overflown[mask], overflown_expected[mask])
+            assert np.array_equal(partially_full[mask[:5]], partially_full_expected[mask[:5]])
+            with pytest.raises(IndexError): partially_full[mask]
+
+        def test_slices_are_views(self, full, overflown):
+            assert np.shares_memory(full[2:8], full.buffer)
+            assert np.shares_memory(overflown[1:4], overflown.buffer)
+            assert isinstance(overflown[:], RingBufferView)
+            assert all(np.shares_memory(segment, overflown.buffer) for segment in overflown[:].segments)
+
+        def test_wrapped_views_behave_like_arrays(self, overflown, overflown_expected):
+            view, expected = overflown[2:9], overflown_expected[2:9]
+            assert view.shape == expected.shape and view.dtype == expected.dtype and len(view) == 7
+            assert view[0] == expected[0] and view[-1] == expected[-1]
+            assert np.array_equal(view[::-2], expected[::-2])
+            assert np.sum(view) == np.sum(expected) and np.mean(view) == np.mean(expected)
+            result = 2 * view + view - 1.5
+            assert isinstance(result, RingBufferView)
+            assert np.array_equal(result, 3 * expected - 1.5)
+            assert np.array_equal(view + np.arange(7), expected + np.arange(7))
+            assert np.array_equal(np.add.reduceat(view, [0, 3]), np.add.reduceat(expected, [0, 3]))
+
     class TestSetItem:
 
         @pytest.fixture
@@ -157,3 +211,320 @@ class TestRingBuffer:
                         check_assign(partially_full, partially_full_expected, slice(i, j, s))
                         check_assign(full, full_expected, slice(i, j, s))
                         check_assign(overflown, overflown_expected, slice(i, j, s))
+
+        def test_int_arrays_and_boolean_masks(self, check_assign, partially_full, overflown, partially_full_expected,
+                                              overflown_expected):
+            for key in [np.array([0, 4, -2]), np.arange(5) % 2 == 0]:
+                check_assign(partially_full, partially_full_expected, key)
+            for key in [np.array([9, 0, -3, 5]), np.arange(10) % 3 == 1]:
+                check_assign(overflown, overflown_expected, key)
+
+        def test_wrapped_slices_broadcast_values(self):
+            buffer = RingBuffer(5, (2,), np.float32)
+            buffer.extend(np.zeros((8, 2)))
+            buffer[1:5] = [1, 2]
+            buffer[:2] = np.array([[3, 4], [5, 6]])
+            assert np.array_equal(buffer[:], [[3, 4], [5, 6], [1, 2], [1, 2], [1, 2]])
+
+    class TestSaveRestore:
+
+        def test_restore_memory_maps_the_saved_buffer(self, tmp_path, overflown, overflown_expected):
+            metadata = overflown.save(str(tmp_path), 'values')
+            restored = RingBuffer(10, (), np.float32)
+            restored.restore(str(tmp_path), 'values', metadata)
+            assert isinstance(restored.buffer, np.memmap)
+            assert np.array_equal(restored[:], overflown_expected)
+            restored.append(100)
+            assert np.array_equal(np.load(tmp_path / 'values.npy')[restored.tail], overflown.buffer[restored.tail])
+
+        def test_only_written_slots_are_saved_again(self, tmp_path, overflown):
+            overflown.save(str(tmp_path), 'values')
+            overflown.append(15)
+            overflown[3] = -1
+            assert np.array_equal(np.flatnonzero(overflown.dirty), np.sort([overflown.tail, (overflown.head + 3) % 10]))
+            metadata = overflown.save(str(tmp_path), 'values')
+            assert not np.any(overflown.dirty)
+            restored = RingBuffer(10, (), np.float32)
+            restored.restore(str(tmp_path), 'values', metadata)
+            assert np.array_equal(restored[:], overflown[:])
+
+        def test_restore_checks_the_shape(self, tmp_path, overflown):
+            metadata = overflown.save(str(tmp_path), 'values')
+            with pytest.raises(ValueError):
+                RingBuffer(10, (2,), np.float32).restore(str(tmp_path), 'values', metadata)
+
+    class TestMemoryMapped:
+
+        def test_memory_mapped_buffer_behaves_like_in_memory_buffer(self, tmp_path, overflown, overflown_expected):
+            buffer = RingBuffer(10, (), np.float32, filename=str(tmp_path / 'buffer.npy'))
+            for i in range(15):
+                buffer.append(i)
+            assert isinstance(buffer.buffer, np.memmap)
+            assert np.array_equal(buffer[:], overflown[:])
+            assert np.array_equal(buffer[np.array([3, -1])], overflown_expected[[3, -1]])
+            buffer[2:4] = [-1, -2]
+            assert np.array_equal(buffer[:4], [5, 6, -1, -2])
+
+        def test_memory_mapped_buffer_is_written_to_disk(self, tmp_path):
+            filename = str(tmp_path / 'nested' / 'buffer.npy')
+            buffer = RingBuffer(4, (2,), np.int16, filename=filename)
+            for i in range(6):
+                buffer.append([i, -i])
+            buffer.buffer.flush()
+            assert np.array_equal(np.load(filename), [[4, -4], [5, -5], [2, -2], [3, -3]])
+
+
+class TestEncodedRingBuffer:
+
+    def test_behaves_like_a_ring_buffer(self):
+        rng = np.random.default_rng(0)
+        values = rng.integers(0, 2, size=(17, 3, 5)).astype(np.int8)
+        buffer, expected = EncodedRingBuffer(10, (3, 5), np.int8, PackedBits()), RingBuffer(10, (3, 5), np.int8)
+        for value in values[:6]:
+            buffer.append(value)
+            expected.append(value)
+        buffer.extend(values[6:])
+        expected.extend(values[6:])
+        assert buffer.buffer.shape == (10, 2)
+        for key in [3, -1, slice(None), slice(2, 9, 3), np.array([0, 9, 4]), np.arange(10) % 2 == 0]:
+            assert np.array_equal(buffer[key], expected[key])
+        for key, value in [(4, values[0]), (slice(7, None), values[1]), (np.array([1, 2]), values[2:4])]:
+            buffer[key] = value
+            expected[key] = value
+        assert np.array_equal(buffer[:], expected[:])
+
+    def test_frame_stacks_can_be_encoded(self):
+        frames = np.random.default_rng(0).integers(0, 2, size=(30, 3, 2)).astype(np.int8)
+        observations = FrameStackBuffer(20, (3, 2, 4), np.int8, encoding=PackedBits())
+        for i in range(4, 30):
+            observations.append(np.moveaxis(frames[i - 4:i], 0, -1))
+        assert observations.frames.buffer.dtype == np.uint8
+        assert np.array_equal(observations[:], np.stack([np.moveaxis(frames[i - 4:i], 0, -1) for i in range(10, 30)]))
+
+
+class TestCompressedRingBuffer:
+
+    def test_behaves_like_a_ring_buffer(self):
+        values = np.arange(2 * 53).reshape(53, 2)
+        buffer = RingBuffer(20, (2,), np.int64, compression_block_size=3)
+        expected = RingBuffer(20, (2,), np.int64)
+        for chunk in np.split(values, [7, 8, 30]):
+            buffer.extend(chunk)
+            expected.extend(chunk)
+            buffer.append(chunk[0])
+            expected.append(chunk[0])
+            assert np.array_equal(buffer[:], expected[:])
+        for key in [3, -1, slice(None, None, -3), np.array([0, 19, 4]), np.arange(20) % 3 == 0]:
+            assert np.array_equal(buffer[key], expected[key])
+        buffer[2:9] = -1
+        expected[2:9] = -1
+        assert np.array_equal(buffer[:], expected[:])
+        assert len(buffer.buffer.raw) <= buffer.buffer.max_raw_blocks
+
+    def test_cold_blocks_are_compressed(self):
+        buffer = RingBuffer(10_000, (8,), np.float32, compression_block_size=500)
+        buffer.extend(np.repeat(np.arange(10_000, dtype=np.float32)[:, None] // 100, 8, axis=1))
+        assert buffer.buffer.nbytes < np.zeros((10_000, 8), dtype=np.float32).nbytes / 4
+        assert np.array_equal(buffer[np.array([0, 5000, 9999])][:, 0], [0, 50, 99])
+
+    def test_save_and_restore(self, tmp_path):
+        buffer = RingBuffer(20, (2,), np.int64, compression_block_size=3)
+        buffer.extend(np.arange(60).reshape(30, 2))
+        metadata = buffer.save(str(tmp_path), 'values')
+        restored = RingBuffer(20, (2,), np.int64, compression_block_size=3)
+        restored.restore(str(tmp_path), 'values', metadata)
+        assert not isinstance(restored.buffer, np.ndarray)
+        assert np.array_equal(restored[:], buffer[:])
+
+
+class TestFrameStackBuffer:
+
+    @staticmethod
+    def _episodes(lengths, n_frames=4, seed=0):
+        """
+        Yields (observation, observation_next) pairs of stacks of random 3x2 frames, padded with zeros on reset.
+        """
+        rng = np.random.default_rng(seed)
+        for length in lengths:
+            stack = np.zeros((3, 2, n_frames), dtype=np.int8)
+            stack = np.dstack((stack, rng.integers(-100, 100, size=(3, 2))))[:, :, 1:]
+            for _ in range(length):
+                stack_next = np.dstack((stack, rng.integers(-100, 100, size=(3, 2))))[:, :, 1:]
+                yield stack, stack_next
+                stack = stack_next
+
+    @pytest.fixture
+    def transitions(self):
+        return list(self._episodes([7, 1, 2, 12, 5]))
+
+    def test_stacks_are_rebuilt_across_episode_boundaries(self, transitions):
+        observations = FrameStackBuffer(30, (3, 2, 4), np.int8)
+        observations_next = FrameStackBuffer(30, (3, 2, 4), np.int8, source=observations)
+        for observation, observation_next in transitions:
+            observations.append(observation)
+            observations_next.append(observation_next)
+        expected = np.stack([t[0] for t in transitions]), np.stack([t[1] for t in transitions])
+        assert len(observations) == len(observations_next) == 27
+        assert np.array_equal(observations[:], expected[0])
+        assert np.array_equal(observations_next[:], expected[1])
+        assert np.array_equal(observations[np.array([3, 8, -1])], expected[0][[3, 8, -1]])
+        assert np.array_equal(observations_next[-2], expected[1][-2])
+        # Every transition adds one frame, every episode additionally adds the frames of its first observation
+        assert observations.n_pushed == 27 + 5 * 4
+
+    def test_overflown_buffer_keeps_the_latest_stacks(self, transitions):
+        observations = FrameStackBuffer(10, (3, 2, 4), np.int8)
+        for observation, _ in transitions:
+            observations.append(observation)
+        assert np.array_equal(observations[:], np.stack([t[0] for t in transitions[-10:]]))
+
+    def test_overwritten_frames_raise(self, transitions):
+        observations = FrameStackBuffer(10, (3, 2, 4), np.int8, frame_capacity=8)
+        for observation, _ in transitions:
+            observations.append(observation)
+        with pytest.raises(IndexError): observations[0]
+
+    def test_purge(self, transitions):
+        observations = FrameStackBuffer(30, (3, 2, 4), np.int8)
+        observations_next = FrameStackBuffer(30, (3, 2, 4), np.int8, source=observations)
+        for observation, observation_next in transitions:
+            observations.append(observation)
+            observations_next.append(observation_next)
+        observations.purge()
+        observations_next.purge()
+        assert len(observations) == len(observations_next) == observations.n_pushed == 0
+        observations.append(transitions[3][0])
+        assert np.array_equal(observations[0], transitions[3][0])
+
+
+class TestNextObservationBuffer:
+
+    @staticmethod
+    def _fill(size, episode_lengths):
+        observations = RingBuffer(size, (2,), np.float32)
+        observations_next = NextObservationBuffer(size, (2,), np.float32, observations)
+        expected, rng = [], np.random.default_rng(0)
+        for length in episode_lengths:
+            observation = rng.uniform(size=2)
+            for _ in range(length):
+                observation_next = rng.uniform(size=2)
+                observations.append(observation)
+                observations_next.append(observation_next)
+                expected.append(observation_next)
+                observation = observation_next
+        return observations_next, np.array(expected[-size:], dtype=np.float32)
+
+    def test_next_observations_are_derived_or_looked_up(self):
+        for size in [1, 2, 10, 50]:
+            observations_next, expected = self._fill(size, [5, 1, 1, 8, 3, 12])
+            assert np.array_equal(observations_next[:], expected)
+            assert np.array_equal(observations_next[2:-3:2], expected[2:-3:2])
+            assert np.array_equal(observations_next[np.array([0, -1, 0])], expected[[0, -1, 0]])
+            assert np.array_equal(observations_next[-1], expected[-1])
+
+    def test_only_episode_ends_are_kept_aside(self):
+        observations_next, _ = self._fill(10, [5, 1, 1, 8, 3, 12])
+        assert len(observations_next.side) == 0
+        observations_next, _ = self._fill(20, [5, 1, 1, 8, 3, 12])
+        assert len(observations_next.side) == 2
+        observations_next, _ = self._fill(50, [5, 1, 1, 8, 3, 12])
+        assert len(observations_next.side) == 5
+
+    def test_extend_matches_repeated_appends(self):
+        rng = np.random.default_rng(1)
+        episodes = [rng.uniform(size=(length + 1, 2)).astype(np.float32) for length in [5, 1, 1, 8, 3, 12]]
+        all_observations = np.concatenate([episode[:-1] for episode in episodes])
+        all_observations_next = np.concatenate([episode[1:] for episode in episodes])
+        for size in [1, 3, 10, 50]:
+            observations = RingBuffer(size, (2,), np.float32)
+            observations_next = NextObservationBuffer(size, (2,), np.float32, observations)
+            expected_observations = RingBuffer(size, (2,), np.float32)
+            expected = NextObservationBuffer(size, (2,), np.float32, expected_observations)
+            for start, stop in [(0, 4), (4, 17), (17, 18), (18, 30)]:
+                observations.extend(all_observations[start:stop])
+                observations_next.extend(all_observations_next[start:stop])
+                for i in range(start, stop):
+                    expected_observations.append(all_observations[i])
+                    expected.append(all_observations_next[i])
+                assert np.array_equal(observations_next[:], expected[:])
+                assert np.array_equal(observations_next.is_side[:], expected.is_side[:])
+                assert observations_next.side.keys() == expected.side.keys()
+
+    def test_encoded_observations_only_keep_episode_ends_aside(self):
+        observations = EncodedRingBuffer(50, (2,), np.float32, Float16())
+        observations_next = NextObservationBuffer(50, (2,), np.float32, observations)
+        rng = np.random.default_rng(0)
+        episodes = [rng.uniform(size=(length + 1, 2)).astype(np.float32) for length in [5, 1, 8]]
+        for episode in episodes:
+            observations.extend(episode[:-1])
+            observations_next.extend(episode[1:])
+        assert len(observations_next.side) == 2
+        expected = np.concatenate([episode[1:] for episode in episodes]).astype(np.float16).astype(np.float32)
+        assert np.array_equal(observations_next[:], expected)
+
+    def test_out_of_bounds_indices(self):
+        observations_next, _ = self._fill(10, [3])
+        with pytest.raises(IndexError): observations_next[3]
+        with pytest.raises(IndexError): observations_next[np.array([-4])]
+
+
+class TestSegmentTrees:
+
+    @pytest.fixture
+    def values(self):
+        return np.random.default_rng(0).uniform(size=13)
+
+    def test_reductions_track_updates(self, values):
+        sum_tree, min_tree = SumTree(13), MinTree(13)
+        for i, v in enumerate(values):
+            sum_tree[i] = v
+            min_tree[i] = v
+            assert np.isclose(sum_tree.reduce(), np.sum(values[:i + 1]))
+            assert np.isclose(min_tree.reduce(), np.min(values[:i + 1]))
+        sum_tree[np.array([2, 7, 7])] = np.array([5.0, 1.0, 3.0])
+        min_tree[np.array([2, 7])] = np.array([5.0, 1e-3])
+        values[[2, 7]] = [5.0, 3.0]
+        assert np.isclose(sum_tree.reduce(), np.sum(values))
+        assert np.array_equal(sum_tree[np.arange(13)], values)
+        assert np.isclose(min_tree.reduce(), 1e-3)
+
+    def test_purge_resets_to_neutral_element(self, values):
+        sum_tree, min_tree = SumTree(13), MinTree(13)
+        sum_tree[np.arange(13)] = values
+        min_tree[np.arange(13)] = values
+        sum_tree.purge()
+        min_tree.purge()
+        assert sum_tree.reduce() == 0.0
+        assert min_tree.reduce() == np.inf
+
+    def test_find_prefixsum_indices(self, values):
+        sum_tree = SumTree(13)
+        sum_tree[np.arange(13)] = values
+        prefixsums = np.random.default_rng(1).uniform(0, np.sum(values), size=1000)
+        expected = np.searchsorted(np.cumsum(values), prefixsums, side='right')
+        assert np.array_equal(sum_tree.find_prefixsum_indices(prefixsums), expected)
+
+    def test_find_prefixsum_indices_skips_zero_leaves(self):
+        sum_tree = SumTree(8)
+        sum_tree[np.arange(8)] = [0, 1, 0, 0, 2, 0, 1, 0]
+        indices = sum_tree.find_prefixsum_indices([0.0, 0.5, 1.0, 2.9, 3.0, 3.5])
+        assert np.array_equal(indices, [1, 1, 4, 4, 6, 6])
+
+
+class TestSegmentedDiscountedCumsum:
+
+    def test_matches_discounted_cumsum_of_every_episode(self):
+        rng = np.random.default_rng(0)
+        for discount in [0.0, 0.5, 0.99, 1.0]:
+            for last_done in [True, False]:
+                lengths = [1, 7, 3, 1, 20, 4]
+                values = rng.normal(size=sum(lengths))
+                dones = np.zeros(sum(lengths), dtype=bool)
+                dones[np.cumsum(lengths)[:-1] - 1] = True
+                dones[-1] = last_done
+                episodes = np.split(values, np.cumsum(lengths)[:-1])
+                expected = np.concatenate([discounted_cumsum(episode, discount) for episode in episodes])
+                assert np.allclose(segmented_discounted_cumsum(values, discount, dones), expected)
+
+    def test_single_value(self):
+        assert np.allclose(segmented_discounted_cumsum([3.0], 0.9, [False]), [3.0])
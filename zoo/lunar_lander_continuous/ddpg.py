@@ -1,10 +1,13 @@
 import os
+from functools import partial
 
 import gym
 
 from rl.agents.ddpg import DDPG
+from rl.encodings import Float16
 from rl.loops import StepTrainLoop
 from rl.metrics import AverageReturn, AverageEpisodeLength
+from rl.replay_buffer import UniformReplayBuffer
 from zoo.lunar_lander_continuous.core import PolicyNetwork, QFunctionNetwork
 from zoo.utils import parse_args, get_output_dirs, evaluate_policy
 
@@ -25,6 +28,10 @@ if __name__ == '__main__':
         gamma=0.99,
         polyak=0.995,
         replay_buffer_size=50_000,
+        replay_buffer_fn=partial(UniformReplayBuffer, field_overrides={
+            'observation': {'encoding': Float16()},
+        }),
+        n_step=3,
         update_iterations=50,
         update_batch_size=32,
         action_noise=0.1,
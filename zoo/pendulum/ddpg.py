@@ -26,6 +26,7 @@ if __name__ == '__main__':
         polyak=0.995,
         action_noise=0.1,
         replay_buffer_size=5000,
+        n_step=3,
         update_iterations=50,
         update_batch_size=32,
     )
@@ -25,6 +25,7 @@ if __name__ == '__main__':
         gamma=0.99,
         polyak=0.995,
         replay_buffer_size=5000,
+        n_step=3,
         update_iterations=50,
         update_batch_size=32,
         update_policy_delay=2,
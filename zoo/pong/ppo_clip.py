@@ -1,8 +1,11 @@
 import os
+from functools import partial
 
 from rl.agents.ppo_clip import PPOClip
+from rl.encodings import PackedBits
 from rl.loops import EpisodeTrainLoop
 from rl.metrics import AverageReturn, AverageEpisodeLength
+from rl.replay_buffer import OnePassReplayBuffer, FrameStackField
 from zoo.pong.core import PolicyNetwork, ValueFunctionNetwork, PongEnvWrapper
 from zoo.utils import parse_args, get_output_dirs, evaluate_policy
 
@@ -26,7 +29,11 @@ if __name__ == '__main__':
         policy_update_iterations=5,
         policy_update_batch_size=64,
         vf_update_batch_size=64,
-        replay_buffer_size=100_000
+        replay_buffer_size=100_000,
+        replay_buffer_fn=partial(OnePassReplayBuffer, field_overrides={
+            'observation': lambda f: FrameStackField(f.name, f.dtype, f.shape, frame_capacity=101_000,
+                                                     encoding=PackedBits()),
+        }),
     )
 
     train_loop = EpisodeTrainLoop(